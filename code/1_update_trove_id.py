@@ -6,9 +6,20 @@ TO FOLLOW UP: WHAT HAPPENS TO ROWS WITH TROVE_ID THAT IS NOT UPDATED????!!!!!I N
 
 import os
 import pandas as pd
-import re
 import json
 import glob
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+import tbc
+from mappings_index import TroveIdMap, ijson, load_mappings_index, stream_mappings
+from pipeline_state import PipelineState, atomic_write
+from sheet_schema import LEGACY_COLUMNS, report_unprocessable, resolve_columns, sniff_sheets
+from table_io import resolve_format, table_path, write_table
+from xlsx_readers import read_sheet
 
 def rename_trove_column(df):
     """
@@ -22,13 +33,10 @@ def rename_trove_column(df):
     pandas.DataFrame: The modified DataFrame. If a 'Trove ID' column was found and renamed, the returned DataFrame will have this column renamed to 'Old_Trove_ID'. Otherwise, the DataFrame is returned as is.
     """
 
-    found_column = False
-    for column in df.columns:
-        if re.search(r'trove[_\s]ID', column, re.IGNORECASE):
-            df.rename(columns={column: 'Old_Trove_ID'}, inplace=True)
-            found_column = True
-            break
-    if not found_column:
+    column = resolve_columns(df.columns).get('trove_id')
+    if column is not None:
+        df.rename(columns={column: 'Old_Trove_ID'}, inplace=True)
+    else:
         print('Column not found')
     return df
 
@@ -70,57 +78,252 @@ def load_trove_dictionary(file_path: str) -> dict:
         trove_dict = data.get("trove", {})
     return trove_dict
 
-def process_directory(input_dir, json_file_path: str) -> None:
+def load_trove_index(file_path: str) -> TroveIdMap:
+    """
+    This function loads the 'trove' dictionary of a mappings JSON file from its compiled binary index
+    (see mappings_index), compiling the index first if it is missing or out of date.
+    The mapping is memory-mapped rather than built as a Python dict.
+
+    Parameters:
+    file_path (str): The path to the JSON file.
+
+    Returns:
+    TroveIdMap: The mapping of old Trove IDs to new title_ids.
+    """
+    return load_mappings_index(file_path).trove
+
+def load_trove_streaming(file_path: str) -> TroveIdMap:
+    """
+    This function reads only the 'trove' dictionary from a JSON file with an incremental parse, straight into a
+    compact array-backed mapping, without loading the rest of the file. It is for when the mappings JSON has changed
+    and there is no time to compile its index first. Falls back to load_trove_dictionary if ijson is not installed.
+
+    Parameters:
+    file_path (str): The path to the JSON file.
+
+    Returns:
+    TroveIdMap: The mapping of old Trove IDs to new title_ids.
+    """
+    if ijson is None:
+        print("ijson is not installed, loading the whole mappings JSON instead")
+        return load_trove_dictionary(file_path)
+    return stream_mappings(file_path, uploaded_chapters=False)[0]
+
+# How each --loader value loads the Trove IDs
+TROVE_LOADERS = {'index': load_trove_index, 'stream': load_trove_streaming, 'json': load_trove_dictionary}
+
+def remap_trove_ids(old_trove_ids, trove_dict):
+    """
+    This function maps a Series of (int) old Trove IDs to the new title_ids, as a nullable Int64 Series
+    that is empty wherever there is no mapping.
+
+    Parameters:
+    old_trove_ids (pandas.Series): The old Trove IDs.
+    trove_dict (dict or TroveIdMap): The dictionary of Trove IDs from load_trove_dictionary or load_trove_index.
+
+    Returns:
+    pandas.Series: The new title_ids.
+    """
+    if isinstance(trove_dict, TroveIdMap):
+        return pd.Series(trove_dict.map_ids(old_trove_ids), index=old_trove_ids.index)
+    return old_trove_ids.astype(str).map(trove_dict).astype('Int64')
+
+def update_trove_ids(df, trove_dict):
+    """
+    This function renames the Trove ID column to 'Old_Trove_ID', converts it to integers and adds a 'title_id'
+    column with the new Trove IDs (empty where there is no mapping).
+
+    Parameters:
+    df (pandas.DataFrame): A sheet as read from an Excel file.
+    trove_dict (dict or TroveIdMap): The dictionary of Trove IDs.
+
+    Returns:
+    pandas.DataFrame: The updated DataFrame.
+    """
+    df = rename_trove_column(df)
+    df = convert_to_int(df)
+    df['title_id'] = remap_trove_ids(df['Old_Trove_ID'], trove_dict)
+    return df
+
+# The trove mapping used by worker processes. With the 'fork' start method it is set in the parent before the pool
+# starts, so workers share the parent's copy (copy-on-write) instead of having it pickled to them for every file.
+_worker_trove_dict = None
+
+# The reader options used by worker processes, set by _init_worker
+_worker_reader = {}
+
+def _init_worker(json_file_path, reader, loader):
+    """
+    This function runs once in each worker process. If the worker was not forked from a parent that already holds
+    the trove mapping, it loads the mapping itself (once per worker, not once per file).
+    """
+    global _worker_trove_dict
+    if _worker_trove_dict is None:
+        _worker_trove_dict = TROVE_LOADERS[loader](json_file_path)
+    _worker_reader.update(reader)
+
+def process_file(file_path: str, output_dir: str, trove_dict=None, backend=None, columns=None, output_format='csv',
+                 usecols=range(LEGACY_COLUMNS)) -> tuple:
+    """
+    This function reads one Excel file, renames the Trove ID column, converts the Trove ID values to integers,
+    maps the old Trove IDs to new ones and writes the updated data to an '_UPDATED_MAPPING' file in output_dir.
+
+    Parameters:
+    file_path (str): The path to the Excel file.
+    output_dir (str): The folder to write the CSV file to.
+    trove_dict (dict or TroveIdMap): The dictionary of Trove IDs. Worker processes leave this out and use the shared mapping.
+    backend (str): The Excel reader backend (see xlsx_readers). Worker processes leave this out and use the pool's.
+    columns (list): Regular expressions for the columns to keep. None keeps all the columns in usecols.
+    output_format (str): The format to write: 'csv', 'parquet' or 'arrow' (see table_io).
+    usecols (range): The column positions to read, from the sheet's layout (see sheet_schema). None reads all columns.
+
+    Returns:
+    tuple: (the number of rows written, the time in seconds it took to parse the Excel file,
+    the time in seconds it took to process the whole file)
+    """
+    start = time.perf_counter()
+    if trove_dict is None:
+        trove_dict = _worker_trove_dict
+        backend = _worker_reader.get('backend', 'pandas')
+        columns = _worker_reader.get('columns')
+        output_format = _worker_reader.get('output_format', 'csv')
+
+    df, backend, parse_seconds = read_sheet(file_path, sheet_name='Sheet1', usecols=usecols,
+                                            columns=columns, backend=backend or 'pandas')
+    #df = pd.read_excel(file_path, sheet_name='Sheet1')
+    print(f"parsed {file_path} in {parse_seconds:.2f}s ({backend})")
+
+    df = update_trove_ids(df, trove_dict)
+    # Write the DataFrame to a new file in 'processed_files' folder
+    with atomic_write(_output_file_path(file_path, output_dir, output_format)) as temp_path:
+        write_table(df, temp_path, output_format)
+    return len(df), parse_seconds, time.perf_counter() - start
+
+def _output_file_path(file_path: str, output_dir: str, output_format='csv') -> str:
+    base_name = os.path.basename(file_path).replace('.xlsx', '_UPDATED_MAPPING')
+    return table_path(os.path.join(output_dir, base_name), output_format)
+
+def process_directory(input_dir, json_file_path: str, workers=1, backend='pandas', columns=None, loader='index',
+                      output_format='csv') -> dict:
     """
     This function processes all Excel files in the given directory. 
     For each Excel file, it reads the data, renames the Trove ID column, 
     converts the Trove ID values to integers, maps the old Trove IDs to new 
     ones using the dictionary from the JSON file, and writes the updated data 
-    to a new CSV file in a 'processed_files' subdirectory.
+    to a new file (CSV by default) in a 'processed_files' subdirectory.
+    Files that were already processed with the same content and mappings are skipped.
+    The header row of every file is read first (see sheet_schema): the files without a Trove ID column are reported
+    together, in 'column_not_found.txt' in the output folder, and skipped, and only the sheets created prior to
+    June 2022 (wider than 33 columns) are limited to their first 33 columns.
+    With more than one worker the files are processed in a pool of worker processes.
 
     Parameters:
     input_dir (str): The path to the directory containing the Excel files to process.
     json_file_path (str): The path to the JSON file containing the dictionary of Trove IDs.
+    workers (int): The number of worker processes. 1 processes the files one at a time in this process.
+    backend (str): The Excel reader backend: 'pandas', 'openpyxl' or 'calamine' (see xlsx_readers).
+    columns (list): Regular expressions for the columns to keep. None keeps all the columns the sheet's layout reads.
+    loader (str): How to load the Trove IDs: 'index' from the compiled mappings index (see mappings_index),
+    'stream' with an incremental parse of the JSON file, or 'json' with json.load.
+    output_format (str): The format to write the updated data in: 'csv', 'parquet' or 'arrow' (see table_io).
     
     Returns:
-    None
+    dict: A summary of the run, with the rows written per processed file ('processed'), the parse time per
+    processed file ('parse_seconds'), the skipped files ('skipped'), the error message per failed file ('failed')
+    and the reason per file that can't be processed ('unprocessable').
     """
-    trove_dict = load_trove_dictionary(json_file_path)
+    global _worker_trove_dict
+    output_format = resolve_format(output_format)
+    with metrics.timer('mappings_load', stage='update_trove_id', loader=loader):
+        if loader == 'index':
+            mappings_index = load_mappings_index(json_file_path)
+            trove_dict, mappings_version = mappings_index.trove, mappings_index.source_sha256
+        else:
+            trove_dict, mappings_version = TROVE_LOADERS[loader](json_file_path), None
     # Create 'processed_files' folder in the same directory
     output_dir = os.path.join(input_dir, 'processed_files')
     os.makedirs(output_dir, exist_ok=True)
+    state = PipelineState(output_dir, 'update_trove_id', json_file_path, mappings_version)
+    summary = {'processed': {}, 'parse_seconds': {}, 'skipped': [], 'failed': {}, 'unprocessable': {}}
 
     # Get list of all Excel files in the directory
     file_list = glob.glob(os.path.join(input_dir, '*.xlsx'))
+    to_process = []
     for file_path in file_list:
         # Skip temporary files
         if os.path.basename(file_path).startswith('~$'):
             continue
-        #print to console to show progress
-        print(f"working on {file_path}")
 
         # Check if file has already been processed
-        base_name = os.path.splitext(os.path.basename(file_path))[0]
-        if os.path.exists(os.path.join(output_dir, f'{base_name}_UPDATED_MAPPING.csv')): 
+        if state.is_done(file_path):
             print(f"{file_path} has already been processed, skipping...")
+            summary['skipped'].append(file_path)
             continue
+        to_process.append(file_path)
 
-        # Read only up to the 33rd column, this is only for the sheets created prior to June_2022
-        df = pd.read_excel(file_path, sheet_name='Sheet1', usecols=range(33))
-        #df = pd.read_excel(file_path, sheet_name='Sheet1')
-        
-        df = rename_trove_column(df)
-        df = convert_to_int(df)
-        df['title_id'] = df['Old_Trove_ID'].astype(str).map(trove_dict).astype('Int64')
-        # Write the DataFrame to a new CSV file in 'processed_files' folder
-        output_file_name = os.path.basename(file_path).replace('.xlsx', '_UPDATED_MAPPING.csv')
-        output_file_path = os.path.join(output_dir, output_file_name)
-        df.to_csv(output_file_path, index=False)
+    # Read only the header row of each file first, and report the files that can't be processed all together
+    schemas = sniff_sheets(to_process, 'update_trove_id')
+    summary['unprocessable'] = report_unprocessable(schemas, output_dir)
+    to_process = [file_path for file_path in to_process if schemas[file_path].processable]
+
+    def record_result(file_path, result=None, error=None):
+        # The manifest is only ever written by this (parent) process
+        if error is None:
+            rows, summary['parse_seconds'][file_path], seconds = result
+            summary['processed'][file_path] = rows
+            # Timed in the worker, recorded here since worker processes do not share the metrics
+            metrics.observe('xlsx_parse', summary['parse_seconds'][file_path], stage='update_trove_id',
+                            backend=backend, sheet=file_path)
+            metrics.observe('sheet', seconds, rows, stage='update_trove_id', sheet=file_path)
+            state.mark_done(file_path, rows, [_output_file_path(file_path, output_dir, output_format)])
+        else:
+            print(f"Error processing {file_path}: {error}")
+            summary['failed'][file_path] = error
+
+    if workers <= 1 or len(to_process) <= 1:
+        for file_path in to_process:
+            #print to console to show progress
+            print(f"working on {file_path}")
+            try:
+                record_result(file_path, process_file(file_path, output_dir, trove_dict, backend, columns, output_format,
+                                                      schemas[file_path].usecols))
+            except Exception as e:
+                record_result(file_path, error=repr(e))
+    else:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+            _worker_trove_dict = trove_dict
+        else:
+            context = multiprocessing.get_context()
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                     initializer=_init_worker,
+                                     initargs=(json_file_path, {'backend': backend, 'columns': columns,
+                                                               'output_format': output_format}, loader)) as executor:
+                futures = {executor.submit(process_file, file_path, output_dir, usecols=schemas[file_path].usecols): file_path
+                           for file_path in to_process}
+                for future, file_path in futures.items():
+                    #print to console to show progress
+                    print(f"working on {file_path}")
+                    try:
+                        record_result(file_path, future.result())
+                    except Exception as e:
+                        record_result(file_path, error=repr(e))
+        finally:
+            _worker_trove_dict = None
+
+    print(f"Processed {len(summary['processed'])} files ({sum(summary['processed'].values())} rows, "
+          f"{sum(summary['parse_seconds'].values()):.2f}s parsing), "
+          f"skipped {len(summary['skipped'])}, failed {len(summary['failed'])}, "
+          f"unprocessable {len(summary['unprocessable'])}")
+    for file_path, error in summary['failed'].items():
+        print(f"  failed: {file_path}: {error}")
+    return summary
 
 def main():
-    json_file_path = '/Volumes/UNTITLED/remote_old_to_new_mappings.json'
-    input_dir = "INSERT FOLDER NAME HERE"
-    process_directory(input_dir, json_file_path)
-    
+    # The options are parsed by tbc.py, so that they are shared with 'tbc.py update-ids'
+    tbc.main(['update-ids'] + sys.argv[1:])
+
+
 if __name__ == "__main__":
     main()
@@ -7,15 +7,28 @@ an entry in the column called 'title_id':
 4. Checks if the article_id is in the dictionary. 
 If it is not in the dictionary, the row is written to a new CSV file with an updated filename that ends 'sheet_to_upload.csv'.
 If the article_id is in the dictionary, the row is written to a new CSV file with an updated filename that ends 'sheet_to_check.csv'.
-5. The new CSV files are saved in a folder called 'processed_files' in the same directory as the input folder.
+5. With --duplicate-check, checks if the article_id was already sent on for upload from an earlier sheet (or earlier
+row) of the run, using a run-wide index of article_ids. Later copies of an article are written to the
+'sheet_to_check.csv' file, with the sheet holding the first copy in a 'duplicate_of_sheet' column.
+6. The new CSV files are saved in a folder called 'processed_files' in the same directory as the input folder.
 """
 
 import os
 import pandas as pd
-import re
 import json
-import glob
 import datetime
+import sys
+
+from article_index import ArticleIdIndex
+import metrics
+import tbc
+from mappings_index import ArticleIdSet, ijson, load_mappings_index, stream_mappings
+from pipeline_state import PipelineState
+from result_sink import ResultSink
+from run_dataset import RunDataset, sheet_name
+from sheet_schema import report_unprocessable, resolve_columns, sniff_sheets
+from table_io import (compact_dtypes, format_of, iter_table, read_table, resolve_format, scan_csv_dtypes,
+                      table_files, table_path)
 
 def check_chapter_number(df):
     """
@@ -31,19 +44,20 @@ def check_chapter_number(df):
     """
 
     #check if chapter number column exists
-    found_column = False
-    for column in df.columns:
-        if re.search(r'chapter[_\s]number', column, re.IGNORECASE):
-            found_column = True
-            # change column name to 'chapter_number'
-            df.rename(columns={column: 'chapter_number'}, inplace=True)
-            #replace all nan values with empty string
-            df['chapter_number'] = df['chapter_number'].astype(str).replace('nan', '', regex=False)
-            #convert column to string
-            df['chapter_number'] = df['chapter_number'].astype(str)
-            break
-    if not found_column:
+    column = resolve_columns(df.columns).get('chapter_number')
+    if column is None:
         print("No 'chapter number' column found.")
+        return df
+    # change column name to 'chapter_number'
+    df.rename(columns={column: 'chapter_number'}, inplace=True)
+    if isinstance(df['chapter_number'].dtype, pd.StringDtype):
+        # Parquet/Arrow inputs already store the column as strings, only the missing values need filling
+        df['chapter_number'] = df['chapter_number'].fillna('')
+        return df
+    #replace all nan values with empty string
+    df['chapter_number'] = df['chapter_number'].astype(str).replace('nan', '', regex=False)
+    #convert column to string
+    df['chapter_number'] = df['chapter_number'].astype(str)
     return df
 
 def check_chapter_title(df):
@@ -60,17 +74,18 @@ def check_chapter_title(df):
     """
     
     #check if chapter title column exists
-    found_column = False
-    for column in df.columns:
-        if re.search(r'chapter[_\s]title', column, re.IGNORECASE):
-            found_column = True
-            # change column name to 'chapter_title'
-            df.rename(columns={column: 'chapter_title'}, inplace=True)
-         # Convert column to string and replace 'nan' with empty string
-            df['chapter_title'] = df['chapter_title'].astype(str).replace('nan', '', regex=False)
-            break
-    if not found_column:
+    column = resolve_columns(df.columns).get('chapter_title')
+    if column is None:
         print("No 'chapter title' column found.")
+        return df
+    # change column name to 'chapter_title'
+    df.rename(columns={column: 'chapter_title'}, inplace=True)
+    if isinstance(df['chapter_title'].dtype, pd.StringDtype):
+        # Parquet/Arrow inputs already store the column as strings, only the missing values need filling
+        df['chapter_title'] = df['chapter_title'].fillna('')
+        return df
+    # Convert column to string and replace 'nan' with empty string
+    df['chapter_title'] = df['chapter_title'].astype(str).replace('nan', '', regex=False)
     return df
 
 def load_article_dictionary(file_path: str) -> list:
@@ -88,75 +103,260 @@ def load_article_dictionary(file_path: str) -> list:
         article_ids = data.get("uploaded_chapters", [])
     return article_ids
 
-def process_directory(input_dir, json_file_path: str) -> None:
+def load_article_index(file_path: str) -> ArticleIdSet:
+    """
+    This function loads the array of article_ids of a mappings JSON file from its compiled binary index
+    (see mappings_index), compiling the index first if it is missing or out of date.
+    The article_ids are memory-mapped as a sorted array rather than built as a Python list.
+
+    Parameters:
+    file_path (str): The path to the JSON file.
+
+    Returns:
+    ArticleIdSet: The set of article_ids.
+    """
+    return load_mappings_index(file_path).uploaded_chapters
+
+def load_article_streaming(file_path: str) -> ArticleIdSet:
+    """
+    This function reads only the array of article_ids from a JSON file with an incremental parse, straight into a
+    compact set of ints, without loading the rest of the file. It is for when the mappings JSON has changed
+    and there is no time to compile its index first. Falls back to load_article_dictionary if ijson is not installed.
+
+    Parameters:
+    file_path (str): The path to the JSON file.
+
+    Returns:
+    ArticleIdSet: The set of article_ids.
+    """
+    if ijson is None:
+        print("ijson is not installed, loading the whole mappings JSON instead")
+        return set(load_article_dictionary(file_path))
+    return stream_mappings(file_path, trove=False)[1]
+
+# How each --loader value loads the article_ids (as a set, so that each lookup is a hash lookup)
+ARTICLE_LOADERS = {
+    'index': load_article_index,
+    'stream': load_article_streaming,
+    'json': lambda file_path: set(load_article_dictionary(file_path)),
+}
+
+def partition_rows(df, article_ids):
+    """
+    This function splits a DataFrame into the rows that need to be checked manually and the rows that can be uploaded.
+    A row needs to be checked if it has no 'title_id' or if its article_id is already in article_ids.
+    Rows are only partitioned on article_id if the DataFrame has an 'article_id' column; otherwise only the rows
+    without a 'title_id' are kept (to be checked) and the rest are dropped.
+
+    Parameters:
+    df (pandas.DataFrame): The DataFrame to partition. This DataFrame should have a 'title_id' column.
+    article_ids (set or ArticleIdSet): The set of article_ids that have already been uploaded.
+
+    Returns:
+    tuple: (to_check, to_upload) DataFrames, each keeping the original row order.
+    """
+    missing_title_id = df['title_id'].isna()
+    if 'article_id' in df.columns:
+        # article_ids are compared as strings, the same way they are stored in the mappings file
+        if isinstance(article_ids, ArticleIdSet):
+            uploaded = article_ids.isin_strings(df['article_id'])
+        else:
+            uploaded = df['article_id'].astype(str).isin(article_ids)
+        to_check = missing_title_id | uploaded
+        to_upload = ~to_check
+    else:
+        for index in df.index[~missing_title_id]:
+            print(f"No article_id found for row {index}")
+        to_check = missing_title_id
+        to_upload = pd.Series(False, index=df.index)
+    return df[to_check], df[to_upload]
+
+def route_duplicates(to_check, to_upload, article_index, sheet):
+    """
+    This function claims the article_ids of the rows to upload in the run-wide article_id index and moves the rows
+    whose article_id was already claimed (by an earlier sheet, or an earlier row of this sheet) to the rows to check,
+    with the sheet that holds the first copy in a 'duplicate_of_sheet' column.
+
+    Parameters:
+    to_check (pandas.DataFrame): The rows to check.
+    to_upload (pandas.DataFrame): The rows to upload.
+    article_index (ArticleIdIndex): The run-wide index of article_ids.
+    sheet (str): The name of the sheet the rows came from.
+
+    Returns:
+    tuple: (to_check, to_upload) DataFrames, each keeping the original row order.
+    """
+    if 'article_id' not in to_upload.columns:
+        return to_check, to_upload
+    origins = article_index.claim(to_upload['article_id'], sheet)
+    duplicate = origins.notna()
+    # The rows to check always get the column (empty when there are no duplicates), so the outputs of every sheet,
+    # and of every chunk of a sheet, have the same columns
+    to_check = to_check.assign(duplicate_of_sheet=None)
+    if not duplicate.any():
+        return to_check, to_upload
+    duplicates = to_upload[duplicate].assign(duplicate_of_sheet=origins[duplicate])
+    print(f"{int(duplicate.sum())} rows of {sheet} repeat an article_id already sent for upload")
+    return pd.concat([to_check, duplicates]).sort_index(kind='stable'), to_upload[~duplicate]
+
+def clean_and_partition(df, article_ids, article_index=None, sheet=None):
+    """
+    This function converts the 'chapter number' and 'chapter title' columns to strings and splits the rows
+    into those to check and those to upload (see partition_rows and route_duplicates).
+
+    Parameters:
+    df (pandas.DataFrame): A sheet with updated Trove IDs.
+    article_ids (set or ArticleIdSet): The set of article_ids that have already been uploaded.
+    article_index (ArticleIdIndex): The run-wide index of article_ids, or None to skip the duplicate check.
+    sheet (str): The name of the sheet, recorded in the index.
+
+    Returns:
+    tuple: (to_check, to_upload) DataFrames.
+    """
+    #call function to check chapter number
+    df = check_chapter_number(df)
+    #call function to check chapter title
+    df = check_chapter_title(df)
+    to_check, to_upload = partition_rows(df, article_ids)
+    if article_index is not None:
+        to_check, to_upload = route_duplicates(to_check, to_upload, article_index, sheet)
+    return to_check, to_upload
+
+def iter_partitions(file_path, article_ids, article_index=None, chunk_rows=None):
+    """
+    This function reads a sheet and splits its rows into those to check and those to upload (see clean_and_partition),
+    either all at once or chunk by chunk.
+    In chunks, only one chunk of the sheet is held in memory at a time, so memory stays flat however long the sheet is.
+    The chunks of a CSV file are read with the dtypes a whole-file read gives each column (found in a first pass,
+    see scan_csv_dtypes) in their compact form (see compact_dtypes), so the rows are written out exactly as the
+    whole-file read writes them.
+
+    Parameters:
+    file_path (str): The path to the sheet (a CSV, Parquet or Arrow file).
+    article_ids (set or ArticleIdSet): The set of article_ids that have already been uploaded.
+    article_index (ArticleIdIndex): The run-wide index of article_ids, or None to skip the duplicate check.
+    chunk_rows (int): The number of rows in each chunk. None reads the whole sheet at once.
+
+    Yields:
+    tuple: (the number of rows read, to_check, to_upload) for the sheet, or for each chunk of it.
+    """
+    if not chunk_rows:
+        df = read_table(file_path)
+        yield (len(df),) + clean_and_partition(df, article_ids, article_index, sheet_name(file_path))
+        return
+    csv_options = {}
+    if format_of(file_path) == 'csv':
+        csv_options['dtype'] = compact_dtypes(scan_csv_dtypes(file_path, chunk_rows))
+    for _, chunk in iter_table(file_path, chunk_rows, **csv_options):
+        yield (len(chunk),) + clean_and_partition(chunk, article_ids, article_index, sheet_name(file_path))
+
+# The file of the run-wide article_id index, in the output folder unless another path is given
+ARTICLE_INDEX_NAME = 'article_ids.sqlite'
+
+def process_directory(input_dir, json_file_path: str, loader='index', output_format='csv', dataset_dir=None,
+                      duplicate_check=False, article_index_path=None, chunk_rows=None) -> None:
     """
-    This function processes all the csv files in the given directory.
-    For each csv file, it reads the data, checks that the article_id is in the dictionary,
+    This function processes all the csv (or Parquet/Arrow) files in the given directory.
+    For each file, it reads the data, checks that the article_id is in the dictionary,
     if it is not in the dictionary, the row is written to a new CSV file with an updated filename that ends 'sheet_to_upload.csv'.
     If the article_id is in the dictionary, the row is written to a new CSV file with an updated filename that ends 'sheet_to_check.csv'.
     The new CSV files are saved in a folder called 'processed_files' in the same directory as the input folder.
+    Files that were already processed with the same content and mappings are skipped.
 
     Parameters:
     input_dir (str): The path to the directory containing the CSV files to process.
     json_file_path (str): The path to the JSON file containing the array of article_ids.
+    loader (str): How to load the article_ids: 'index' from the compiled mappings index (see mappings_index),
+    'stream' with an incremental parse of the JSON file, or 'json' with json.load.
+    output_format (str): The format to write the two outputs in: 'csv', 'parquet' or 'arrow' (see table_io).
+    dataset_dir (str): Add the rows to this run-wide dataset (see run_dataset), with the status 'to_check' or
+    'to_upload', instead of writing two files per sheet. A file is only marked as processed once its rows are committed.
+    duplicate_check (bool): Send the rows whose article_id was already sent for upload (see route_duplicates) to be checked.
+    Off by default; the rows to check then have a 'duplicate_of_sheet' column and the index is kept in the output folder.
+    article_index_path (str): The SQLite file of the article_id index. It defaults to 'article_ids.sqlite' in the
+    output folder, so it persists across runs; give the same path to share it between folders or processes.
+    A sheet that is processed again first gives up the article_ids it claimed before.
+    chunk_rows (int): Read, split and write each sheet this many rows at a time (see iter_partitions), to bound
+    memory on very long sheets. None processes each sheet whole. The outputs are the same either way.
+    The header row of every file is read first (see sheet_schema), and the files without a 'title_id' column are
+    reported together, in 'column_not_found.txt' in the output folder, and skipped.
 
     Returns:
     None
 
     """
-    article_ids = load_article_dictionary(json_file_path)
+    output_format = resolve_format(output_format)
+    with metrics.timer('mappings_load', stage='clean_and_check', loader=loader):
+        if loader == 'index':
+            mappings_index = load_mappings_index(json_file_path)
+            article_ids, mappings_version = mappings_index.uploaded_chapters, mappings_index.source_sha256
+        else:
+            article_ids, mappings_version = ARTICLE_LOADERS[loader](json_file_path), None
 
     # Create 'processed_files' folder in the same directory
     output_dir = os.path.join(input_dir, 'clean_and_check_processed_files')
     os.makedirs(output_dir, exist_ok=True)
+    state = PipelineState(output_dir, 'clean_and_check', json_file_path, mappings_version)
+    dataset = RunDataset(dataset_dir, output_format) if dataset_dir else None
+    # The files added to the dataset but not committed yet, by sheet name
+    pending = {}
+    article_index = None
+    if duplicate_check:
+        article_index = ArticleIdIndex(article_index_path or os.path.join(output_dir, ARTICLE_INDEX_NAME))
 
-    # Get list of all CSV files in the directory
-    file_list = glob.glob(os.path.join(input_dir, '*.csv'))
+    # Get list of all CSV (and Parquet/Arrow) files in the directory, skipping temporary files
+    file_list = [file_path for file_path in table_files(input_dir) if not os.path.basename(file_path).startswith('~$')]
+    # Read only the header row of each file first, and report the files that can't be processed all together
+    schemas = sniff_sheets(file_list, 'clean_and_check')
+    report_unprocessable(schemas, output_dir)
+    file_list = [file_path for file_path in file_list if schemas[file_path].processable]
     for file_path in file_list:
-        # Skip temporary files
-        if os.path.basename(file_path).startswith('~$'):
+        # Check if file has already been processed
+        if state.is_done(file_path):
+            print(f"{file_path} has already been processed, skipping...")
             continue
         #print to console to show progress
         print(f"working on {file_path}")
         # print timestamp to console to show progress
         print(datetime.datetime.now().strftime("%H:%M:%S"))
-        df = pd.read_csv(file_path)
-        #call function to check chapter number
-        df = check_chapter_number(df)
-        #call function to check chapter title
-        df = check_chapter_title(df)
-
-
-        #Check if article_id is in array article_ids, if not, write to sheet_to_upload.csv
-        for index, row in df.iterrows():
-            #check if value in title_id is a NaN value
-            if pd.isna(row['title_id']):
-                #write this row to '_sheet_to_check.csv'
-                output_file_name = os.path.basename(file_path).replace('.csv', '_sheet_to_check.csv')
-            elif 'article_id' in row:
-            # Convert the article_id to str, handling any conversion errors
-                try:
-                    article_id = str(row['article_id'])
-                    #article_id = int(row['article_id'])
-                    if article_id not in article_ids:
-                        output_file_name = os.path.basename(file_path).replace('.csv', '_sheet_to_upload.csv')
-                    else:
-                        output_file_name = os.path.basename(file_path).replace('.csv', '_sheet_to_check.csv')
-                except ValueError:
-                    print(f"Error converting article_id for row {index}: {row['article_id']}")
-                    continue # Skip this row if conversion fails
+        with metrics.timer('sheet', stage='clean_and_check', sheet=file_path) as timer:
+            #split the rows into those to check and those to upload, and write each set through a sink
+            #(no file is written for a sheet that has no rows of a kind, and one left by an earlier run is removed)
+            if article_index is not None:
+                article_index.forget(sheet_name(file_path))
+            parts = iter_partitions(file_path, article_ids, article_index, chunk_rows)
+            rows = 0
+            if dataset is not None:
+                for part_rows, to_check, to_upload in parts:
+                    dataset.add(to_check, sheet_name(file_path), 'to_check')
+                    dataset.add(to_upload, sheet_name(file_path), 'to_upload')
+                    rows += part_rows
             else:
-                print(f"No article_id found for row {index}")
-                continue # Skip this row if no article_id found
-
-            output_file_path = os.path.join(output_dir, output_file_name)
-            row.to_frame().T.to_csv(output_file_path, index=False, mode='a', header=not os.path.exists(output_file_path))
-            
+                base_name = os.path.splitext(os.path.basename(file_path))[0]
+                output_file_paths = {name: table_path(os.path.join(output_dir, base_name + suffix), output_format)
+                                     for name, suffix in [('to_check', '_sheet_to_check'), ('to_upload', '_sheet_to_upload')]}
+                with ResultSink(output_file_paths, output_format) as sink:
+                    for part_rows, to_check, to_upload in parts:
+                        sink.add('to_check', to_check)
+                        sink.add('to_upload', to_upload)
+                        rows += part_rows
+            timer.rows = rows
+        if dataset is not None:
+            pending[sheet_name(file_path)] = (file_path, rows)
+            for name in dataset.commit_if_full():
+                state.mark_done(*pending.pop(name))
+            continue
+        state.mark_done(file_path, rows, sink.written_paths())
+    if dataset is not None:
+        for name in dataset.commit():
+            state.mark_done(*pending.pop(name))
+    if article_index is not None:
+        article_index.close()
 
 def main():
-    json_file_path = '/Volumes/UNTITLED/remote_old_to_new_mappings.json'
-    input_dir = "INSERT FOLDER NAME HERE"
-    process_directory(input_dir, json_file_path)
-   
+    # The options are parsed by tbc.py, so that they are shared with 'tbc.py clean-check'
+    tbc.main(['clean-check'] + sys.argv[1:])
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -2,41 +2,38 @@
 # Functionality to check the title_id and title string of a record
 # against the readallaboutit.com.au database (api).
 
-import requests
-import json
-from thefuzz import fuzz
-import csv
 import pandas as pd
 import datetime
 import os
-import glob
+import sys
+import time
+
+import metrics
+import tbc
+from pipeline_state import PipelineState, atomic_write, truncate_outputs
+from result_sink import ResultSink
+from run_dataset import RunDataset, sheet_name
+from sheet_schema import report_unprocessable, resolve_columns, sniff_sheets
+from table_io import format_of, iter_table, resolve_format, table_files, table_path, write_table
+from title_api import TitleLookup
+from title_index import TitleIndex
+from title_match import batch_fuzzy_check, candidate_pairs, record_triples
+
+# Shared lookup engine, so every call reuses the same pooled session
+lookup = TitleLookup()
+
 
 def build_url(title_id: int) -> str:
     """Builds the url to query the api with, given a title_id."""
-    return f"https://readallaboutit.com.au/api/v1/title/{title_id}"
+    return lookup.build_url(title_id)
 
 
 def get_title(title_id: int) -> dict:
     """Get a title record from the readallaboutit api given a title_id."""
-    url = build_url(title_id)
-    retries = 3  # Number of times to retry the request
-
-    for attempt in range(retries):
-        try:
-            response = requests.get(url)
-            response.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
-            print(f"Successfully fetched title_id {title_id}.")
-            # print timestamp to console to show progress
-            print(datetime.datetime.now().strftime("%H:%M:%S"))
-            return json.loads(response.text)
-        except requests.ConnectionError as e:
-            print(f"Connection error when fetching title_id {title_id}: {e}. Retrying...")
-            if attempt == retries - 1:
-                print(f"Failed to fetch title_id {title_id} after {retries} retries. Response Code: {e}")
-                return None
-        except requests.HTTPError as e:
-            print(f"Failed to fetch title_id {title_id}. Response Code: {e.response.status_code}")
-            return None
+    title_record = lookup.get_title(title_id)
+    # print timestamp to console to show progress
+    print(datetime.datetime.now().strftime("%H:%M:%S"))
+    return title_record
 
 def check_title_id_string_pair(title_id: int, title: str) -> bool:
     """
@@ -56,59 +53,115 @@ def check_title_id_string_pair(title_id: int, title: str) -> bool:
 
 
 def fuzzy_check_title_id_string_pair(title_id: int, title: str, tolerance=75) -> bool:
-
-    
+    """
+    Request a title record for a given title_id and check that the given title
+    string is a fuzzy match for the 'publication_title' or 'common_title'.
+    """
     title_record = get_title(title_id)
+    return fuzzy_check_title_record(title_record, title_id, title, tolerance)
+
+
+def fuzzy_check_title_record(title_record: dict, title_id: int, title: str, tolerance=75) -> bool:
+    """
+    Check that the given title string is a fuzzy match for the 'publication_title' or 'common_title'
+    of an already fetched title record. Both titles are truncated to the length of the shorter string first.
+    """
+    # Only the per-pair checks use thefuzz, the stage itself scores whole batches with title_match
+    from thefuzz import fuzz
+
     if title_record:
         print(f"Checking title_id {title_id} with title: {title}")
-        title = title.lower()  # Convert to lowercase
-        title_len = len(title) # Get length of title
-        pub_title_len = len(title_record['publication_title'])
-        com_title_len = len(title_record['common_title'])
-
         # Compare the title with publication_title and common_title based on the length
-        if title_len < pub_title_len:
-            if fuzz.ratio(title_record['publication_title'][:title_len].lower(), title) >= tolerance:
+        for record_title, sheet_title in candidate_pairs(title, title_record['publication_title'], title_record['common_title']):
+            if fuzz.ratio(record_title, sheet_title) >= tolerance:
                 return True
-            elif fuzz.ratio(title_record['common_title'][:title_len].lower(), title) >= tolerance: #I need to change this so it checks the whole name...
-                return True
-        elif title_len > pub_title_len:
-            if fuzz.ratio(title_record['publication_title'].lower(), title[:pub_title_len]) >= tolerance:
-                return True
-            elif fuzz.ratio(title_record['common_title'].lower(), title[:com_title_len]) >= tolerance:
-                return True
-        elif title_len == pub_title_len:
-            if fuzz.ratio(title_record['publication_title'].lower(), title) >= tolerance:
-                return True
-            elif fuzz.ratio(title_record['common_title'].lower(), title) >= tolerance:
-                return True
-        else:
-            print(f"Title record not found for title_id {title_id}.")
-        return False
-            
     return False
 
-def process_directory(input_dir: str) -> None:
+def find_title_header(fieldnames) -> str:
+    """Returns the name of the 'trove title' column among fieldnames, or None if there is none (see sheet_schema)."""
+    return resolve_columns(fieldnames).get('trove_title')
+
+
+def check_titles(title_ids, titles, title_lookup: TitleLookup = None) -> list:
+    """
+    Fetch the title records for a batch of rows and fuzzy match each row's title against its record.
+    Returns True (safe to upload) or False for each row, in order.
+    """
+    title_lookup = title_lookup or lookup
+    title_records = title_lookup.get_titles(title_ids)
+    return batch_fuzzy_check(record_triples(titles, title_records))
+
+
+def add_suggestions(rows: pd.DataFrame, title_header: str, title_index: TitleIndex) -> pd.DataFrame:
+    """
+    Returns a copy of rows (that failed the check) with a 'suggested_title_id' column: the title_id whose record
+    best matches each row's title in the offline title index, or empty if none matches well enough.
+    """
+    rows = rows.copy()
+    rows['suggested_title_id'] = pd.array(title_index.suggest_many(rows[title_header].fillna('').tolist()),
+                                          dtype='Int64')
+    return rows
+
+
+def iter_rows(file_path: str, batch_size: int, skip_rows=0):
+    """
+    Reads a sheet to check batch_size rows at a time, yielding (position of the batch's first row, rows).
+    A CSV file is read with every value as a string, exactly as written (empty cells stay empty strings);
+    a Parquet/Arrow file is read with the types it was written with.
+    """
+    csv_options = {'dtype': str, 'keep_default_na': False} if format_of(file_path) == 'csv' else {}
+    yield from iter_table(file_path, batch_size, skip_rows=skip_rows, **csv_options)
+
+
+def read_title_ids(title_ids: pd.Series) -> list:
+    """Returns a batch's title_ids as ints. Typed (Parquet/Arrow) inputs already hold them as ints."""
+    if pd.api.types.is_integer_dtype(title_ids.dtype):
+        return title_ids.astype('int64').tolist()
+    return [int(float(title_id)) for title_id in title_ids]  # Convert to float first, then to int
+
+
+def process_directory(input_dir: str, title_lookup: TitleLookup = None, batch_size=200, output_format='csv',
+                      dataset_dir=None, title_index: TitleIndex = None) -> None:
     """
     This function processes all the filesin a given directory and writes the 
-    results to a directory titled 'processed_API'
+    results to a directory titled 'processed_API'.
+    The rows of each sheet are read and processed in batches of batch_size: the title records for a batch are fetched
+    concurrently through title_lookup (the shared lookup engine by default), the rows are checked, and the batch is
+    routed to the safe / not safe outputs through a ResultSink, appended to the output files and committed to the
+    manifest. The titles of a batch are fuzzy matched together
+    (see title_match.batch_fuzzy_check). Sheets that were already processed are skipped,
+    and a sheet that was partly processed resumes after its last committed batch.
+    The inputs may be CSV, Parquet or Arrow files (see table_io). Parquet and Arrow outputs cannot be appended to,
+    so with those output formats each sheet's outputs are written in chunks to temporary files that are moved into
+    place once the whole sheet is checked, and a sheet that was interrupted starts over.
+    With dataset_dir, the rows are added to that run-wide dataset (see run_dataset) with the status 'safe' or
+    'not_safe' instead, keeping the 'row_index' column of the input if it has one, and a sheet is only marked as
+    processed once its rows are committed.
+    With title_index (see title_index.TitleIndex), the not safe rows get a 'suggested_title_id' column, and the
+    rows are checked against the index's records instead of the api unless a title_lookup is given too.
+    The header row of every file is read first (see sheet_schema), and the files without a 'trove title' or 'title_id'
+    column are reported together, in 'column_not_found.txt' in the output folder, and skipped.
     """
+    title_lookup = title_lookup or title_index or lookup
+    output_format = resolve_format(output_format)
 
     # Create 'processed_files' folder in the same directory
     output_dir = os.path.join(input_dir, '3_processed_files')
     os.makedirs(output_dir, exist_ok=True)
-
-    # Get list of all CSV files in the directory
-    file_list = glob.glob(os.path.join(input_dir, '*.csv'))
+    state = PipelineState(output_dir, 'check_title_id')
+    dataset = RunDataset(dataset_dir, output_format) if dataset_dir else None
+    # The files added to the dataset but not committed yet, by sheet name
+    pending = {}
+
+    # Get list of all CSV (and Parquet/Arrow) files in the directory, skipping temporary files
+    file_list = [file_path for file_path in table_files(input_dir) if not os.path.basename(file_path).startswith('~$')]
+    # Read only the header row of each file first, and report the files that can't be processed all together
+    schemas = sniff_sheets(file_list, 'check_title_id')
+    report_unprocessable(schemas, output_dir)
+    file_list = [file_path for file_path in file_list if schemas[file_path].processable]
     for file_path in file_list:
-        # Skip temporary files
-        if os.path.basename(file_path).startswith('~$'):
-            continue
-
         # Check if this file has already been processed
-        base_name = os.path.splitext(os.path.basename(file_path))[0]
-        if os.path.exists(os.path.join(output_dir, f'{base_name}_safe_upload.csv')) and \
-           os.path.exists(os.path.join(output_dir, f'{base_name}_not_safe_upload.csv')):
+        if state.is_done(file_path):
             print(f"{file_path} has already been processed, skipping...")
             continue
 
@@ -116,44 +169,84 @@ def process_directory(input_dir: str) -> None:
         print(f"working on {file_path}")
         # Print timestamp to console to show progress
         print(datetime.datetime.now().strftime("%H:%M:%S"))
-        #df = pd.read_csv(file_path)
-
-        # Create empty data frames for safe and not safe uploads
-        safe_upload = pd.DataFrame()
-        not_safe_upload = pd.DataFrame()
-
-        with open(file_path, 'r') as infile:
-            reader = csv.DictReader(infile)
-
-            #determine the correct header for 'trove title'
-            title_header = None
-            for possible_title_header in ['Trove Title', 'trove title', 'Trove_Title', 'trove_title']:
-                if possible_title_header in reader.fieldnames:
-                    title_header = possible_title_header
-                    break
-
-            if title_header is None:
-                print(f"Could not find title header in {file_path}")
-                continue
-
-            for row in reader:
-                title_id = int(float(row['title_id']))  # Convert to float first, then to int
-                title = row[title_header]
-                if fuzzy_check_title_id_string_pair(title_id, title):
-                    safe_upload = safe_upload.append(row, ignore_index=True)
+        sheet_start = time.perf_counter()
+        #the correct header for 'trove title', found when the header was read
+        columns = schemas[file_path].header
+        title_header = schemas[file_path].columns['trove_title']
+
+        if dataset is not None:
+            rows = 0
+            for start, batch in iter_rows(file_path, batch_size):
+                matches = pd.Series(check_titles(read_title_ids(batch['title_id']),
+                                                 batch[title_header].fillna('').tolist(), title_lookup),
+                                    index=batch.index, dtype=bool)
+                if 'row_index' in batch.columns:
+                    batch = batch.set_index(batch.pop('row_index').astype('int64').to_numpy())
                 else:
-                    not_safe_upload = not_safe_upload.append(row, ignore_index=True)
+                    batch = batch.set_index(pd.RangeIndex(start, start + len(batch)))
+                matches.index = batch.index
+                dataset.add(batch[matches], sheet_name(file_path), 'safe')
+                not_safe = batch[~matches]
+                if title_index is not None:
+                    not_safe = add_suggestions(not_safe, title_header, title_index)
+                dataset.add(not_safe, sheet_name(file_path), 'not_safe')
+                rows = start + len(batch)
+            pending[sheet_name(file_path)] = (file_path, rows)
+            metrics.observe('sheet', time.perf_counter() - sheet_start, rows, stage='check_title_id', sheet=file_path)
+            for name in dataset.commit_if_full():
+                state.mark_done(*pending.pop(name))
+            continue
 
         # Create unique names for the output files based on the original file name
         base_name = os.path.splitext(os.path.basename(file_path))[0]
-        safe_upload.to_csv(os.path.join(output_dir, f'{base_name}_safe_upload.csv'), index=False)
-        not_safe_upload.to_csv(os.path.join(output_dir, f'{base_name}_not_safe_upload.csv'), index=False)
+        safe_path = table_path(os.path.join(output_dir, f'{base_name}_safe_upload'), output_format)
+        not_safe_path = table_path(os.path.join(output_dir, f'{base_name}_not_safe_upload'), output_format)
+
+        # Resume after the last committed batch, dropping anything written after it
+        rows_done, output_sizes = state.progress(file_path) if output_format == 'csv' else (0, {})
+        truncate_outputs([safe_path, not_safe_path], output_sizes)
+        if rows_done:
+            print(f"resuming {file_path} at row {rows_done}")
+
+        # Only one batch of the sheet is held in memory at a time, and each output is written in chunks
+        with ResultSink({'safe': safe_path, 'not_safe': not_safe_path}, output_format,
+                        append=output_format == 'csv') as sink:
+            for start, batch in iter_rows(file_path, batch_size, rows_done):
+                # Fetch the title records for every row of the batch at once, then check them all together
+                matches = check_titles(read_title_ids(batch['title_id']), batch[title_header].fillna('').tolist(),
+                                       title_lookup)
+                if title_index is None:
+                    sink.route(batch, matches, 'safe', 'not_safe')
+                else:
+                    matches = pd.Series(matches, index=batch.index, dtype=bool)
+                    sink.add('safe', batch[matches])
+                    sink.add('not_safe', add_suggestions(batch[~matches], title_header, title_index))
+                rows_done = start + len(batch)
+                if output_format == 'csv':
+                    # Write and commit every batch, so an interrupted sheet resumes after it
+                    sink.flush()
+                    state.commit_batch(file_path, rows_done, [safe_path, not_safe_path])
+
+        # Sheets with no safe (or no not safe) rows still get an (empty) output file
+        for output_path in [safe_path, not_safe_path]:
+            if os.path.exists(output_path):
+                continue
+            if output_format == 'csv':
+                pd.DataFrame().to_csv(output_path, index=False)
+            else:
+                with atomic_write(output_path) as temp_path:
+                    write_table(pd.DataFrame(columns=columns), temp_path, output_format)
+        state.mark_done(file_path, rows_done, [safe_path, not_safe_path])
+        metrics.observe('sheet', time.perf_counter() - sheet_start, rows_done, stage='check_title_id', sheet=file_path)
+    if dataset is not None:
+        for name in dataset.commit():
+            state.mark_done(*pending.pop(name))
 
    
 def main():
-    input_dir = 'FOLDER NAME HERE'
-    process_directory(input_dir)
+    # The options are parsed by tbc.py, so that they are shared with 'tbc.py verify-titles'
+    tbc.main(['verify-titles'] + sys.argv[1:])
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# A run-wide index of the article_ids sent on for upload, so that an article transcribed in more than one sheet is
+# caught in stage 2 (its later copies are sent to be checked) rather than at ingest.
+
+import sqlite3
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+# The number of article_ids remembered in memory before the in-memory set is dropped (the SQLite table keeps them all)
+DEFAULT_MEMORY_IDS = 500000
+
+# SQLite limits the number of parameters in a single statement
+_MAX_PARAMS = 500
+
+
+def article_keys(values: pd.Series) -> list:
+    """
+    Returns the key each article_id is indexed under: the canonical string of a whole number (so 123, '123' and
+    123.0 are the same article), otherwise the stripped string. Missing article_ids have no key (None).
+    """
+    strings = values.astype(str).str.strip()
+    numbers = pd.to_numeric(strings, errors='coerce')
+    whole = (numbers.notna() & (numbers % 1 == 0) & (numbers.abs() < 2 ** 63)).to_numpy()
+    keys = strings.to_numpy(dtype=object)
+    keys[whole] = numbers.to_numpy()[whole].astype(np.int64).astype(str)
+    missing = values.isna().to_numpy() | np.isin(keys, ['', 'nan', '<NA>', 'None'])
+    keys[missing] = None
+    return keys.tolist()
+
+
+class ArticleIdIndex:
+    """
+    The article_ids claimed so far, each with the sheet it was first seen in, stored in a SQLite table.
+
+    claim() registers a sheet's article_ids and returns, for each, the sheet that already holds it (or None for the
+    first occurrence). Every claim is written through to the table in one transaction, so several processes can share
+    an index file and it persists across runs. Claimed article_ids are also remembered in an in-memory dict, so that
+    repeated article_ids are answered without a query. The dict is cleared once it holds max_memory_ids ids, which
+    bounds memory at millions of ids; ids that are not in memory are looked up in the table (by primary key) in
+    batches, once per sheet.
+
+    Parameters:
+    path (str): The path to the SQLite file. None keeps the index in a temporary file for this run only.
+    max_memory_ids (int): The most article_ids remembered in memory.
+    """
+
+    def __init__(self, path=None, max_memory_ids=DEFAULT_MEMORY_IDS):
+        self._temp_dir = None
+        if path is None:
+            self._temp_dir = tempfile.TemporaryDirectory()
+            path = f'{self._temp_dir.name}/article_ids.sqlite'
+        self.path = path
+        self.max_memory_ids = max_memory_ids
+        self._memory = {}
+        # The pipeline claims from its stage thread, so one connection is shared behind a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS article_ids (article_id TEXT PRIMARY KEY, sheet TEXT NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS article_ids_sheet ON article_ids (sheet)')
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM article_ids').fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+        if self._temp_dir is not None:
+            self._temp_dir.cleanup()
+
+    def _owners(self, keys: list) -> dict:
+        """Returns the sheet holding each of keys that is in the table."""
+        found = {}
+        for start in range(0, len(keys), _MAX_PARAMS):
+            chunk = keys[start:start + _MAX_PARAMS]
+            placeholders = ','.join('?' * len(chunk))
+            found.update(self._conn.execute(
+                f'SELECT article_id, sheet FROM article_ids WHERE article_id IN ({placeholders})', chunk).fetchall())
+        return found
+
+    def claim(self, article_ids: pd.Series, sheet: str) -> pd.Series:
+        """
+        This function registers the article_ids of a sheet, in order.
+
+        Parameters:
+        article_ids (pandas.Series): The article_ids of the sheet's rows.
+        sheet (str): The name of the sheet.
+
+        Returns:
+        pandas.Series: For each row (with the same index), the sheet that already held its article_id, which is this
+        sheet for a repeat within it, or None if the row is the first occurrence (or has no article_id).
+        """
+        keys = article_keys(article_ids)
+        origins = [None] * len(keys)
+        with self._lock:
+            with self._conn:
+                # An immediate transaction, so no other process can claim the same ids in between
+                self._conn.execute('BEGIN IMMEDIATE')
+                unknown = list({key for key in keys if key is not None and key not in self._memory})
+                owners = self._owners(unknown)
+                claimed = []
+                for position, key in enumerate(keys):
+                    if key is None:
+                        continue
+                    owner = self._memory.get(key) or owners.get(key)
+                    if owner is None:
+                        owners[key] = sheet
+                        claimed.append((key, sheet))
+                    else:
+                        origins[position] = owner
+                self._conn.executemany('INSERT OR IGNORE INTO article_ids VALUES (?, ?)', claimed)
+            if len(self._memory) + len(owners) > self.max_memory_ids:
+                self._memory.clear()
+            self._memory.update(owners)
+        return pd.Series(origins, index=article_ids.index, dtype=object)
+
+    def forget(self, sheet: str) -> None:
+        """Removes the article_ids claimed by a sheet, so that processing the sheet again does not flag its own rows."""
+        with self._lock:
+            with self._conn:
+                self._conn.execute('DELETE FROM article_ids WHERE sheet = ?', (sheet,))
+            self._memory = {key: owner for key, owner in self._memory.items() if owner != sheet}
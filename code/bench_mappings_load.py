@@ -0,0 +1,115 @@
+"""
+This program compares the ways of loading remote_old_to_new_mappings.json on a synthetic mappings file:
+- 'json': json.load of the whole file (load_trove_dictionary / load_article_dictionary).
+- 'stream': the incremental ijson parse of only the 'trove' and 'uploaded_chapters' sections (mappings_index.stream_mappings).
+- 'index': memory-mapping the compiled binary index (mappings_index.load_mappings_index), after compiling it.
+Each loader runs in a fresh process so that its peak RSS can be measured on its own.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def write_synthetic_mappings(file_path: str, trove_entries: int, uploaded_chapters: int, other_entries: int, seed=0) -> None:
+    """
+    This function writes a synthetic mappings JSON file shaped like remote_old_to_new_mappings.json: a 'trove' object
+    of old Trove ID (string) -> new title_id (int), an 'uploaded_chapters' array of article_id strings, and an
+    'other' object standing in for the sections the pipeline never reads. It is written incrementally.
+    """
+    rng = random.Random(seed)
+    with open(file_path, 'w') as f:
+        f.write('{"trove": {')
+        for i in range(trove_entries):
+            f.write(f'{"," if i else ""}"{1000000 + i * 7}": {rng.randint(1, 50000)}')
+        f.write('}, "uploaded_chapters": [')
+        for i in range(uploaded_chapters):
+            f.write(f'{"," if i else ""}"{rng.randint(1, 250000000)}"')
+        f.write('], "other": {')
+        for i in range(other_entries):
+            f.write(f'{"," if i else ""}"{i}": {{"id": {i}, "name": "entry {i}"}}')
+        f.write('}}')
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_loader(loader: str, json_file_path: str) -> dict:
+    """This function loads the mappings with the given loader in this process and returns its load time and peak RSS."""
+    import numpy  # noqa: F401 -- imported up front so every loader is measured against the same baseline
+    import mappings_index
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    if loader == 'json':
+        with open(json_file_path, 'r') as json_file:
+            data = json.load(json_file)
+        trove, uploaded = data.get('trove', {}), data.get('uploaded_chapters', [])
+    elif loader == 'stream':
+        trove, uploaded, _ = mappings_index.stream_mappings(json_file_path)
+    else:
+        index = mappings_index.load_mappings_index(json_file_path)
+        trove, uploaded = index.trove, index.uploaded_chapters
+        # Touch every page, as a full run of the stages would
+        int(trove.old_ids.sum() + trove.new_ids.sum() + uploaded.article_ids.sum())
+    seconds = time.perf_counter() - start
+    return {'loader': loader, 'seconds': seconds, 'peak_rss_mb': _peak_rss_mb(), 'baseline_rss_mb': baseline,
+            'trove_entries': len(trove), 'uploaded_chapters': len(uploaded)}
+
+
+def measure(loader: str, json_file_path: str) -> dict:
+    """This function runs a loader in a fresh Python process and returns its measurements."""
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', loader, json_file_path],
+                            check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare peak RSS and load time of the mappings JSON loaders.')
+    parser.add_argument('--trove-entries', type=int, default=3000000)
+    parser.add_argument('--uploaded-chapters', type=int, default=1000000)
+    parser.add_argument('--other-entries', type=int, default=500000)
+    parser.add_argument('--json-file', help='an existing mappings file to load instead of a synthetic one')
+    parser.add_argument('--child', nargs=2, metavar=('LOADER', 'JSON_FILE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_loader(*args.child)))
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        json_file_path = args.json_file
+        if json_file_path is None:
+            json_file_path = os.path.join(temp_dir, 'remote_old_to_new_mappings.json')
+            print(f"writing synthetic mappings ({args.trove_entries} trove entries, "
+                  f"{args.uploaded_chapters} uploaded chapters, {args.other_entries} other entries)")
+            write_synthetic_mappings(json_file_path, args.trove_entries, args.uploaded_chapters, args.other_entries)
+        print(f"mappings file: {os.path.getsize(json_file_path) / (1024 * 1024):.1f} MB")
+
+        import mappings_index
+        index_dir = mappings_index.default_index_dir(json_file_path)
+        if args.json_file is not None and os.path.exists(index_dir):
+            print(f"using existing index {index_dir}")
+        else:
+            start = time.perf_counter()
+            mappings_index.compile_mappings_index(json_file_path)
+            print(f"compiled index in {time.perf_counter() - start:.2f}s")
+
+        print(f"{'loader':<8} {'load time (s)':>14} {'peak RSS (MB)':>14} {'over baseline (MB)':>19}")
+        for loader in ['json', 'stream', 'index']:
+            result = measure(loader, json_file_path)
+            print(f"{loader:<8} {result['seconds']:>14.2f} {result['peak_rss_mb']:>14.1f} "
+                  f"{result['peak_rss_mb'] - result['baseline_rss_mb']:>19.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,461 @@
+"""
+This program benchmarks stages 1 to 3 and clean_titles on a synthetic TBC corpus, so they can be measured without
+the Cloudstor sheets or the real mappings file:
+- write_synthetic_corpus writes Excel sheets shaped like the TBC sheets ('Trove ID' column variants, chapter number /
+  title, 'article_id', 'Trove Title' with noise, and 'title' headlines such as 'CHAPTER IV. (Continued.)'), the title
+  records of a stub title api, and a mappings JSON file that maps the Trove IDs to those records.
+- Each stage is timed at several scales (10k, 100k and 1M rows by default), each run in a fresh Python process so
+  that its peak RSS can be measured on its own. Stage 3 queries a local stub of the title api (see stub_title_api)
+  with a configurable latency.
+- The results are written to a JSON file named after the current git commit (in 'bench_results' next to this
+  script unless --results-dir is given), and --compare prints the change in throughput and peak memory between two
+  such files, e.g. before and after a change.
+
+The corpus is written once for the largest scale (and reused by later runs with the same options); each smaller
+scale uses the first of its sheets.
+"""
+
+import argparse
+import csv
+import datetime
+import glob
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_mappings_load import _peak_rss_mb
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The results are kept next to this script, wherever it is run from
+DEFAULT_RESULTS_DIR = os.path.join(CODE_DIR, 'bench_results')
+
+STAGES = ['update_trove_id', 'clean_and_check', 'check_title_id', 'clean_titles', 'pipeline']
+
+DEFAULT_STAGES = ['update_trove_id', 'clean_and_check', 'check_title_id', 'clean_titles']
+
+DEFAULT_SCALES = [10000, 100000, 1000000]
+
+CORPUS_MANIFEST = 'corpus.json'
+
+# The name variants of the columns seen across the TBC sheets (each sheet uses one of each)
+TROVE_ID_HEADERS = ['Trove ID', 'Trove_ID', 'trove id', 'TROVE ID']
+CHAPTER_NUMBER_HEADERS = ['chapter_number', 'chapter number', 'Chapter Number']
+CHAPTER_TITLE_HEADERS = ['chapter_title', 'chapter title', 'Chapter Title']
+TITLE_HEADERS = ['Trove Title', 'trove title', 'Trove_Title', 'trove_title']
+OTHER_HEADERS = ['Date', 'Newspaper', 'Author', 'Word Count', 'Notes', 'Checked By']
+
+WORDS = ['the', 'mystery', 'of', 'grange', 'lady', 'secret', 'heir', 'shadow', 'wreck', 'bushranger', 'gold',
+         'river', 'station', 'squatter', 'convict', 'daughter', 'fortune', 'storm', 'lost', 'diamond', 'curse',
+         'hollow', 'crime', 'love', 'vengeance', 'midnight', 'stranger', 'valley', 'captain', 'bride', 'will']
+NEWSPAPERS = ['The Argus', 'The Queenslander', 'Sydney Mail', 'The Australasian', 'Adelaide Observer']
+ROMAN_NUMERALS = ['I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X', 'XI', 'XII', 'XIII', 'XIV', 'XV',
+                  'XVI', 'XVII', 'XVIII', 'XIX', 'XX', 'XXI', 'XXII', 'XXIII', 'XXIV', 'XXV', 'XXX', 'XL']
+CONTINUED_VARIANTS = ['(Continued.)', '(Continued)', '(CONTINUED.)', '(Contiuned.)', '(Contined)', 'continued']
+
+
+def _title_text(rng: random.Random) -> str:
+    words = rng.sample(WORDS, rng.randint(2, 5))
+    return ' '.join(words).title()
+
+
+def _noisy_title(title: str, rng: random.Random) -> str:
+    """Returns a title as it might have been typed into a sheet: with a typo, changed case or punctuation."""
+    noise = rng.random()
+    if noise < 0.3:
+        position = rng.randrange(len(title))
+        return title[:position] + title[position + 1:]
+    if noise < 0.5:
+        return title.upper()
+    if noise < 0.7:
+        return title.lower() + '.'
+    if noise < 0.85:
+        return title + ' (Continued)'
+    return '  ' + title.replace(' ', ', ', 1) + ' '
+
+
+def _headline(chapter: str, chapter_title: str, rng: random.Random) -> str:
+    """Returns a chapter headline like those in the 'title' column that clean_titles parses."""
+    style = rng.random()
+    if style < 0.35:
+        return f"CHAPTER {chapter}. {rng.choice(CONTINUED_VARIANTS)}"
+    if style < 0.7:
+        return f"CHAPTER {chapter}.—{chapter_title.upper()}."
+    if style < 0.85:
+        return f"{chapter}. {chapter_title} ({rng.choice(CONTINUED_VARIANTS)})"
+    return f"{chapter_title.upper()}. (.)"
+
+
+def write_title_records(title_count: int, seed=0) -> dict:
+    """
+    This function returns synthetic title records keyed by title_id, as served by the stub title api.
+    Some records have a common_title that differs from their publication_title.
+    """
+    rng = random.Random(seed)
+    records = {}
+    for i in range(title_count):
+        title_id = 100000 + i
+        publication_title = _title_text(rng)
+        common_title = publication_title if rng.random() < 0.7 else _title_text(rng)
+        records[title_id] = {'id': title_id, 'publication_title': publication_title, 'common_title': common_title}
+    return records
+
+
+def write_synthetic_mappings(file_path: str, old_trove_ids: dict, uploaded_chapters: list, extra_entries: int,
+                             seed=0) -> None:
+    """
+    This function writes a mappings JSON file shaped like remote_old_to_new_mappings.json: the 'trove' object maps the
+    given old Trove IDs (and extra_entries more that no sheet uses) to title_ids, and 'uploaded_chapters' holds the given
+    article_ids (and extra_entries more). It is written incrementally.
+    """
+    rng = random.Random(seed)
+    with open(file_path, 'w') as f:
+        f.write('{"trove": {')
+        entries = [f'"{old_id}": {title_id}' for old_id, title_id in old_trove_ids.items()]
+        f.write(', '.join(entries))
+        for i in range(extra_entries):
+            f.write(f', "{90000000 + i}": {rng.randint(1, 50000)}')
+        f.write('}, "uploaded_chapters": [')
+        f.write(', '.join(f'"{article_id}"' for article_id in uploaded_chapters))
+        for i in range(extra_entries):
+            f.write(f'{", " if uploaded_chapters or i else ""}"{rng.randint(900000000, 999999999)}"')
+        f.write(']}')
+
+
+def write_synthetic_corpus(corpus_dir: str, rows: int, rows_per_sheet=5000, title_count=2000, mappings_entries=100000,
+                           seed=0) -> dict:
+    """
+    This function writes a synthetic TBC corpus to corpus_dir:
+    - 'sheets/sheet_NNNNN.xlsx': the sheets, rows_per_sheet rows each. About 5% of the Trove IDs are missing, 3% are
+      not in the mappings and 2% are junk; about 5% of the titles don't match their record; about 3% of the article_ids
+      are already uploaded and 0.5% repeat an article_id of an earlier sheet.
+    - 'title_records.json': the title records for the stub title api.
+    - 'mappings.json': the mappings, with mappings_entries unused entries on top of those the sheets need.
+    - 'titles.csv': the 'title' column of every sheet, in order, for timing clean_titles on its own.
+    - 'corpus.json': the options the corpus was written with, so it can be reused.
+
+    Returns:
+    dict: The contents of corpus.json.
+    """
+    from openpyxl import Workbook
+
+    rng = random.Random(seed)
+    records = write_title_records(title_count, seed)
+    title_ids = list(records)
+    # Each title has one or two old Trove IDs
+    old_trove_ids = {}
+    for title_id in title_ids:
+        for _ in range(rng.choice([1, 1, 2])):
+            old_trove_ids[1000000 + len(old_trove_ids) * 7] = title_id
+    old_ids = list(old_trove_ids)
+
+    sheets_dir = os.path.join(corpus_dir, 'sheets')
+    os.makedirs(sheets_dir, exist_ok=True)
+    uploaded_chapters = []
+    used_article_ids = []
+    sheet_count = math.ceil(rows / rows_per_sheet)
+    with open(os.path.join(corpus_dir, 'titles.csv'), 'w', newline='') as titles_file:
+        titles_writer = csv.writer(titles_file)
+        titles_writer.writerow(['title'])
+        for sheet_number in range(1, sheet_count + 1):
+            sheet_rows = min(rows_per_sheet, rows - (sheet_number - 1) * rows_per_sheet)
+            header = ['article_id', rng.choice(TROVE_ID_HEADERS), rng.choice(TITLE_HEADERS), 'title',
+                      rng.choice(CHAPTER_NUMBER_HEADERS), rng.choice(CHAPTER_TITLE_HEADERS), *OTHER_HEADERS]
+            workbook = Workbook(write_only=True)
+            worksheet = workbook.create_sheet('Sheet1')
+            worksheet.append(header)
+            for _ in range(sheet_rows):
+                if used_article_ids and rng.random() < 0.005:
+                    article_id = rng.choice(used_article_ids)
+                else:
+                    article_id = 100000000 + len(used_article_ids) * 13 + rng.randrange(13)
+                    used_article_ids.append(article_id)
+                if rng.random() < 0.03:
+                    uploaded_chapters.append(article_id)
+
+                old_id = rng.choice(old_ids)
+                record = records[old_trove_ids[old_id]]
+                trove_id_noise = rng.random()
+                if trove_id_noise < 0.05:
+                    trove_id = None
+                elif trove_id_noise < 0.08:
+                    trove_id = 5000000 + rng.randrange(100000)
+                elif trove_id_noise < 0.10:
+                    trove_id = rng.choice(['n/a', '?', 'see notes'])
+                else:
+                    trove_id = old_id if rng.random() < 0.8 else f' {old_id} '
+
+                title = rng.choice([record['publication_title'], record['common_title']])
+                title_noise = rng.random()
+                if title_noise < 0.05:
+                    title = _title_text(rng)
+                elif title_noise < 0.4:
+                    title = _noisy_title(title, rng)
+
+                chapter = rng.choice(ROMAN_NUMERALS)
+                chapter_title = _title_text(rng) if rng.random() < 0.6 else None
+                headline = _headline(chapter, chapter_title or _title_text(rng), rng)
+                # Most chapter numbers are Roman Numerals, some are written as numbers and some are missing
+                chapter_number = chapter if rng.random() < 0.8 else rng.choice([ROMAN_NUMERALS.index(chapter) + 1, None])
+
+                worksheet.append([article_id, trove_id, title, headline, chapter_number, chapter_title,
+                                  f"{1850 + rng.randrange(70)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                                  rng.choice(NEWSPAPERS), None if rng.random() < 0.7 else _title_text(rng),
+                                  rng.randint(500, 9000), None, rng.choice(['', 'AB', 'CD'])])
+                titles_writer.writerow([headline])
+            workbook.save(os.path.join(sheets_dir, f'sheet_{sheet_number:05d}.xlsx'))
+            print(f"wrote sheet {sheet_number} of {sheet_count}")
+
+    with open(os.path.join(corpus_dir, 'title_records.json'), 'w') as json_file:
+        json.dump(list(records.values()), json_file)
+    write_synthetic_mappings(os.path.join(corpus_dir, 'mappings.json'), old_trove_ids, uploaded_chapters,
+                             mappings_entries, seed)
+    corpus = {'rows': rows, 'rows_per_sheet': rows_per_sheet, 'title_count': title_count,
+              'mappings_entries': mappings_entries, 'seed': seed}
+    with open(os.path.join(corpus_dir, CORPUS_MANIFEST), 'w') as json_file:
+        json.dump(corpus, json_file, indent=1)
+    return corpus
+
+
+def ensure_corpus(corpus_dir: str, rows: int, rows_per_sheet: int, title_count: int, mappings_entries: int,
+                  seed: int) -> dict:
+    """This function writes the corpus unless corpus_dir already holds one written with the same options."""
+    wanted = {'rows': rows, 'rows_per_sheet': rows_per_sheet, 'title_count': title_count,
+              'mappings_entries': mappings_entries, 'seed': seed}
+    manifest_path = os.path.join(corpus_dir, CORPUS_MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as json_file:
+            corpus = json.load(json_file)
+        if corpus == wanted:
+            print(f"using existing corpus {corpus_dir}")
+            return corpus
+        shutil.rmtree(corpus_dir)
+    print(f"writing synthetic corpus ({rows} rows, {rows_per_sheet} rows per sheet) to {corpus_dir}")
+    start = time.perf_counter()
+    corpus = write_synthetic_corpus(corpus_dir, rows, rows_per_sheet, title_count, mappings_entries, seed)
+    print(f"wrote corpus in {time.perf_counter() - start:.1f}s")
+    return corpus
+
+
+def _count_rows(file_paths) -> int:
+    import pandas as pd
+    return sum(len(pd.read_csv(file_path, usecols=[0])) for file_path in file_paths)
+
+
+def run_stage(stage: str, options: dict) -> dict:
+    """
+    This function runs one stage in this process and returns its time, the number of rows it processed and its peak
+    RSS. The stage's own console output is discarded.
+    """
+    import importlib
+    import numpy  # noqa: F401 -- imported up front so every stage is measured against the same baseline
+    import pandas as pd
+
+    work_dir = options['work_dir']
+    sheets_dir = os.path.join(work_dir, 'sheets')
+    baseline = _peak_rss_mb()
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            start = time.perf_counter()
+            if stage == 'update_trove_id':
+                importlib.import_module('1_update_trove_id').process_directory(
+                    sheets_dir, options['mappings'], options['workers'], options['reader'])
+            elif stage == 'clean_and_check':
+                importlib.import_module('2_clean_and_check_data').process_directory(
+                    os.path.join(sheets_dir, 'processed_files'), options['mappings'])
+            elif stage == 'clean_titles':
+                import clean_titles
+                titles = pd.read_csv(options['titles'], nrows=options['rows'], dtype=str)['title']
+                start = time.perf_counter()
+                clean_titles.parse_titles(titles)
+            else:
+                from title_api_async import create_lookup
+                from title_cache import TitleCache
+                with TitleCache(os.path.join(work_dir, f'{stage}_title_cache.sqlite')) as cache, \
+                        create_lookup(options['client'], options['base_url'], max_workers=options['concurrency'],
+                                      requests_per_second=0, cache=cache, batch=options['batch']) as title_lookup:
+                    if stage == 'check_title_id':
+                        importlib.import_module('3_check_title_id_query_API').process_directory(
+                            os.path.join(work_dir, 'to_upload'), title_lookup, options['batch_size'])
+                    else:
+                        importlib.import_module('pipeline').run_pipeline(
+                            sheets_dir, options['mappings'], title_lookup, backend=options['reader'],
+                            batch_size=options['batch_size'])
+            seconds = time.perf_counter() - start
+        finally:
+            sys.stdout = stdout
+    peak = _peak_rss_mb()
+
+    if stage == 'clean_and_check':
+        rows = _count_rows(glob.glob(os.path.join(sheets_dir, 'processed_files', '*.csv')))
+    elif stage == 'check_title_id':
+        rows = _count_rows(glob.glob(os.path.join(work_dir, 'to_upload', '*.csv')))
+    else:
+        rows = options['rows']
+    return {'stage': stage, 'rows': rows, 'seconds': seconds, 'rows_per_sec': rows / seconds if seconds else None,
+            'peak_rss_mb': peak, 'baseline_rss_mb': baseline}
+
+
+def measure(stage: str, options: dict) -> dict:
+    """This function runs a stage in a fresh Python process and returns its measurements (or its error)."""
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', stage, json.dumps(options)],
+                               capture_output=True, text=True, cwd=CODE_DIR)
+    if completed.returncode != 0:
+        error = completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else f"exit {completed.returncode}"
+        return {'stage': stage, 'error': error}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def prepare_scale(corpus_dir: str, work_dir: str, rows: int, rows_per_sheet: int) -> None:
+    """This function sets up a fresh working folder holding the first sheets of the corpus, up to rows rows."""
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    sheets_dir = os.path.join(work_dir, 'sheets')
+    os.makedirs(sheets_dir)
+    os.makedirs(os.path.join(work_dir, 'to_upload'))
+    sheet_files = sorted(glob.glob(os.path.join(corpus_dir, 'sheets', '*.xlsx')))
+    for file_path in sheet_files[:math.ceil(rows / rows_per_sheet)]:
+        os.symlink(os.path.abspath(file_path), os.path.join(sheets_dir, os.path.basename(file_path)))
+
+
+def collect_to_upload(work_dir: str) -> None:
+    """This function links the '_sheet_to_upload' outputs of stage 2 into the input folder of stage 3."""
+    outputs = glob.glob(os.path.join(work_dir, 'sheets', 'processed_files', 'clean_and_check_processed_files',
+                                     '*_sheet_to_upload.csv'))
+    for file_path in outputs:
+        os.link(file_path, os.path.join(work_dir, 'to_upload', os.path.basename(file_path)))
+
+
+def git_commit() -> tuple:
+    """Returns (the short hash of the current commit, whether the tree has uncommitted changes), or (None, None)."""
+    repo_dir = CODE_DIR
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, check=True,
+                                capture_output=True, text=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir, check=True,
+                                capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status)
+
+
+def print_results(results: list) -> None:
+    print(f"{'rows':>9} {'stage':<16} {'time (s)':>9} {'rows/sec':>10} {'peak RSS (MB)':>14}")
+    for result in results:
+        if 'error' in result:
+            print(f"{result['scale']:>9} {result['stage']:<16} failed: {result['error']}")
+            continue
+        print(f"{result['scale']:>9} {result['stage']:<16} {result['seconds']:>9.2f} {result['rows_per_sec']:>10.0f} "
+              f"{result['peak_rss_mb']:>14.1f}")
+
+
+def compare(old_path: str, new_path: str) -> None:
+    """This function prints the change in throughput and peak RSS per scale and stage between two results files."""
+    with open(old_path, 'r') as json_file:
+        old = json.load(json_file)
+    with open(new_path, 'r') as json_file:
+        new = json.load(json_file)
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    old_results = {(result['scale'], result['stage']): result for result in old['results'] if 'error' not in result}
+    print(f"{'rows':>9} {'stage':<16} {'rows/sec':>21} {'speedup':>8} {'peak RSS (MB)':>17}")
+    for result in new['results']:
+        before = old_results.get((result['scale'], result['stage']))
+        if before is None or 'error' in result:
+            continue
+        print(f"{result['scale']:>9} {result['stage']:<16} {before['rows_per_sec']:>10.0f} {result['rows_per_sec']:>10.0f} "
+              f"{result['rows_per_sec'] / before['rows_per_sec']:>7.2f}x "
+              f"{before['peak_rss_mb']:>8.1f} {result['peak_rss_mb']:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark stages 1 to 3 and clean_titles on a synthetic TBC corpus.')
+    parser.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES, help='numbers of rows to run at')
+    parser.add_argument('--stages', choices=STAGES, nargs='+', default=DEFAULT_STAGES,
+                        help='stages to time, in order (each of stages 2 and 3 reads the outputs of the stage before)')
+    parser.add_argument('--rows-per-sheet', type=int, default=5000)
+    parser.add_argument('--titles', type=int, default=2000, help='number of title records the sheets refer to')
+    parser.add_argument('--mappings-entries', type=int, default=100000,
+                        help='unused trove entries and uploaded chapters to pad the mappings file with')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the stub title api takes per request')
+    parser.add_argument('--concurrency', type=int, default=8, help='maximum number of requests in flight in stage 3')
+    parser.add_argument('--client', choices=['async', 'threads'], default='async', help='title api client for stage 3')
+    parser.add_argument('--no-batch', action='store_true',
+                        help='the stub title api has no multi-id endpoint and the client does not use it')
+    parser.add_argument('--batch-size', type=int, default=200, help='rows checked at a time in stage 3')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes for stage 1')
+    parser.add_argument('--reader', default='pandas', help='Excel reader backend (see xlsx_readers)')
+    parser.add_argument('--work-dir', help='folder to keep the corpus and the stage outputs in (default: a temporary folder)')
+    parser.add_argument('--results-dir', default=DEFAULT_RESULTS_DIR,
+                        help='folder to save the results JSON in (default: bench_results next to this script)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two results files and exit')
+    parser.add_argument('--child', nargs=2, metavar=('STAGE', 'OPTIONS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_stage(args.child[0], json.loads(args.child[1]))))
+        return
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    from stub_title_api import start_stub_server
+
+    temp_dir = None
+    work_dir = args.work_dir
+    if work_dir is None:
+        temp_dir = tempfile.TemporaryDirectory()
+        work_dir = temp_dir.name
+    try:
+        corpus_dir = os.path.join(work_dir, 'corpus')
+        ensure_corpus(corpus_dir, max(args.scales), args.rows_per_sheet, args.titles, args.mappings_entries, args.seed)
+        with open(os.path.join(corpus_dir, 'title_records.json'), 'r') as json_file:
+            records = {record['id']: record for record in json.load(json_file)}
+        # The stub runs in this process, so the stages' peak RSS does not include it
+        server, base_url = start_stub_server(records, latency=args.latency, batch=not args.no_batch)
+
+        results = []
+        for scale in sorted(args.scales):
+            scale_dir = os.path.join(work_dir, f'run_{scale}')
+            prepare_scale(corpus_dir, scale_dir, scale, args.rows_per_sheet)
+            options = {'work_dir': scale_dir, 'rows': scale, 'mappings': os.path.join(corpus_dir, 'mappings.json'),
+                       'titles': os.path.join(corpus_dir, 'titles.csv'), 'base_url': base_url,
+                       'concurrency': args.concurrency, 'client': args.client, 'batch_size': args.batch_size, 'batch': not args.no_batch, 'workers': args.workers,
+                       'reader': args.reader}
+            for stage in args.stages:
+                # Stage 3 checks the rows stage 2 sent on for upload
+                if stage == 'check_title_id':
+                    collect_to_upload(scale_dir)
+                print(f"running {stage} on {scale} rows")
+                result = {'scale': scale, **measure(stage, options)}
+                results.append(result)
+        server.shutdown()
+    finally:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+    print_results(results)
+    commit, dirty = git_commit()
+    run = {'commit': commit, 'dirty': dirty, 'created': datetime.datetime.now().isoformat(timespec='seconds'),
+           'python': platform.python_version(), 'platform': platform.platform(),
+           'options': {key: value for key, value in vars(args).items() if key not in ('child', 'compare', 'work_dir', 'results_dir')},
+           'results': results}
+    os.makedirs(args.results_dir, exist_ok=True)
+    results_path = os.path.join(args.results_dir, f"{commit or 'unknown'}{'-dirty' if dirty else ''}-"
+                                                  f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(results_path, 'w') as json_file:
+        json.dump(run, json_file, indent=1)
+    print(f"saved results to {results_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+This program measures the cold-start time of the command line: each command is run in a fresh interpreter a number of
+times and the median wall time is reported, along with the heavy packages (pandas, numpy, openpyxl, the api clients)
+the command imported, found with 'python -X importtime'. It covers:
+- 'tbc.py --help', the '--help' of each subcommand and '--dry-run' on an empty folder, which should import none of them.
+- the '--help' of the numbered scripts, which import their stage module before parsing their options.
+- the import time of each heavy package and stage module on its own, less the start-up of a bare interpreter.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The packages whose import makes a command slow to start
+HEAVY_PACKAGES = ['pandas', 'numpy', 'pyarrow', 'openpyxl', 'requests', 'httpx', 'thefuzz', 'fuzzywuzzy', 'rapidfuzz']
+
+STAGE_MODULES = ['1_update_trove_id', '2_clean_and_check_data', '3_check_title_id_query_API', 'clean_titles',
+                 'pipeline', 'watch_folder']
+
+
+def time_command(argv: list, runs: int) -> float:
+    """This function runs a command runs times in a fresh process and returns the median wall time in seconds."""
+    seconds = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, cwd=CODE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds)
+
+
+def heavy_imports(argv: list) -> list:
+    """This function runs a Python command once with -X importtime and returns the HEAVY_PACKAGES it imported."""
+    result = subprocess.run([argv[0], '-X', 'importtime'] + argv[1:], cwd=CODE_DIR, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True)
+    imported = set()
+    for line in result.stderr.splitlines():
+        # 'import time:  self [us] | cumulative | imported package', nested imports are indented
+        if line.startswith('import time:') and '|' in line:
+            imported.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+    return [package for package in HEAVY_PACKAGES if package in imported]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cold-start time of tbc.py and the stage scripts.')
+    parser.add_argument('--runs', type=int, default=5, help='runs of each command (the median is reported)')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    python = sys.executable
+    results = {'commands': {}, 'imports': {}}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        input_dir = os.path.join(temp_dir, 'sheets')
+        os.makedirs(input_dir)
+        mappings = os.path.join(temp_dir, 'remote_old_to_new_mappings.json')
+        with open(mappings, 'w') as json_file:
+            json.dump({'trove': {}, 'uploaded_chapters': []}, json_file)
+
+        commands = {'python (bare interpreter)': [python, '-c', 'pass'], 'tbc.py --help': [python, 'tbc.py', '--help']}
+        for command in ['update-ids', 'clean-check', 'verify-titles', 'clean-titles', 'pipeline', 'watch']:
+            commands[f'tbc.py {command} --help'] = [python, 'tbc.py', command, '--help']
+        for command in ['update-ids', 'clean-check', 'verify-titles', 'pipeline']:
+            commands[f'tbc.py {command} --dry-run'] = [python, 'tbc.py', command, input_dir, '--dry-run',
+                                                       *(['--mappings', mappings] if command != 'verify-titles' else [])]
+        for module in STAGE_MODULES[:-1]:
+            commands[f'{module}.py --help'] = [python, f'{module}.py', '--help']
+
+        print(f"{'command':<45} {'median':>9}  heavy imports")
+        for label, argv in commands.items():
+            seconds = time_command(argv, args.runs)
+            packages = heavy_imports(argv)
+            results['commands'][label] = {'seconds': seconds, 'heavy_imports': packages}
+            print(f"{label:<45} {seconds * 1000:>7.0f}ms  {', '.join(packages) or '-'}")
+
+    baseline = results['commands']['python (bare interpreter)']['seconds']
+    print(f"\n{'import (less the bare interpreter)':<45} {'median':>9}")
+    for module in HEAVY_PACKAGES + STAGE_MODULES + ['tbc']:
+        argv = [python, '-c', f'import importlib; importlib.import_module({module!r})']
+        if subprocess.run(argv, cwd=CODE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode:
+            print(f"{module:<45} {'not installed':>9}")
+            continue
+        seconds = time_command(argv, args.runs)
+        results['imports'][module] = seconds - baseline
+        print(f"{module:<45} {(seconds - baseline) * 1000:>7.0f}ms")
+
+    if args.output:
+        with open(args.output, 'w') as json_file:
+            json.dump(results, json_file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 """
 This program takes in an Excel file and extracts Roman Numerals from the 'Title' column and puts them in a new column titled 'chapter number'. 
 This program also extracts  the Chapter Title from the 'Title' column and puts them in a new column titled 'chapter title'. 
+With --chunk-rows, the file is read and written a chunk of rows at a time, so memory stays flat however long it is.
 """
 
 import pandas as pd
@@ -8,9 +9,42 @@ import re
 import numpy as np
 import os
 import sys
+import functools
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
 from fuzzywuzzy import fuzz
 
+import tbc
+from table_io import compact_dtypes
+from xlsx_readers import iter_sheet_chunks, scan_sheet
+
+# Patterns used on every title, compiled once
+ROMAN_NUMERAL = re.compile(r'\b[MDCLXVI]+\b')
+WORD = re.compile(r'\b\w+\b')
+CHAPTER_I = re.compile(r'chapter\sI(\s|\.)', re.IGNORECASE)
+CONTINUED = re.compile(r'continued', re.IGNORECASE)
+
+# The clean-up steps of clean_chapter_title, in order, as (pattern, replacement) pairs
+CHAPTER_TITLE_CLEANUP = [
+    #remove all instances where there is a '. (.)' in the string or ' . ' in the string 
+    (re.compile(r'\.\s\(\.\)'), ''),
+    (re.compile(r'\.\s'), ''),
+    #remove all instances of '()' from string
+    (re.compile(r'\(\)'), ''),
+    #remove all instances of '(.)' or ' (.)' from string eetc.
+    (re.compile(r'\s\(\.\)'), ''),
+    (re.compile(r'\(\.\)'), ''),
+    (re.compile(r'\(\.\s'), ''),
+    #remove all instances where '.' is at the beginning of the string with trailing whitespace 
+    (re.compile(r'^\.\s'), ''),
+    #remove all '.' from string
+    (re.compile(r'\.'), ''),
+]
+
+# The number of distinct titles (and words) whose results are remembered
+CACHE_SIZE = 100000
+
 def identify_roman_numeral(title):
     """
     This function takes in a string and returns the Roman Numeral in the string.
@@ -20,13 +54,27 @@ def identify_roman_numeral(title):
         return np.nan
     else:
         # Roman Numerals
-        roman_numeral = re.findall(r'\b[MDCLXVI]+\b', title)
-        if roman_numeral == []:
+        roman_numeral = ROMAN_NUMERAL.search(title)
+        if roman_numeral is None:
             roman_numeral = np.nan
         else:
-            roman_numeral = roman_numeral[0]
+            roman_numeral = roman_numeral.group()
     return roman_numeral
 
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def is_continued_word(word):
+    """
+    This function checks whether a word is 'continued' or close to it (fuzz ratio of at least 80).
+    Only words of 6 to 13 characters can reach a ratio of 80 against the 9 characters of 'continued',
+    so the fuzzy comparison is skipped for all other words.
+    """
+    word = word.lower()
+    if word == 'continued':
+        return True
+    if not 6 <= len(word) <= 13:
+        return False
+    return fuzz.ratio(word, 'continued') >= 80  # Adjust the threshold as needed
+
 def identify_continued(title):
     """
     This function checks to see if the title contains a word similar to 'continued' with a Levenshtein distance of 2.
@@ -36,9 +84,8 @@ def identify_continued(title):
         return np.nan
     
     # Check for 'continued' or similar words
-    word_list = re.findall(r'\b\w+\b', title)  # Extract individual words from the title
-    for word in word_list:
-        if fuzz.ratio(word.lower(), 'continued') >= 80:  # Adjust the threshold as needed
+    for word in WORD.findall(title):  # Extract individual words from the title
+        if is_continued_word(word):
             # Add ' (Continued)' to the end of the string in the 'chapter number' column
             return ' (Continued)'
     return ''  # Return an empty string if 'continued' is not found
@@ -51,82 +98,191 @@ def identify_chapter_title(title):
         return ''
 
     # Roman Numerals
-    roman_numeral = re.findall(r'\b[MDCLXVI]+\b', title)
-    if roman_numeral == []:
+    roman_numeral = ROMAN_NUMERAL.search(title)
+    if roman_numeral is None:
         return ''
     else:
-        roman_numeral = roman_numeral[0]
+        roman_numeral = roman_numeral.group()
 
     #Create a condition to handle instances where there is 'CHAPTER I' OR 'chapter I' in the title column and retrieve all text after it
-    if re.search(r'chapter\sI(\s|\.)', title, re.IGNORECASE):
+    if CHAPTER_I.search(title):
         chapter_title = title.split('CHAPTER I')[-1].strip()
-        #conduct regex match of chapter title to see if it is 'continued'
-        if re.match(r'continued', chapter_title.lower(), re.IGNORECASE):
-            return ''
-        else:
-            return chapter_title
+    else:
+        # Chapter Title
+        chapter_title = title.split(roman_numeral)[-1].strip()
 
-    # Chapter Title
-    chapter_title = title.split(roman_numeral)[-1].strip()
     #conduct regex match of chapter title to see if it is 'continued'
-    if re.match(r'continued', chapter_title.lower(), re.IGNORECASE):
+    if CONTINUED.match(chapter_title.lower()):
         return ''
 
     return chapter_title
 
 
+def clean_chapter_title(title):
+    #remove all non-ascci characters from string 
+    title = title.encode("ascii", errors="ignore").decode()
+    #remove all instances of 'continued' from string as well as any leading or trailing whitespace as regex
+    title = CONTINUED.sub('', title).strip()
+    for pattern, replacement in CHAPTER_TITLE_CLEANUP:
+        title = pattern.sub(replacement, title)
+    return title
 
 
+def clean_chapter_titles(titles):
+    """
+    This function applies clean_chapter_title to a whole column of strings with pandas' vectorized .str methods.
+    """
+    titles = titles.str.encode("ascii", errors="ignore").str.decode("ascii")
+    titles = titles.str.replace(CONTINUED, '', regex=True).str.strip()
+    for pattern, replacement in CHAPTER_TITLE_CLEANUP:
+        titles = titles.str.replace(pattern, replacement, regex=True)
+    return titles
 
 
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def split_title(title):
+    """
+    This function returns (chapter_number, continued, chapter_title) for a title, with the chapter title not yet
+    cleaned. Results are remembered for the most recent CACHE_SIZE distinct titles, as the same headlines
+    (e.g. 'CHAPTER I. (Continued.)') come up again and again.
+    """
+    return identify_roman_numeral(title), identify_continued(title), identify_chapter_title(title)
 
-def clean_chapter_title(title):
-    #remove all non-ascci characters from string 
-    title = title.encode("ascii", errors="ignore").decode()
-    #remove all instances of 'continued' from string as well as any leading or trailing whitespace as regex
-    title = re.sub(r'continued', '', title, flags=re.IGNORECASE).strip()
-    #remove all instances where there is a '. (.)' in the string or ' . ' in the string 
-    title = re.sub(r'\.\s\(\.\)', '', title)
-    title = re.sub(r'\.\s', '', title)
-    #remove all instances of '()' from string
-    title = re.sub(r'\(\)', '', title)
-    #remove all instances of '(.)' or ' (.)' from string eetc.
-    title = re.sub(r'\s\(\.\)', '', title)
-    title = re.sub(r'\(\.\)', '', title)
-    title = re.sub(r'\(\.\s', '', title)
-    #remove all instances where '.' is at the beginning of the string with trailing whitespace 
-    title = re.sub(r'^\.\s', '', title)
-    #remove all '.' from string
-    title = re.sub(r'\.', '', title)
 
-    
+def parse_title(title):
+    """
+    This function parses a title in one call and returns (chapter_number, continued, chapter_title):
+    the Roman Numeral in the title (NaN if there is none), ' (Continued)' if the title contains a word similar
+    to 'continued' (otherwise ''), and the cleaned chapter title.
+    """
+    chapter_number, continued, chapter_title = split_title(title)
+    return chapter_number, continued, clean_chapter_title(chapter_title)
 
-    return title
 
+def parse_titles(titles):
+    """
+    This function parses a whole column of titles, parsing each distinct title only once and cleaning
+    the distinct chapter titles with vectorized string operations.
+
+    Parameters:
+    titles (pandas.Series): The titles.
+
+    Returns:
+    pandas.DataFrame: The 'chapter number' (Roman Numeral followed by ' (Continued)' where the title is continued)
+    and 'chapter title' columns, with the same index as titles.
+    """
+    codes, uniques = pd.factorize(titles)
+    chapter_numbers = np.empty(len(uniques) + 1, dtype=object)
+    continued = np.empty(len(uniques) + 1, dtype=object)
+    chapter_titles = np.empty(len(uniques) + 1, dtype=object)
+    for i, title in enumerate(uniques):
+        chapter_numbers[i], continued[i], chapter_titles[i] = split_title(title)
+    # Missing titles (code -1) take the last slot
+    chapter_numbers[-1], continued[-1], chapter_titles[-1] = np.nan, np.nan, ''
+    chapter_titles = clean_chapter_titles(pd.Series(chapter_titles, dtype=object)).to_numpy(dtype=object)
 
+    chapter_number = pd.Series(chapter_numbers[codes], index=titles.index).astype(str)
+    return pd.DataFrame({
+        'chapter number': chapter_number + pd.Series(continued[codes], index=titles.index).replace(np.nan, ''),
+        'chapter title': pd.Series(chapter_titles[codes], index=titles.index),
+    })
+
+
+def add_chapter_columns(df):
+    """
+    This function parses each distinct string in the 'title' column once, extracting the Roman Numeral (with
+    ' (Continued)' added if the title is continued) into a 'chapter number' column and the cleaned chapter title
+    into a 'chapter title' column.
+    """
+    parsed = parse_titles(df['title'])
+    df['chapter number'] = parsed['chapter number']
+    df['chapter title'] = parsed['chapter title']
+    return df
+
+
+def _header_cell(sheet, value):
+    """Returns a header cell styled the way pandas' to_excel styles its header row."""
+    cell = WriteOnlyCell(sheet, value=value)
+    thin = Side(style='thin')
+    cell.font = Font(bold=True)
+    cell.border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    cell.alignment = Alignment(horizontal='center', vertical='top')
+    return cell
+
+
+def _excel_value(value):
+    """Converts a DataFrame value to the cell value pandas' to_excel writes for it."""
+    if pd.api.types.is_scalar(value) and pd.isna(value):
+        return ''
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def clean_file_chunked(file, output_file, chunk_rows):
+    """
+    This function cleans an Excel file chunk by chunk: its rows are streamed from the sheet with the read-only reader
+    and written to a write-only workbook as each chunk is parsed, so only one chunk is held in memory at a time.
+    The chunks are read with the dtypes a whole-file read gives each column, in their compact form where that keeps
+    every value (repeated titles and chapter numbers as categories, other text as Arrow-backed strings), so the cells
+    written are the same as those of the whole-file path.
+
+    Parameters:
+    file (str): The path to the Excel file.
+    output_file (str): The path to write the cleaned Excel file to.
+    chunk_rows (int): The number of rows in each chunk.
+    """
+    header, dtypes, mixed_columns = scan_sheet(file, chunk_rows)
+    # Columns mixing numbers and text are kept as objects, so each cell keeps its type
+    dtypes = {**dtypes, **compact_dtypes({column: dtype for column, dtype in dtypes.items()
+                                          if column not in mixed_columns})}
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet('Sheet1')
+    columns = None
+    for chunk in iter_sheet_chunks(file, chunk_rows, header=header, dtype=dtypes):
+        chunk = add_chapter_columns(chunk)
+        if columns is None:
+            columns = list(chunk.columns)
+            sheet.append([_header_cell(sheet, column) for column in columns])
+        for row in chunk.itertuples(index=False, name=None):
+            sheet.append([_excel_value(value) for value in row])
+    if columns is None:
+        # A sheet with a header row only
+        added = [column for column in ['chapter number', 'chapter title'] if column not in header]
+        sheet.append([_header_cell(sheet, column) for column in header + added])
+    workbook.save(output_file)
+
+
+def clean_file(file, output_file, chunk_rows=None):
+    """
+    This function extracts the chapter number and chapter title of each row's title in an Excel file and writes
+    the result to a new Excel file.
+
+    Parameters:
+    file (str): The path to the Excel file.
+    output_file (str): The path to write the cleaned Excel file to.
+    chunk_rows (int): Clean the file this many rows at a time (see clean_file_chunked), or None to read it whole.
+    """
+    if chunk_rows:
+        clean_file_chunked(file, output_file, chunk_rows)
+        return
 
-def main():
     #read in the excel file
-    file = 'FILE NAME HERE'
     df = pd.read_excel(file, sheet_name='Sheet1')
-    
-    #read in string from title column and apply identify_roman_numeral function to it and work through entire column 
-    df['chapter number'] = df['title'].apply(identify_roman_numeral)
-    #read in string from title title column and apply identify_continued function to it, if True, add ' (Continued)' to end of chapter number column
-    df['chapter number'] = df['chapter number'].astype(str) + df['title'].apply(identify_continued).replace(np.nan, '')
 
-    #read in string from title column and apply identify_chapter_title function to it and work through entire column
-    df['chapter title'] = df['title'].apply(identify_chapter_title)
-
-    #read in string from chapter title column and apply clean_chapter_title function to it and work through entire column
-    df['chapter title'] = df['chapter title'].apply(clean_chapter_title)
+    #parse each distinct string in the title column once, extracting the Roman Numeral (with ' (Continued)' added
+    #if the title is continued) into the chapter number column and the cleaned chapter title into the chapter title column
+    df = add_chapter_columns(df)
 
     #write to new excel file
-    df.to_excel('FILE NAME HERE_CLEANED.xlsx', index=False)
-
-    
+    df.to_excel(output_file, index=False)
 
 
+def main():
+    # The options are parsed by tbc.py, so that they are shared with 'tbc.py clean-titles'
+    tbc.main(['clean-titles'] + sys.argv[1:])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,392 @@
+"""
+This module compiles remote_old_to_new_mappings.json into a compact binary index and loads it back with memory-mapping.
+
+The index is a folder of NumPy arrays:
+- trove_old.npy / trove_new.npy: the 'trove' mapping as sorted int64 old Trove IDs and the matching new title_ids.
+- uploaded_chapters.npy: the 'uploaded_chapters' array as sorted, unique int64 article_ids.
+- meta.json: the size, mtime and sha256 of the JSON file the index was compiled from.
+Loading it maps the arrays into memory instead of building a Python object per entry, and lookups are vectorized
+binary searches (np.searchsorted). The index is recompiled automatically when the JSON file's content changes.
+
+When the index cannot be compiled first, stream_mappings reads just the 'trove' and/or 'uploaded_chapters' sections
+straight into the same compact containers with an incremental (ijson) parse, so the whole document is never built.
+"""
+
+import array
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from pipeline_state import atomic_write, file_sha256
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+INDEX_VERSION = 2
+
+
+def _canonical_int(value):
+    """
+    Returns value as an int if it is an int or the canonical string form of one (e.g. '123', not '0123' or '123.0'),
+    otherwise None. Only these values could ever match the str(int) lookups the stages make.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        try:
+            number = int(value)
+        except ValueError:
+            return None
+        return number if str(number) == value else None
+    return None
+
+
+def _fast_canonical_int(value):
+    """_canonical_int with a fast path for the common cases: an int, or a string of ASCII digits without a leading zero."""
+    if type(value) is int:
+        return value
+    if type(value) is str and value.isascii() and value.isdigit() and (value[0] != '0' or value == '0'):
+        return int(value)
+    return _canonical_int(value)
+
+
+class TroveIdMap:
+    """
+    A read-only old Trove ID -> new title_id mapping backed by two sorted int64 arrays.
+    It supports the dict lookups stage 1 makes (map_ids, get, in, len) without a Python object per entry.
+    """
+
+    def __init__(self, old_ids: np.ndarray, new_ids: np.ndarray):
+        self.old_ids = old_ids
+        self.new_ids = new_ids
+
+    def __len__(self):
+        return len(self.old_ids)
+
+    def lookup(self, old_ids) -> tuple:
+        """
+        Looks up an array of old Trove IDs.
+
+        Returns:
+        tuple: (new_ids, found) arrays. new_ids is 0 wherever found is False.
+        """
+        old_ids = np.asarray(old_ids, dtype=np.int64)
+        if len(self.old_ids) == 0:
+            return np.zeros(len(old_ids), dtype=np.int64), np.zeros(len(old_ids), dtype=bool)
+        positions = np.searchsorted(self.old_ids, old_ids)
+        positions[positions == len(self.old_ids)] = 0
+        found = self.old_ids[positions] == old_ids
+        return np.where(found, self.new_ids[positions], 0), found
+
+    def map_ids(self, old_ids) -> pd.array:
+        """Maps a Series or array of int old Trove IDs to a nullable Int64 array of new title_ids (<NA> where there is no mapping)."""
+        new_ids, found = self.lookup(old_ids)
+        return pd.arrays.IntegerArray(new_ids, ~found)
+
+    def get(self, old_id, default=None):
+        old_id = _canonical_int(old_id)
+        if old_id is None:
+            return default
+        new_ids, found = self.lookup([old_id])
+        return int(new_ids[0]) if found[0] else default
+
+    def __contains__(self, old_id):
+        return self.get(old_id) is not None
+
+
+class ArticleIdSet:
+    """A read-only set of article_ids backed by a sorted int64 array."""
+
+    def __init__(self, article_ids: np.ndarray):
+        self.article_ids = article_ids
+
+    def __len__(self):
+        return len(self.article_ids)
+
+    def contains(self, article_ids) -> np.ndarray:
+        """Returns a boolean array marking which of the given int article_ids are in the set."""
+        article_ids = np.asarray(article_ids, dtype=np.int64)
+        if len(self.article_ids) == 0:
+            return np.zeros(len(article_ids), dtype=bool)
+        positions = np.searchsorted(self.article_ids, article_ids)
+        positions[positions == len(self.article_ids)] = 0
+        return self.article_ids[positions] == article_ids
+
+    def isin_strings(self, values: pd.Series) -> pd.Series:
+        """
+        The vectorized equivalent of values.astype(str).isin(uploaded_chapters): a value matches only if its
+        string form is the canonical string of an int in the set (so '123' matches, '123.0' and 'nan' do not).
+        """
+        strings = values.astype(str)
+        numbers = pd.to_numeric(strings, errors='coerce')
+        whole = (numbers.notna() & (numbers % 1 == 0) & (numbers.abs() < 2 ** 63)).to_numpy()
+        positions = np.flatnonzero(whole)
+        candidates = numbers.to_numpy()[positions].astype(np.int64)
+        canonical = candidates.astype(str) == strings.to_numpy()[positions].astype(str)
+        result = np.zeros(len(values), dtype=bool)
+        result[positions[canonical]] = self.contains(candidates[canonical])
+        return pd.Series(result, index=values.index)
+
+    def __contains__(self, article_id):
+        article_id = _canonical_int(article_id)
+        return article_id is not None and bool(self.contains([article_id])[0])
+
+
+class MappingsIndex:
+    """The loaded index: the 'trove' mapping (TroveIdMap), the 'uploaded_chapters' set (ArticleIdSet) and its metadata."""
+
+    def __init__(self, trove: TroveIdMap, uploaded_chapters: ArticleIdSet, meta: dict):
+        self.trove = trove
+        self.uploaded_chapters = uploaded_chapters
+        self.meta = meta
+
+    @property
+    def source_sha256(self) -> str:
+        """The sha256 of the mappings JSON the index was compiled from, i.e. the version of the mappings."""
+        return self.meta['sha256']
+
+
+def _sorted_trove_arrays(old_ids, new_ids) -> tuple:
+    old_ids = np.frombuffer(old_ids, dtype=np.int64) if len(old_ids) else np.zeros(0, dtype=np.int64)
+    new_ids = np.frombuffer(new_ids, dtype=np.int64) if len(new_ids) else np.zeros(0, dtype=np.int64)
+    order = np.argsort(old_ids, kind='stable')
+    return old_ids[order], new_ids[order]
+
+
+def stream_mappings(json_file_path: str, trove=True, uploaded_chapters=True) -> tuple:
+    """
+    This function reads the 'trove' mapping and/or the 'uploaded_chapters' array from a mappings JSON file in one
+    incremental parse (ijson), without building the rest of the document. Entries go straight into int64 buffers,
+    so peak memory is roughly 8 bytes per id rather than a Python object per entry.
+    Entries that could never match a lookup are left out: 'trove' entries that are not ints or canonical strings of
+    ints, and 'uploaded_chapters' entries that are not canonical strings of ints.
+
+    Parameters:
+    json_file_path (str): The path to remote_old_to_new_mappings.json.
+    trove (bool): Read the 'trove' mapping.
+    uploaded_chapters (bool): Read the 'uploaded_chapters' array.
+
+    Returns:
+    tuple: (TroveIdMap or None, ArticleIdSet or None, the number of entries left out)
+    """
+    if ijson is None:
+        raise ImportError("ijson is not installed, it is needed to stream the mappings JSON")
+    old_ids, new_ids, article_ids = array.array('q'), array.array('q'), array.array('q')
+    skipped = 0
+    old_id = None
+    trove_value = ('number', 'string')
+    with open(json_file_path, 'rb') as json_file:
+        # This loop runs once per JSON token, so the cheapest tests come first
+        for prefix, event, value in ijson.parse(json_file):
+            if prefix == 'trove':
+                if event == 'map_key':
+                    old_id = _fast_canonical_int(value)
+            elif prefix == 'uploaded_chapters.item':
+                if uploaded_chapters:
+                    # Only strings, like the str(article_id) the stages look up (a JSON number never matched one)
+                    article_id = _fast_canonical_int(value) if event == 'string' else None
+                    if article_id is None:
+                        skipped += 1
+                    else:
+                        article_ids.append(article_id)
+            elif trove and event in trove_value and prefix.startswith('trove.') and prefix.count('.') == 1:
+                new_id = _fast_canonical_int(value)
+                if old_id is None or new_id is None:
+                    skipped += 1
+                else:
+                    old_ids.append(old_id)
+                    new_ids.append(new_id)
+
+    trove_map = TroveIdMap(*_sorted_trove_arrays(old_ids, new_ids)) if trove else None
+    del old_ids, new_ids
+    article_set = None
+    if uploaded_chapters:
+        article_set = ArticleIdSet(np.unique(np.frombuffer(article_ids, dtype=np.int64)) if len(article_ids)
+                                   else np.zeros(0, dtype=np.int64))
+    return trove_map, article_set, skipped
+
+
+def default_index_dir(json_file_path: str) -> str:
+    """Returns the default index folder for a mappings JSON file: '<json file>.index' next to it."""
+    return json_file_path + '.index'
+
+
+def _read_meta(index_dir: str) -> dict:
+    meta_path = os.path.join(index_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as json_file:
+        return json.load(json_file)
+
+
+def _save_array(index_dir: str, name: str, array: np.ndarray) -> None:
+    file_path = os.path.join(index_dir, name)
+    with atomic_write(file_path) as temp_path:
+        with open(temp_path, 'wb') as f:
+            np.save(f, array)
+
+
+def build_index_arrays(trove: dict, uploaded_chapters) -> tuple:
+    """
+    This function turns the 'trove' dict and 'uploaded_chapters' list of the mappings JSON into the index arrays.
+    Entries that could never match a lookup are left out: 'trove' entries that are not ints or canonical strings of
+    ints, and 'uploaded_chapters' entries that are not canonical strings of ints.
+
+    Returns:
+    tuple: (trove_old, trove_new, uploaded_chapters) sorted int64 arrays, and the number of entries left out.
+    """
+    skipped = 0
+    pairs = []
+    for old_id, new_id in trove.items():
+        old_id, new_id = _canonical_int(old_id), _canonical_int(new_id)
+        if old_id is None or new_id is None:
+            skipped += 1
+            continue
+        pairs.append((old_id, new_id))
+    trove_array = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+    order = np.argsort(trove_array[:, 0], kind='stable')
+    trove_old = np.ascontiguousarray(trove_array[order, 0])
+    trove_new = np.ascontiguousarray(trove_array[order, 1])
+
+    article_ids = []
+    for article_id in uploaded_chapters:
+        # Only strings, like the str(article_id) the stages look up (a JSON number never matched one)
+        article_id = _canonical_int(article_id) if isinstance(article_id, str) else None
+        if article_id is None:
+            skipped += 1
+            continue
+        article_ids.append(article_id)
+    uploaded = np.unique(np.array(article_ids, dtype=np.int64))
+    return trove_old, trove_new, uploaded, skipped
+
+
+def write_index(index_dir: str, json_file_path: str, sha256: str, trove_old, trove_new, uploaded, skipped) -> dict:
+    """This function writes the index arrays and their metadata to index_dir. meta.json is written last."""
+    os.makedirs(index_dir, exist_ok=True)
+    _save_array(index_dir, 'trove_old.npy', trove_old)
+    _save_array(index_dir, 'trove_new.npy', trove_new)
+    _save_array(index_dir, 'uploaded_chapters.npy', uploaded)
+    stat = os.stat(json_file_path)
+    meta = {
+        'version': INDEX_VERSION,
+        'source': os.path.abspath(json_file_path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha256': sha256,
+        'trove_entries': int(len(trove_old)),
+        'uploaded_chapters': int(len(uploaded)),
+        'skipped_entries': skipped,
+    }
+    with atomic_write(os.path.join(index_dir, 'meta.json')) as temp_path:
+        with open(temp_path, 'w') as json_file:
+            json.dump(meta, json_file, indent=1)
+    return meta
+
+
+def compile_mappings_index(json_file_path: str, index_dir=None, sha256=None) -> dict:
+    """
+    This function compiles the mappings JSON into a binary index (see the module docstring).
+
+    Parameters:
+    json_file_path (str): The path to remote_old_to_new_mappings.json.
+    index_dir (str): The folder to write the index to. Defaults to '<json file>.index'.
+    sha256 (str): The sha256 of the JSON file, if it is already known.
+
+    Returns:
+    dict: The index metadata.
+    """
+    index_dir = index_dir or default_index_dir(json_file_path)
+    print(f"compiling mappings index for {json_file_path} into {index_dir}")
+    sha256 = sha256 or file_sha256(json_file_path)
+    if ijson is not None:
+        trove_map, article_set, skipped = stream_mappings(json_file_path)
+        arrays = (trove_map.old_ids, trove_map.new_ids, article_set.article_ids, skipped)
+    else:
+        with open(json_file_path, 'r') as json_file:
+            data = json.load(json_file)
+        arrays = build_index_arrays(data.get('trove', {}), data.get('uploaded_chapters', []))
+        del data
+    return write_index(index_dir, json_file_path, sha256, *arrays)
+
+
+def index_is_current(json_file_path: str, index_dir=None) -> tuple:
+    """
+    This function checks whether the index in index_dir was compiled from the current content of the JSON file.
+    The JSON file is only hashed if its size or mtime differs from when the index was compiled.
+
+    Returns:
+    tuple: (True/False, the sha256 of the JSON file if it had to be computed, otherwise None)
+    """
+    meta = _read_meta(index_dir or default_index_dir(json_file_path))
+    if meta is None or meta.get('version') != INDEX_VERSION:
+        return False, None
+    stat = os.stat(json_file_path)
+    if meta['size'] == stat.st_size and meta['mtime'] == stat.st_mtime:
+        return True, None
+    sha256 = file_sha256(json_file_path)
+    return meta['sha256'] == sha256, sha256
+
+
+# The indexes loaded in this process, by index folder, with the (size, mtime) of the JSON file each was loaded for
+_loaded_indexes = {}
+
+
+def load_mappings_index(json_file_path: str, index_dir=None) -> MappingsIndex:
+    """
+    This function loads the binary index for a mappings JSON file, compiling it first if it is missing or was
+    compiled from a different version of the JSON. The arrays are memory-mapped read-only.
+    An index already loaded in this process is returned again while the JSON file keeps its size and mtime, so the
+    stages run in one process (see pipeline.py and tbc.py) share a single load.
+
+    Parameters:
+    json_file_path (str): The path to remote_old_to_new_mappings.json.
+    index_dir (str): The index folder. Defaults to '<json file>.index'.
+
+    Returns:
+    MappingsIndex: The loaded index.
+    """
+    index_dir = index_dir or default_index_dir(json_file_path)
+    stat = os.stat(json_file_path)
+    loaded = _loaded_indexes.get(os.path.abspath(index_dir))
+    if loaded is not None and loaded[0] == (stat.st_size, stat.st_mtime):
+        return loaded[1]
+    current, sha256 = index_is_current(json_file_path, index_dir)
+    if not current:
+        compile_mappings_index(json_file_path, index_dir, sha256)
+    elif sha256 is not None:
+        # Same content with a new mtime, so remember the new mtime to skip hashing next time
+        meta = _read_meta(index_dir)
+        meta['size'], meta['mtime'] = os.stat(json_file_path).st_size, os.stat(json_file_path).st_mtime
+        with atomic_write(os.path.join(index_dir, 'meta.json')) as temp_path:
+            with open(temp_path, 'w') as json_file:
+                json.dump(meta, json_file, indent=1)
+
+    def load(name):
+        return np.load(os.path.join(index_dir, name), mmap_mode='r')
+
+    mappings_index = MappingsIndex(TroveIdMap(load('trove_old.npy'), load('trove_new.npy')),
+                                   ArticleIdSet(load('uploaded_chapters.npy')),
+                                   _read_meta(index_dir))
+    _loaded_indexes[os.path.abspath(index_dir)] = ((stat.st_size, stat.st_mtime), mappings_index)
+    return mappings_index
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Compile remote_old_to_new_mappings.json into a memory-mappable index.')
+    parser.add_argument('json_file_path', nargs='?', default='/Volumes/UNTITLED/remote_old_to_new_mappings.json')
+    parser.add_argument('--index-dir', help="folder to write the index to (default: '<json file>.index')")
+    args = parser.parse_args()
+    meta = compile_mappings_index(args.json_file_path, args.index_dir)
+    print(f"{meta['trove_entries']} trove mappings, {meta['uploaded_chapters']} uploaded chapters, "
+          f"{meta['skipped_entries']} entries skipped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+This module records timers, counters and histograms for the pipeline stages, with almost no overhead while it is
+disabled (the default): every recording call returns straight away, and timer() hands back a shared no-op context.
+
+Once enabled with configure() (or session(), which the stage scripts use for their --metrics option):
+- every measurement is written as one JSON object per line to the metrics file, with its labels (stage, sheet, ...),
+- the measurements are aggregated per metric and labels (leaving out the per-sheet label), and summary_table()
+  prints the count, total, rows/sec and the p50 / p95 / max of each at the end of a run.
+profile() runs a block under cProfile or pyinstrument (if installed), so a slow run can be pinned to a function.
+
+The metrics recorded across the stages are:
+- 'sheet' (timer, with the rows of the sheet): the time each stage spends on each sheet,
+- 'xlsx_parse' (timer): the time taken to parse each Excel file,
+- 'schema_sniff' (timer, with the sheets read): the time taken to read the header rows of a stage's sheets,
+- 'mappings_load' (timer): the time taken to load the mappings JSON (or its index),
+- 'api_latency' (histogram): the latency of each api request, 'api_requests' and 'api_retries' (counters),
+  labelled endpoint=batch for multi-id requests,
+- 'api_coalesced' (counter): title_ids that joined a request already in flight instead of being requested again,
+- 'cache_hits' and 'cache_misses' (counters): title cache lookups,
+- 'fuzzy_match' (timer, with the rows checked): the time taken to fuzzy match each batch of titles,
+- 'watch_latency' (histogram): in watch mode, the time from a sheet being first seen to its outputs being written.
+"""
+
+import contextlib
+import cProfile
+import io
+import json
+import pstats
+import random
+import threading
+import time
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+PROFILERS = ['cprofile', 'pyinstrument']
+
+# Labels that are written to the metrics file but not kept apart in the summary
+SUMMARY_EXCLUDED_LABELS = {'sheet'}
+
+# The number of values kept per histogram to estimate its percentiles (a uniform sample once there are more)
+MAX_SAMPLES = 100000
+
+
+class _Aggregate:
+    """The running totals of one metric with one set of labels."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.count = 0
+        self.total = 0.0
+        self.rows = 0
+        self.maximum = None
+        self.samples = []
+
+    def add(self, value: float, rows=None) -> None:
+        self.count += 1
+        self.total += value
+        if rows is not None:
+            self.rows += rows
+        if self.kind == 'counter':
+            return
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(value)
+        else:
+            # Reservoir sampling keeps a uniform sample of all the values seen
+            position = random.randrange(self.count)
+            if position < MAX_SAMPLES:
+                self.samples[position] = value
+
+    def percentile(self, fraction: float) -> float:
+        ordered = sorted(self.samples)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] if ordered else None
+
+
+class _Timer:
+    """A running timer. Set rows to record the number of rows it covered, for the rows/sec in the summary."""
+
+    def __init__(self, registry, name: str, labels: dict):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.rows = None
+        self.seconds = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self._start
+        self.registry.record('timer', self.name, self.seconds, self.labels, self.rows)
+
+
+class _NullTimer:
+    """The timer handed out while metrics are disabled: it records nothing."""
+    rows = None
+    seconds = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return None
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """A registry of measurements. The module-level functions use the shared registry, REGISTRY."""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._file = None
+        self.aggregates = {}
+
+    def configure(self, jsonl_path=None, enabled=True) -> None:
+        """Enables (or disables) recording, writing every measurement to jsonl_path if it is given."""
+        self.close()
+        self.enabled = enabled
+        self.aggregates = {}
+        if enabled and jsonl_path:
+            self._file = open(jsonl_path, 'a')
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def record(self, kind: str, name: str, value: float, labels: dict, rows=None) -> None:
+        key = (name, tuple(sorted((k, v) for k, v in labels.items() if k not in SUMMARY_EXCLUDED_LABELS)))
+        with self._lock:
+            aggregate = self.aggregates.get(key)
+            if aggregate is None:
+                aggregate = self.aggregates[key] = _Aggregate(kind)
+            aggregate.add(value, rows)
+            if self._file is not None:
+                event = {'ts': time.time(), 'type': kind, 'name': name, 'value': value, **labels}
+                if rows is not None:
+                    event['rows'] = rows
+                self._file.write(json.dumps(event, default=str) + '\n')
+
+    def timer(self, name: str, **labels):
+        return _Timer(self, name, labels) if self.enabled else _NULL_TIMER
+
+    def count(self, name: str, value=1, **labels) -> None:
+        if self.enabled:
+            self.record('counter', name, value, labels)
+
+    def observe(self, name: str, value: float, rows=None, **labels) -> None:
+        if self.enabled:
+            self.record('histogram', name, value, labels, rows)
+
+    def summary_table(self) -> str:
+        """Returns the aggregated measurements as a table."""
+        lines = [f"{'metric':<56} {'count':>8} {'total':>10} {'rows/sec':>10} {'p50':>9} {'p95':>9} {'max':>9}"]
+        for (name, labels), aggregate in sorted(self.aggregates.items()):
+            label = name + ''.join(f" {k}={v}" for k, v in labels)
+            if aggregate.kind == 'counter':
+                lines.append(f"{label:<56} {aggregate.count:>8} {aggregate.total:>10g}")
+                continue
+            rate = f"{aggregate.rows / aggregate.total:>10.0f}" if aggregate.rows and aggregate.total else f"{'':>10}"
+            lines.append(f"{label:<56} {aggregate.count:>8} {aggregate.total:>10.3f} {rate} "
+                         f"{aggregate.percentile(0.5):>9.4f} {aggregate.percentile(0.95):>9.4f} {aggregate.maximum:>9.4f}")
+        return '\n'.join(lines)
+
+
+REGISTRY = Metrics()
+
+
+def configure(jsonl_path=None, enabled=True) -> None:
+    REGISTRY.configure(jsonl_path, enabled)
+
+
+def enabled() -> bool:
+    return REGISTRY.enabled
+
+
+def timer(name: str, **labels):
+    """Returns a context manager that times its block as the metric name (see _Timer)."""
+    return REGISTRY.timer(name, **labels)
+
+
+def count(name: str, value=1, **labels) -> None:
+    """Adds value to the counter name."""
+    REGISTRY.count(name, value, **labels)
+
+
+def observe(name: str, value: float, rows=None, **labels) -> None:
+    """Records one value of the histogram name."""
+    REGISTRY.observe(name, value, rows, **labels)
+
+
+def summary_table() -> str:
+    return REGISTRY.summary_table()
+
+
+@contextlib.contextmanager
+def profile(profiler='cprofile', output_path=None):
+    """
+    Runs the block under a profiler: 'cprofile', or 'pyinstrument' if it is installed (otherwise cProfile, with a
+    message). The report is written to output_path if given (cProfile stats for pstats / snakeviz, or pyinstrument's
+    HTML), and the top functions are printed.
+    """
+    if profiler == 'pyinstrument' and pyinstrument is None:
+        print("pyinstrument is not installed, profiling with cProfile instead")
+        profiler = 'cprofile'
+    if profiler == 'pyinstrument':
+        profiler_instance = pyinstrument.Profiler()
+        profiler_instance.start()
+        try:
+            yield
+        finally:
+            profiler_instance.stop()
+            print(profiler_instance.output_text(unicode=False, color=False))
+            if output_path:
+                with open(output_path, 'w') as f:
+                    f.write(profiler_instance.output_html())
+        return
+    profiler_instance = cProfile.Profile()
+    profiler_instance.enable()
+    try:
+        yield
+    finally:
+        profiler_instance.disable()
+        if output_path:
+            profiler_instance.dump_stats(output_path)
+        stream = io.StringIO()
+        pstats.Stats(profiler_instance, stream=stream).sort_stats('cumulative').print_stats(25)
+        print(stream.getvalue())
+
+
+def add_arguments(parser) -> None:
+    """Adds the --metrics, --profile and --profile-output options to a stage's argument parser."""
+    parser.add_argument('--metrics', help='record timings and counters, appending them to this JSON-lines file, '
+                                          'and print a summary table at the end')
+    parser.add_argument('--profile', choices=PROFILERS, help='profile the run with cProfile or pyinstrument')
+    parser.add_argument('--profile-output', help='write the profile to this file')
+
+
+@contextlib.contextmanager
+def session(args):
+    """
+    Runs a stage's block with the metrics and profiling options parsed by add_arguments: records metrics if
+    --metrics is given (printing the summary table at the end) and profiles the block if --profile is given.
+    """
+    if args.metrics:
+        configure(args.metrics)
+    try:
+        with profile(args.profile, args.profile_output) if args.profile else contextlib.nullcontext():
+            yield
+    finally:
+        if args.metrics:
+            print(summary_table())
+            REGISTRY.close()
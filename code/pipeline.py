@@ -0,0 +1,298 @@
+"""
+This program runs stages 1 to 3 over a folder of Excel sheets in a single pass, without writing and re-reading the
+intermediate CSV files. Each sheet is passed from stage to stage as a DataFrame:
+1. update_trove_id: read the sheet, rename and convert the Trove ID column and map it to the new title_id.
+2. clean_and_check_data: convert the chapter columns to strings and split the rows into to_check / to_upload.
+3. check_title_id_query_API: fetch the title records of the to_upload rows and fuzzy match their titles.
+Each stage runs in its own thread and the stages are connected by bounded queues, so the api requests of stage 3
+overlap with reading and cleaning the next sheets, while at most queue_size sheets wait between two stages.
+
+The outputs of each sheet are written to a 'pipeline_output' folder in the input folder:
+'<sheet>_sheet_to_check', '<sheet>_safe_upload' and '<sheet>_not_safe_upload', as CSV, Parquet or Arrow files
+(see table_io). With debug_csv the intermediate '<sheet>_UPDATED_MAPPING' and '<sheet>_sheet_to_upload' files are
+written as well. With a dataset folder, the rows of every sheet go to one run-wide dataset instead (see run_dataset),
+with the statuses 'to_check', 'safe' and 'not_safe', and the safe rows can be exported to the API ingest JSON.
+"""
+
+import glob
+import importlib
+import os
+import queue
+import sys
+import threading
+import time
+
+import pandas as pd
+
+from article_index import ArticleIdIndex
+import metrics
+import tbc
+from mappings_index import load_mappings_index
+from pipeline_state import PipelineState, atomic_write
+from run_dataset import DEFAULT_PART_ROWS, RunDataset
+from sheet_schema import report_unprocessable, sniff_sheets
+from table_io import resolve_format, table_path, write_table
+from title_api import TitleLookup
+from title_index import TitleIndex
+from xlsx_readers import read_sheet
+
+# The numbered stage scripts can't be imported with an import statement
+update_trove_id = importlib.import_module('1_update_trove_id')
+clean_and_check_data = importlib.import_module('2_clean_and_check_data')
+check_title_id_query_API = importlib.import_module('3_check_title_id_query_API')
+
+# The folder, in the input folder, the outputs are written to
+OUTPUT_FOLDER = 'pipeline_output'
+
+# Put on a queue after the last sheet
+_DONE = object()
+
+
+class SheetBatch:
+    """
+    A sheet on its way through the pipeline: its path, its schema (see sheet_schema), the DataFrames produced so far,
+    timings and any error.
+    """
+
+    def __init__(self, file_path: str, schema=None):
+        self.file_path = file_path
+        self.schema = schema
+        self.base_name = os.path.splitext(os.path.basename(file_path))[0]
+        self.df = None
+        self.to_check = None
+        self.to_upload = None
+        self.results = {}
+        self.error = None
+        self.seconds = {}
+
+
+def _write_output(df, output_dir: str, name: str, output_format: str) -> None:
+    with atomic_write(table_path(os.path.join(output_dir, name), output_format)) as temp_path:
+        write_table(df, temp_path, output_format)
+
+
+def _sheet_rows(sheet: SheetBatch):
+    """Returns the number of rows a stage has just handled for the sheet, for the rows/sec in the metrics."""
+    if sheet.results:
+        return sum(len(rows) for rows in sheet.results.values())
+    if sheet.df is not None:
+        return len(sheet.df)
+    if sheet.to_check is not None:
+        return len(sheet.to_check) + len(sheet.to_upload)
+    return None
+
+
+def _run_stage(name: str, work, inbox: queue.Queue, outbox: queue.Queue) -> None:
+    """
+    This function takes sheets from inbox, applies work to each and passes them on to outbox until it sees _DONE.
+    A sheet whose work raises an error is passed on with the error recorded, so later stages skip it.
+    """
+    while True:
+        sheet = inbox.get()
+        if sheet is _DONE:
+            outbox.put(_DONE)
+            return
+        if sheet.error is None:
+            start = time.perf_counter()
+            try:
+                work(sheet)
+            except Exception as e:
+                sheet.error = f"{name}: {e!r}"
+            sheet.seconds[name] = time.perf_counter() - start
+            metrics.observe('sheet', sheet.seconds[name], _sheet_rows(sheet), stage=name, sheet=sheet.file_path)
+        outbox.put(sheet)
+
+
+def run_pipeline(input_dir: str, json_file_path: str, title_lookup: TitleLookup = None, update_ids=True,
+                 debug_csv=False, backend='pandas', queue_size=2, batch_size=200, file_list=None,
+                 output_format='csv', dataset_dir=None, ingest_json=None, part_rows=DEFAULT_PART_ROWS,
+                 title_index: TitleIndex = None, duplicate_check=False, article_index_path=None, schemas=None) -> dict:
+    """
+    This function runs stages 1 to 3 over every Excel file in input_dir (see the module docstring).
+
+    Parameters:
+    input_dir (str): The path to the directory containing the Excel files to process.
+    json_file_path (str): The path to remote_old_to_new_mappings.json. Its compiled index is loaded once.
+    title_lookup (TitleLookup): The lookup engine for the title records. Defaults to stage 3's shared one.
+    update_ids (bool): Run stage 1. Sheets created after the migration already have new title_ids and skip it.
+    debug_csv (bool): Also write the intermediate '_UPDATED_MAPPING' and '_sheet_to_upload' files.
+    backend (str): The Excel reader backend (see xlsx_readers).
+    queue_size (int): The number of sheets that may wait between two stages.
+    batch_size (int): The number of rows whose title records are fetched at a time in stage 3.
+    file_list (list): The Excel files to process. Defaults to every '.xlsx' file in input_dir.
+    output_format (str): The format to write the outputs in: 'csv', 'parquet' or 'arrow' (see table_io).
+    dataset_dir (str): Write the rows of every sheet to this run-wide dataset instead of three files per sheet.
+    A sheet is only marked as processed once its rows are committed to the dataset.
+    ingest_json (str): With dataset_dir, export the dataset's safe rows to this API ingest JSON file at the end.
+    part_rows (int): With dataset_dir, the number of rows per dataset commit.
+    title_index (TitleIndex): An offline title index. The not safe rows get a 'suggested_title_id' column, and the
+    titles are checked against the index instead of the api unless a title_lookup is given too.
+    duplicate_check (bool): Send the rows whose article_id was already sent for upload from an earlier sheet to be
+    checked (see clean_and_check_data.route_duplicates). Off by default.
+    article_index_path (str): The SQLite file of the article_id index. Defaults to 'article_ids.sqlite' in the
+    output folder.
+    schemas (dict): The SheetSchema of each file of file_list (see sheet_schema), if the caller has already read their
+    headers and reported the ones that can't be processed. Only the processable files are then processed.
+
+    The header row of every sheet is read before the stages start (see sheet_schema): the sheets missing a column the
+    stages need are reported together, in 'column_not_found.txt' in the output folder, and skipped, and only the
+    sheets created prior to June 2022 (wider than 33 columns) are limited to their first 33 columns in stage 1.
+
+    Returns:
+    dict: A summary of the run: the rows per outcome for each processed sheet ('processed'), the skipped sheets
+    ('skipped'), the error per failed sheet ('failed') and the reason per sheet that can't be processed
+    ('unprocessable').
+    """
+    title_lookup = title_lookup or title_index or check_title_id_query_API.lookup
+    output_format = resolve_format(output_format)
+    with metrics.timer('mappings_load', stage='pipeline', loader='index'):
+        mappings_index = load_mappings_index(json_file_path)
+    output_dir = os.path.join(input_dir, OUTPUT_FOLDER)
+    os.makedirs(output_dir, exist_ok=True)
+    state = PipelineState(output_dir, 'pipeline' if update_ids else 'pipeline_post_migration',
+                          json_file_path, mappings_index.source_sha256)
+    summary = {'processed': {}, 'skipped': [], 'failed': {}, 'unprocessable': {}}
+    dataset = RunDataset(dataset_dir, output_format, part_rows) if dataset_dir else None
+    article_index = None
+    if duplicate_check:
+        article_index = ArticleIdIndex(article_index_path or
+                                       os.path.join(output_dir, clean_and_check_data.ARTICLE_INDEX_NAME))
+
+    def read_and_update_ids(sheet):
+        if update_ids:
+            sheet.df, used_backend, parse_seconds = read_sheet(sheet.file_path, sheet_name='Sheet1',
+                                                               usecols=sheet.schema.usecols, backend=backend)
+            sheet.df = update_trove_id.update_trove_ids(sheet.df, mappings_index.trove)
+        else:
+            sheet.df, used_backend, parse_seconds = read_sheet(sheet.file_path, sheet_name='Sheet1', backend=backend)
+        metrics.observe('xlsx_parse', parse_seconds, stage='update_trove_id', backend=used_backend,
+                        sheet=sheet.file_path)
+        if debug_csv:
+            _write_output(sheet.df, output_dir, f'{sheet.base_name}_UPDATED_MAPPING', output_format)
+
+    def clean_and_check(sheet):
+        if article_index is not None:
+            article_index.forget(sheet.base_name)
+        sheet.to_check, sheet.to_upload = clean_and_check_data.clean_and_partition(
+            sheet.df, mappings_index.uploaded_chapters, article_index, sheet.base_name)
+        sheet.df = None
+        if debug_csv:
+            _write_output(sheet.to_upload, output_dir, f'{sheet.base_name}_sheet_to_upload', output_format)
+
+    def check_titles(sheet):
+        to_upload = sheet.to_upload
+        title_header = check_title_id_query_API.find_title_header(to_upload.columns)
+        if title_header is None:
+            raise ValueError(f"Could not find title header in {sheet.file_path}")
+        title_ids = to_upload['title_id'].astype(float).astype('int64').tolist()
+        # Missing titles are empty strings, as they are when stage 3 reads the sheet back from CSV
+        titles = to_upload[title_header].fillna('').astype(str).tolist()
+        safe = []
+        for start in range(0, len(to_upload), batch_size):
+            safe.extend(check_title_id_query_API.check_titles(title_ids[start:start + batch_size],
+                                                              titles[start:start + batch_size], title_lookup))
+        safe = pd.Series(safe, index=to_upload.index, dtype=bool)
+        not_safe = to_upload[~safe]
+        if title_index is not None:
+            not_safe = check_title_id_query_API.add_suggestions(not_safe, title_header, title_index)
+        sheet.results = {'to_check': sheet.to_check, 'safe': to_upload[safe], 'not_safe': not_safe}
+        sheet.to_check = sheet.to_upload = None
+
+    if file_list is None:
+        file_list = sorted(glob.glob(os.path.join(input_dir, '*.xlsx')))
+    # Skip temporary files
+    file_list = [file_path for file_path in file_list if not os.path.basename(file_path).startswith('~$')]
+    if schemas is None:
+        # Read only the header row of each sheet first, and report the sheets that can't be processed all together
+        schemas = sniff_sheets(file_list, 'pipeline' if update_ids else 'pipeline_post_migration')
+        summary['unprocessable'] = report_unprocessable(schemas, output_dir)
+    file_list = [file_path for file_path in file_list if schemas[file_path].processable]
+    # The manifest is only read and written from this thread, so the sheets already done are skipped here, before
+    # the stages start
+    to_process = []
+    for file_path in file_list:
+        try:
+            done = state.is_done(file_path)
+        except OSError as e:
+            # e.g. the sheet was removed after its header was read
+            summary['failed'][file_path] = repr(e)
+            print(f"Error processing {file_path}: {summary['failed'][file_path]}")
+            continue
+        if done:
+            print(f"{file_path} has already been processed, skipping...")
+            summary['skipped'].append(file_path)
+            continue
+        to_process.append(file_path)
+    parse_queue, clean_queue, check_queue, done_queue = (queue.Queue(maxsize=queue_size) for _ in range(4))
+    threads = [
+        threading.Thread(target=_run_stage, args=('update_trove_id', read_and_update_ids, parse_queue, clean_queue), daemon=True),
+        threading.Thread(target=_run_stage, args=('clean_and_check', clean_and_check, clean_queue, check_queue), daemon=True),
+        threading.Thread(target=_run_stage, args=('check_title_id', check_titles, check_queue, done_queue), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    def feed():
+        try:
+            for file_path in to_process:
+                parse_queue.put(SheetBatch(file_path, schemas[file_path]))
+        finally:
+            # Always end the stream, so the stages and the loop below finish even if feeding stops early
+            parse_queue.put(_DONE)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    # The sheets added to the dataset but not committed yet, by sheet name
+    pending = {}
+
+    def mark_committed(sheet_names):
+        for name in sheet_names:
+            file_path = pending.pop(name)
+            state.mark_done(file_path, sum(summary['processed'][file_path].values()))
+
+    # Write the outputs of each sheet as it comes out of the last stage; the outputs and the manifest are only
+    # written from this thread
+    while True:
+        sheet = done_queue.get()
+        if sheet is _DONE:
+            break
+        if sheet.error is not None:
+            print(f"Error processing {sheet.file_path}: {sheet.error}")
+            summary['failed'][sheet.file_path] = sheet.error
+            continue
+        timings = ', '.join(f"{name} {seconds:.2f}s" for name, seconds in sheet.seconds.items())
+        print(f"finished {sheet.file_path} ({timings})")
+        summary['processed'][sheet.file_path] = {status: len(rows) for status, rows in sheet.results.items()}
+        if dataset is None:
+            for status, suffix in [('to_check', '_sheet_to_check'), ('safe', '_safe_upload'),
+                                   ('not_safe', '_not_safe_upload')]:
+                _write_output(sheet.results[status], output_dir, sheet.base_name + suffix, output_format)
+            state.mark_done(sheet.file_path, sum(summary['processed'][sheet.file_path].values()))
+            continue
+        for status, rows in sheet.results.items():
+            dataset.add(rows, sheet.base_name, status)
+        pending[sheet.base_name] = sheet.file_path
+        mark_committed(dataset.commit_if_full())
+    feeder.join()
+    for thread in threads:
+        thread.join()
+    if article_index is not None:
+        article_index.close()
+    if dataset is not None:
+        mark_committed(dataset.commit())
+        if ingest_json:
+            print(f"wrote {dataset.export_ingest_json(ingest_json)} records to {ingest_json}")
+
+    print(f"Processed {len(summary['processed'])} sheets, skipped {len(summary['skipped'])}, "
+          f"failed {len(summary['failed'])}, unprocessable {len(summary['unprocessable'])}")
+    return summary
+
+
+def main():
+    # The options are parsed by tbc.py, so that they are shared with 'tbc.py pipeline'
+    tbc.main(['pipeline'] + sys.argv[1:])
+
+
+if __name__ == "__main__":
+    main()
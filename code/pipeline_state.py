@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# Functionality to record which sheets each stage of the pipeline has processed, so reruns only
+# process new or changed sheets and a partly processed sheet can resume where it stopped.
+
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+
+
+def file_sha256(file_path: str) -> str:
+    """Returns the sha256 hex digest of a file's content, reading it in 1MB blocks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# The process umask, read once (os.umask can only be read by setting it)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def replace_file(temp_path: str, file_path: str) -> None:
+    """
+    Renames a temporary file over file_path. mkstemp creates the temporary file readable by its owner only, so it is
+    first given the mode file_path already has, or the mode a newly created file would get (0666 less the umask).
+    """
+    try:
+        mode = os.stat(file_path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o666 & ~_UMASK
+    os.chmod(temp_path, mode)
+    os.replace(temp_path, file_path)
+
+
+@contextlib.contextmanager
+def atomic_write(file_path: str):
+    """
+    Yields a temporary path in the same folder as file_path. If the block finishes without an error the temporary
+    file is renamed over file_path, so readers only ever see the old or the complete new file.
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(file_path), suffix='.tmp')
+    os.close(fd)
+    try:
+        yield temp_path
+        replace_file(temp_path, file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class PipelineState:
+    """
+    A manifest of the sheets a stage has processed, stored as JSON in the stage's output folder.
+
+    Each entry is keyed by the input path and records the input's size, mtime and sha256 hash, the version (sha256)
+    of the mappings JSON the stage used, and either 'done' or the number of rows committed so far along with the
+    sizes of the output files at that point. The manifest is rewritten atomically after every change.
+
+    Parameters:
+    output_dir (str): The folder the stage writes its outputs to.
+    stage (str): The name of the stage, used to name the manifest file.
+    mappings_path (str): The path to the mappings JSON used by the stage, if any. Sheets processed with a different
+    version of the mappings are processed again.
+    mappings_version (str): The sha256 of the mappings JSON, if it is already known (e.g. from the mappings index).
+    read_only (bool): Never rewrite the manifest (for a dry run).
+    """
+
+    def __init__(self, output_dir: str, stage: str, mappings_path=None, mappings_version=None, read_only=False):
+        self.path = os.path.join(output_dir, f'.{stage}_manifest.json')
+        if mappings_version is None and mappings_path:
+            mappings_version = file_sha256(mappings_path)
+        self.mappings_version = mappings_version
+        self.read_only = read_only
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as json_file:
+                self.entries = json.load(json_file)
+
+    def save(self) -> None:
+        if self.read_only:
+            return
+        with atomic_write(self.path) as temp_path:
+            with open(temp_path, 'w') as json_file:
+                json.dump(self.entries, json_file, indent=1, sort_keys=True)
+
+    def _key(self, input_path: str) -> str:
+        return os.path.abspath(input_path)
+
+    def _matching_entry(self, input_path: str) -> dict:
+        """
+        Returns the manifest entry for input_path if it was made from the same content and mappings, otherwise None.
+        The file is only hashed if its size or mtime has changed since the entry was made.
+        """
+        entry = self.entries.get(self._key(input_path))
+        if entry is None or entry.get('mappings_version') != self.mappings_version:
+            return None
+        stat = os.stat(input_path)
+        if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry
+        if entry['size'] != stat.st_size or entry['sha256'] != file_sha256(input_path):
+            return None
+        # Same content with a new mtime (e.g. the file was copied again), so remember the new mtime
+        entry['mtime'] = stat.st_mtime
+        self.save()
+        return entry
+
+    def is_done(self, input_path: str) -> bool:
+        """Returns True if input_path has already been fully processed with the current mappings."""
+        entry = self._matching_entry(input_path)
+        return entry is not None and entry['status'] == 'done'
+
+    def progress(self, input_path: str) -> tuple:
+        """
+        Returns (rows_committed, output_sizes) for a partly processed input_path, or (0, {}) if it has to start over.
+        output_sizes maps each output path to its size in bytes at the last committed batch.
+        """
+        entry = self._matching_entry(input_path)
+        if entry is None or entry['status'] != 'partial':
+            return 0, {}
+        return entry['rows'], entry['outputs']
+
+    def _record(self, input_path: str, status: str, rows: int, outputs: dict) -> None:
+        stat = os.stat(input_path)
+        previous = self.entries.get(self._key(input_path), {})
+        # Only hash the input once per content, a batch commit should not re-read the whole sheet
+        if previous.get('size') == stat.st_size and previous.get('mtime') == stat.st_mtime:
+            sha256 = previous['sha256']
+        else:
+            sha256 = file_sha256(input_path)
+        self.entries[self._key(input_path)] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': sha256,
+            'mappings_version': self.mappings_version,
+            'status': status,
+            'rows': rows,
+            'outputs': outputs,
+        }
+        self.save()
+
+    def commit_batch(self, input_path: str, rows: int, output_paths) -> None:
+        """Records that the first rows rows of input_path have been written to output_paths."""
+        outputs = {path: os.path.getsize(path) for path in output_paths if os.path.exists(path)}
+        self._record(input_path, 'partial', rows, outputs)
+
+    def mark_done(self, input_path: str, rows=None, output_paths=()) -> None:
+        """Records that input_path has been fully processed."""
+        outputs = {path: os.path.getsize(path) for path in output_paths if os.path.exists(path)}
+        self._record(input_path, 'done', rows, outputs)
+
+
+def truncate_outputs(output_paths, output_sizes: dict) -> None:
+    """
+    Cuts each output file back to the size it had at the last committed batch, removing any rows written after it.
+    Output files that did not exist at the last committed batch are removed.
+    """
+    for path in output_paths:
+        if not os.path.exists(path):
+            continue
+        if path in output_sizes:
+            with open(path, 'r+b') as f:
+                f.truncate(output_sizes[path])
+        else:
+            os.remove(path)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# Functionality to split the rows of a sheet between several output files (e.g. safe / not safe uploads)
+# without rebuilding a DataFrame for every row: rows are buffered per output and written in chunks.
+
+import os
+import tempfile
+
+import pandas as pd
+
+from pipeline_state import replace_file
+from table_io import apply_schema, pa, pq
+
+DEFAULT_FLUSH_ROWS = 10000
+
+
+class _OutputWriter:
+    """Writes the chunks of one output file in its format, to a temporary file unless it appends to a CSV file."""
+
+    def __init__(self, path: str, table_format: str, append: bool):
+        self.path = path
+        self.table_format = table_format
+        self.append = append
+        self.rows = 0
+        self.temp_path = None
+        self._file = None
+        self._header = False
+        self._writer = None
+        self._schema = None
+
+    def _open(self) -> None:
+        if self.append:
+            self._file = open(self.path, 'a', newline='')
+            self._header = self._file.tell() == 0
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, self.temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(self.path), suffix='.tmp')
+        if self.table_format == 'csv':
+            self._file = os.fdopen(fd, 'w', newline='')
+            self._header = True
+        else:
+            os.close(fd)
+
+    def write(self, df: pd.DataFrame) -> None:
+        if self._file is None and self.temp_path is None:
+            self._open()
+        if self.table_format == 'csv':
+            df.to_csv(self._file, index=False, header=self._header)
+            self._header = False
+        else:
+            table = pa.Table.from_pandas(apply_schema(df), preserve_index=False)
+            if self._writer is None:
+                # Every later chunk is written with the first chunk's schema
+                self._schema = table.schema
+                if self.table_format == 'parquet':
+                    self._writer = pq.ParquetWriter(self.temp_path, self._schema, compression='zstd')
+                else:
+                    self._writer = pa.ipc.new_file(self.temp_path, self._schema)
+            elif not table.schema.equals(self._schema):
+                table = table.cast(self._schema)
+            self._writer.write_table(table)
+        self.rows += len(df)
+
+    def flush(self) -> None:
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def commit(self) -> None:
+        """Moves the temporary file into place, or removes a stale output if no rows were written."""
+        self.close()
+        if self.temp_path is not None:
+            replace_file(self.temp_path, self.path)
+            self.temp_path = None
+        elif not self.append and not self.rows and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def abort(self) -> None:
+        self.close()
+        if self.temp_path is not None and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        self.temp_path = None
+
+
+class ResultSink:
+    """
+    Collects the rows of a sheet that are routed to several outputs and writes them in chunks.
+
+    Rows are added as DataFrames (slices of the sheet) and kept in a list per output. Once flush_rows rows are
+    buffered in total, every output's buffered rows are concatenated and written in one go, so memory stays bounded
+    however large the sheet is and no output is rebuilt row by row.
+
+    By default each output is written to a temporary file that is moved into place when the sink is closed, and an
+    output that received no rows is not written (a stale file from an earlier run is removed). With append, rows are
+    appended to the CSV outputs instead and each file's header is only written when the file is new, so a caller
+    can commit what was flushed (see PipelineState.commit_batch) and resume later.
+    Used as a context manager, the sink is closed when the block finishes and its temporary files are removed
+    if the block raises an error.
+
+    Parameters:
+    output_paths (dict): The path of each output, by name (e.g. {'safe': ..., 'not_safe': ...}).
+    table_format (str): The format to write: 'csv', 'parquet' or 'arrow' (see table_io).
+    flush_rows (int): The number of buffered rows (across all outputs) that triggers a flush.
+    append (bool): Append to the outputs instead of replacing them. Only supported for CSV.
+    """
+
+    def __init__(self, output_paths: dict, table_format='csv', flush_rows=DEFAULT_FLUSH_ROWS, append=False):
+        if append and table_format != 'csv':
+            raise ValueError(f"Only csv outputs can be appended to, not {table_format}")
+        self.output_paths = dict(output_paths)
+        self.flush_rows = flush_rows
+        self._writers = {name: _OutputWriter(path, table_format, append) for name, path in self.output_paths.items()}
+        self._buffers = {name: [] for name in self.output_paths}
+        self.buffered_rows = 0
+
+    def add(self, name: str, rows: pd.DataFrame) -> None:
+        """Adds rows to the named output, flushing if enough rows are buffered."""
+        if rows.empty:
+            return
+        self._buffers[name].append(rows)
+        self.buffered_rows += len(rows)
+        if self.buffered_rows >= self.flush_rows:
+            self.flush()
+
+    def route(self, rows: pd.DataFrame, mask, if_true: str, if_false: str) -> None:
+        """Adds the rows where mask is True to the output if_true and the other rows to the output if_false."""
+        mask = pd.Series(mask, index=rows.index, dtype=bool)
+        self.add(if_true, rows[mask])
+        self.add(if_false, rows[~mask])
+
+    def flush(self) -> None:
+        """Writes every output's buffered rows."""
+        for name, buffer in self._buffers.items():
+            if buffer:
+                self._writers[name].write(buffer[0] if len(buffer) == 1 else pd.concat(buffer))
+                buffer.clear()
+            self._writers[name].flush()
+        self.buffered_rows = 0
+
+    def rows_written(self, name: str) -> int:
+        return self._writers[name].rows
+
+    def written_paths(self) -> list:
+        """Returns the paths of the outputs that have received rows in this sink."""
+        return [writer.path for writer in self._writers.values() if writer.rows]
+
+    def close(self) -> list:
+        """
+        Flushes the remaining rows and moves the outputs into place.
+
+        Returns:
+        list: The paths of the outputs that received rows in this sink.
+        """
+        self.flush()
+        for writer in self._writers.values():
+            writer.commit()
+        return self.written_paths()
+
+    def abort(self) -> None:
+        """Drops the buffered rows and removes the temporary files."""
+        for name in self._buffers:
+            self._buffers[name].clear()
+            self._writers[name].abort()
+        self.buffered_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
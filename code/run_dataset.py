@@ -0,0 +1,238 @@
+"""
+This module collects the outputs of a whole run in one dataset, instead of a few small files per sheet.
+Every row carries its provenance and outcome in three extra columns:
+- 'source_sheet': the name of the sheet the row came from (without extension or stage suffixes),
+- 'row_index': the row's position among the data rows of that sheet (0 is the first row under the header),
+- 'status': where the row ended up, e.g. 'to_check', 'to_upload', 'safe' or 'not_safe'.
+The rows are stored in part files partitioned by status (<dataset>/status=safe/part-00001.parquet), each part
+holding the rows of many sheets. New parts are appended by commit(): the parts are written to temporary files and
+moved into place, and only then recorded in the dataset's manifest ('_dataset.json', itself replaced atomically),
+so readers never see half a commit. A sheet that is committed again (e.g. after it changed) replaces its earlier
+rows, and parts left with no current rows are removed.
+
+The safe rows can be exported straight to the JSON the API ingests (export_ingest_json), which replaces the
+separate combine_safe_files.py / convert_json.py pass.
+Only one process should write to a dataset at a time.
+"""
+
+import argparse
+import json
+import os
+
+import pandas as pd
+
+from pipeline_state import atomic_write
+from table_io import EXTENSIONS, SCHEMA, read_table, resolve_format, write_table
+
+PROVENANCE_COLUMNS = ['source_sheet', 'row_index', 'status']
+
+MANIFEST_NAME = '_dataset.json'
+
+DEFAULT_PART_ROWS = 100000
+
+# The columns read back from CSV parts as strings rather than with inferred types
+CSV_DTYPES = {'source_sheet': str, 'status': str,
+              **{column: str for column, dtype in SCHEMA.items() if dtype == 'string'}}
+
+# Stage suffixes stripped from a file name to get the name of the sheet it came from
+SHEET_SUFFIXES = ['_not_safe_upload', '_safe_upload', '_sheet_to_upload', '_sheet_to_check', '_UPDATED_MAPPING']
+
+
+def sheet_name(file_path: str) -> str:
+    """Returns the name of the sheet a file of any stage came from, e.g. 'a_UPDATED_MAPPING_sheet_to_upload.csv' -> 'a'."""
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    stripped = True
+    while stripped:
+        stripped = False
+        for suffix in SHEET_SUFFIXES:
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+                stripped = True
+    return name
+
+
+class RunDataset:
+    """
+    A run-wide dataset of output rows, partitioned by status (see the module docstring).
+
+    Rows are added per sheet with add() and buffered in memory until commit() writes them as one new part per status.
+    commit_if_full() commits once part_rows rows are buffered, so a caller can commit between sheets and mark the
+    committed sheets as done.
+
+    Parameters:
+    root_dir (str): The folder of the dataset. It is created if it does not exist.
+    table_format (str): The format of new parts: 'csv', 'parquet' or 'arrow' (see table_io).
+    part_rows (int): The number of buffered rows after which commit_if_full commits.
+    """
+
+    def __init__(self, root_dir: str, table_format='parquet', part_rows=DEFAULT_PART_ROWS):
+        self.root_dir = root_dir
+        self.table_format = resolve_format(table_format)
+        self.part_rows = part_rows
+        os.makedirs(root_dir, exist_ok=True)
+        self.manifest_path = os.path.join(root_dir, MANIFEST_NAME)
+        self.manifest = {'next_commit': 1, 'parts': {}, 'sheets': {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as json_file:
+                self.manifest = json.load(json_file)
+        self._buffers = {}
+        self._pending_sheets = []
+        self.buffered_rows = 0
+
+    def add(self, rows: pd.DataFrame, source_sheet: str, status: str, row_index=None) -> None:
+        """
+        Adds a sheet's rows with the given status. row_index defaults to the rows' index, which is their position
+        in the sheet when the rows were selected from the whole sheet. A sheet is recorded even if it adds no rows,
+        so that committing it replaces any rows it had before.
+        """
+        if source_sheet not in self._pending_sheets:
+            self._pending_sheets.append(source_sheet)
+        if rows.empty:
+            return
+        rows = rows.copy()
+        rows.insert(0, 'status', status)
+        rows.insert(0, 'row_index', rows.index if row_index is None else list(row_index))
+        rows.insert(0, 'source_sheet', source_sheet)
+        self._buffers.setdefault(status, []).append(rows)
+        self.buffered_rows += len(rows)
+
+    def commit(self) -> list:
+        """
+        Writes the buffered rows as one new part per status and records them (and the sheets they came from) in the
+        manifest.
+
+        Returns:
+        list: The sheets that were committed.
+        """
+        if not self._pending_sheets:
+            return []
+        commit_id = self.manifest['next_commit']
+        parts = {}
+        for status, frames in self._buffers.items():
+            relative_path = os.path.join(f'status={status}', f'part-{commit_id:05d}{EXTENSIONS[self.table_format]}')
+            os.makedirs(os.path.join(self.root_dir, f'status={status}'), exist_ok=True)
+            rows = pd.concat(frames, ignore_index=True)
+            with atomic_write(os.path.join(self.root_dir, relative_path)) as temp_path:
+                write_table(rows, temp_path, self.table_format)
+            parts[relative_path] = {'status': status, 'rows': len(rows), 'commit': commit_id,
+                                    'sheets': sorted(rows['source_sheet'].unique().tolist())}
+
+        committed = self._pending_sheets
+        self.manifest['parts'].update(parts)
+        for source_sheet in committed:
+            self.manifest['sheets'][source_sheet] = commit_id
+        self.manifest['next_commit'] = commit_id + 1
+        stale = [path for path, part in self.manifest['parts'].items()
+                 if not any(self.manifest['sheets'].get(sheet) == part['commit'] for sheet in part['sheets'])]
+        for path in stale:
+            del self.manifest['parts'][path]
+        self._save()
+        # The manifest no longer lists the stale parts, so they can go
+        for path in stale:
+            if os.path.exists(os.path.join(self.root_dir, path)):
+                os.remove(os.path.join(self.root_dir, path))
+
+        self._buffers = {}
+        self._pending_sheets = []
+        self.buffered_rows = 0
+        return committed
+
+    def commit_if_full(self) -> list:
+        """Commits if at least part_rows rows are buffered, returning the committed sheets (or an empty list)."""
+        return self.commit() if self.buffered_rows >= self.part_rows else []
+
+    def _save(self) -> None:
+        with atomic_write(self.manifest_path) as temp_path:
+            with open(temp_path, 'w') as json_file:
+                json.dump(self.manifest, json_file, indent=1, sort_keys=True)
+
+    def sheets(self) -> list:
+        """Returns the committed sheets."""
+        return sorted(self.manifest['sheets'])
+
+    def iter_parts(self, status=None, columns=None):
+        """
+        Yields the current rows of each committed part as a DataFrame, skipping rows of sheets that were committed
+        again later. status limits the parts to one status; columns limits the columns read.
+        """
+        for relative_path, part in sorted(self.manifest['parts'].items()):
+            if status is not None and part['status'] != status:
+                continue
+            read_columns = None if columns is None else list(dict.fromkeys(['source_sheet', *columns]))
+            rows = read_table(os.path.join(self.root_dir, relative_path), columns=read_columns, dtype=CSV_DTYPES)
+            current = rows['source_sheet'].map(self.manifest['sheets']) == part['commit']
+            rows = rows[current.to_numpy()]
+            yield rows if columns is None else rows[columns]
+
+    def read(self, status=None, columns=None) -> pd.DataFrame:
+        """Returns the current rows of the dataset (of one status, if given) as one DataFrame."""
+        frames = list(self.iter_parts(status, columns))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+
+    def summary(self) -> dict:
+        """Returns the number of current rows per status."""
+        counts = {}
+        for rows in self.iter_parts(columns=['status']):
+            for status, count in rows['status'].value_counts().items():
+                counts[status] = counts.get(status, 0) + int(count)
+        return counts
+
+    def export_ingest_json(self, output_path: str, status='safe', provenance=False) -> int:
+        """
+        This function writes the rows of one status as the JSON array of records the API ingests: null (and empty)
+        values are left out of each record and the id columns are written as integers. The records are written part by part,
+        and the file is replaced atomically.
+
+        Parameters:
+        output_path (str): The path of the JSON file.
+        status (str): The status of the rows to export.
+        provenance (bool): Keep the 'source_sheet' and 'row_index' columns in the records.
+
+        Returns:
+        int: The number of records written.
+        """
+        id_columns = [column for column, dtype in SCHEMA.items() if dtype == 'Int64']
+        count = 0
+        with atomic_write(output_path) as temp_path:
+            with open(temp_path, 'w') as json_file:
+                json_file.write('[')
+                for rows in self.iter_parts(status):
+                    rows = rows.drop(columns=['status'] if provenance else PROVENANCE_COLUMNS)
+                    for record in rows.to_dict('records'):
+                        record = {key: value for key, value in record.items() if not _is_null(value)}
+                        for column in id_columns:
+                            if column in record:
+                                record[column] = int(float(record[column]))
+                        json_file.write(',\n' if count else '\n')
+                        json_file.write(json.dumps(record))
+                        count += 1
+                json_file.write('\n]\n')
+        return count
+
+
+def _is_null(value) -> bool:
+    # Empty strings count as null, as they did when the safe CSV files were read back and combined
+    if isinstance(value, str):
+        return value == ''
+    return value is None or pd.isna(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarise a run dataset or export its safe rows for the API ingest.')
+    parser.add_argument('dataset_dir')
+    parser.add_argument('--export-json', help='write the rows of --status to this JSON file for the API ingest')
+    parser.add_argument('--status', default='safe', help='the status of the rows to export')
+    parser.add_argument('--provenance', action='store_true', help="keep 'source_sheet' and 'row_index' in the export")
+    args = parser.parse_args()
+
+    dataset = RunDataset(args.dataset_dir)
+    print(f"{len(dataset.sheets())} sheets")
+    for status, count in sorted(dataset.summary().items()):
+        print(f"{status}: {count} rows")
+    if args.export_json:
+        count = dataset.export_ingest_json(args.export_json, args.status, args.provenance)
+        print(f"wrote {count} records to {args.export_json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# Reads only the header row of each sheet (an Excel file, or a CSV / Parquet / Arrow table) to find its canonical
+# columns and classify its layout, so that the sheets a stage can't process are reported together, up front,
+# instead of being found one by one after each has been parsed.
+
+import argparse
+import glob
+import os
+import re
+
+import pandas as pd
+
+import metrics
+from pipeline_state import atomic_write
+from table_io import table_columns, table_files
+from xlsx_readers import read_header
+
+# Sheets created prior to June 2022 have stray data after the 33rd column, which is not read
+LEGACY_COLUMNS = 33
+
+# How each canonical column is found in a header: a regular expression (case-insensitive) searched for in the column
+# names in sheet order, or a tuple of the exact names it may have, in order of preference
+CANONICAL_COLUMNS = {
+    'article_id': ('article_id',),
+    'trove_id': r'trove[_\s]ID',
+    'title_id': ('title_id',),
+    'trove_title': ('Trove Title', 'trove title', 'Trove_Title', 'trove_title'),
+    'chapter_number': r'chapter[_\s]number',
+    'chapter_title': r'chapter[_\s]title',
+}
+
+# The canonical columns each stage needs; a sheet missing one of them can't be processed by the stage
+REQUIRED_COLUMNS = {
+    'update_trove_id': ['trove_id'],
+    'clean_and_check': ['title_id'],
+    'check_title_id': ['title_id', 'trove_title'],
+    'pipeline': ['trove_id', 'trove_title'],
+    'pipeline_post_migration': ['title_id', 'trove_title'],
+}
+
+# The stages that read Excel sheets with the Trove ID column, and so only the first LEGACY_COLUMNS of a legacy sheet
+LEGACY_STAGES = {'update_trove_id', 'pipeline'}
+
+# The file the unprocessable sheets are listed in, in a stage's output folder
+REPORT_NAME = 'column_not_found.txt'
+
+
+class ColumnResolver:
+    """
+    Finds the canonical columns in a header with precompiled patterns. A run sees the same few headers again and
+    again, so the columns found for each header signature (the tuple of its column names) are remembered.
+
+    Parameters:
+    canonical_columns (dict): How each canonical column is found (see CANONICAL_COLUMNS).
+    """
+
+    def __init__(self, canonical_columns=CANONICAL_COLUMNS):
+        self._rules = []
+        for canonical, rule in canonical_columns.items():
+            if isinstance(rule, str):
+                rule = re.compile(rule, re.IGNORECASE)
+            self._rules.append((canonical, rule))
+        self._cache = {}
+
+    def resolve(self, header) -> dict:
+        """
+        This function finds the canonical columns in a header.
+
+        Parameters:
+        header (list): The column names.
+
+        Returns:
+        dict: The name of each canonical column found in the header, by canonical name.
+        """
+        signature = tuple(header)
+        columns = self._cache.get(signature)
+        if columns is not None:
+            return columns
+        columns = {}
+        for canonical, rule in self._rules:
+            if isinstance(rule, tuple):
+                column = next((name for name in rule if name in signature), None)
+            else:
+                column = next((name for name in signature if rule.search(str(name))), None)
+            if column is not None:
+                columns[canonical] = column
+        self._cache[signature] = columns
+        return columns
+
+
+# The resolver shared by every stage
+resolver = ColumnResolver()
+
+
+def resolve_columns(header) -> dict:
+    """Returns the name of each canonical column found in a header, by canonical name (see ColumnResolver)."""
+    return resolver.resolve(list(header))
+
+
+def sheet_layout(width: int, columns: dict) -> str:
+    """
+    Classifies a sheet by its layout:
+    - 'pre_june_2022': wider than LEGACY_COLUMNS columns, as the sheets created prior to June 2022 are.
+    - 'pre_migration': a Trove ID column and no title_id, so the Trove IDs need updating (stage 1).
+    - 'post_migration': a title_id column and no Trove ID, as the sheets created after the migration have.
+    - 'updated': both, as the '_UPDATED_MAPPING' files stage 1 writes have.
+    - 'unknown': neither.
+    """
+    if width > LEGACY_COLUMNS:
+        return 'pre_june_2022'
+    if 'title_id' in columns:
+        return 'updated' if 'trove_id' in columns else 'post_migration'
+    return 'pre_migration' if 'trove_id' in columns else 'unknown'
+
+
+class SheetSchema:
+    """
+    What a stage needs to know about a sheet before reading it, from its header row alone.
+
+    Attributes:
+    file_path (str): The path to the sheet.
+    header (list): The column names, as the sheet would be read.
+    columns (dict): The name of each canonical column found, by canonical name.
+    layout (str): The layout of the sheet (see sheet_layout).
+    usecols (range): The column positions the stage reads, or None for all of them.
+    missing (list): The canonical columns the stage needs that the sheet does not have.
+    error (str): Why the header could not be read, or None.
+    """
+
+    def __init__(self, file_path, header, columns, layout, usecols=None, missing=(), error=None):
+        self.file_path = file_path
+        self.header = header
+        self.columns = columns
+        self.layout = layout
+        self.usecols = usecols
+        self.missing = list(missing)
+        self.error = error
+
+    @property
+    def processable(self) -> bool:
+        return self.error is None and not self.missing
+
+    def problem(self) -> str:
+        """Describes why the sheet can't be processed, or returns None if it can."""
+        if self.error is not None:
+            return f"could not read the header: {self.error}"
+        if self.missing:
+            return f"no {', '.join(self.missing)} column (columns: {', '.join(str(name) for name in self.header)})"
+        return None
+
+
+def sniff_sheet(file_path: str, stage: str, sheet_name='Sheet1') -> SheetSchema:
+    """
+    This function reads the header row of a sheet and works out its canonical columns, its layout, the columns the
+    stage reads and any canonical columns the stage needs that are missing.
+
+    Parameters:
+    file_path (str): The path to an Excel file or a table file (see table_io).
+    stage (str): The stage the sheet is for, one of REQUIRED_COLUMNS.
+    sheet_name (str): The sheet of an Excel file to read.
+
+    Returns:
+    SheetSchema: The schema of the sheet.
+    """
+    try:
+        if file_path.lower().endswith('.xlsx'):
+            header, width = read_header(file_path, sheet_name)
+        else:
+            try:
+                header = table_columns(file_path)
+            except pd.errors.EmptyDataError:
+                header = []
+            width = len(header)
+    except Exception as e:
+        return SheetSchema(file_path, [], {}, 'unknown', error=repr(e))
+    usecols = None
+    if stage in LEGACY_STAGES and width > LEGACY_COLUMNS:
+        # Read only up to the 33rd column, this is only for the sheets created prior to June_2022
+        usecols = range(LEGACY_COLUMNS)
+        header = header[:LEGACY_COLUMNS]
+    columns = resolve_columns(header)
+    missing = [column for column in REQUIRED_COLUMNS[stage] if column not in columns]
+    return SheetSchema(file_path, header, columns, sheet_layout(width, columns), usecols, missing)
+
+
+def sniff_sheets(file_paths, stage: str, sheet_name='Sheet1') -> dict:
+    """Returns the SheetSchema of each sheet, by path (see sniff_sheet)."""
+    with metrics.timer('schema_sniff', stage=stage) as timer:
+        schemas = {file_path: sniff_sheet(file_path, stage, sheet_name) for file_path in file_paths}
+        timer.rows = len(schemas)
+    return schemas
+
+
+def report_unprocessable(schemas: dict, output_dir: str) -> dict:
+    """
+    This function lists the sheets that can't be processed, all together, on the console and in a
+    'column_not_found.txt' file in output_dir (which is removed when every sheet can be processed).
+
+    Parameters:
+    schemas (dict): The SheetSchema of each sheet, by path.
+    output_dir (str): The stage's output folder.
+
+    Returns:
+    dict: Why each unprocessable sheet can't be processed, by path.
+    """
+    problems = {file_path: schema.problem() for file_path, schema in schemas.items() if not schema.processable}
+    report_path = os.path.join(output_dir, REPORT_NAME)
+    if not problems:
+        if os.path.exists(report_path):
+            os.remove(report_path)
+        return problems
+    print(f"{len(problems)} of {len(schemas)} sheets can't be processed and will be skipped (see {report_path}):")
+    for file_path, problem in problems.items():
+        print(f"  {file_path}: {problem}")
+    with atomic_write(report_path) as temp_path:
+        with open(temp_path, 'w') as report_file:
+            for file_path, problem in problems.items():
+                report_file.write(f"{file_path}: {problem}\n")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify a folder of sheets from their header rows and list the "
+                                                 "sheets a stage can't process.")
+    parser.add_argument('input_dir')
+    parser.add_argument('--stage', choices=sorted(REQUIRED_COLUMNS), default='update_trove_id',
+                        help='the stage whose required columns are checked')
+    parser.add_argument('--report', metavar='OUTPUT_DIR', help='also write column_not_found.txt to this folder')
+    args = parser.parse_args()
+
+    file_paths = sorted(glob.glob(os.path.join(args.input_dir, '*.xlsx'))) + table_files(args.input_dir)
+    file_paths = [file_path for file_path in file_paths if not os.path.basename(file_path).startswith('~$')]
+    schemas = sniff_sheets(file_paths, args.stage)
+    layouts = {}
+    for schema in schemas.values():
+        layouts[schema.layout] = layouts.get(schema.layout, 0) + 1
+    print(f"{len(schemas)} sheets: " + ', '.join(f"{count} {layout}" for layout, count in sorted(layouts.items())))
+    if args.report:
+        report_unprocessable(schemas, args.report)
+    else:
+        for file_path, schema in schemas.items():
+            if not schema.processable:
+                print(f"  {file_path}: {schema.problem()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# A local stub of the readallaboutit.com.au title api (/api/v1/title/{id}, /api/v1/titles?ids=1,2,3 and the
+# /api/v1/titles/export?since=... bulk export) for testing
+# 3_check_title_id_query_API.py without hitting the real server.
+
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+TITLE_PATH = re.compile(r'^/api/v1/title/(\d+)/?$')
+BATCH_PATH = re.compile(r'^/api/v1/titles/?$')
+EXPORT_PATH = re.compile(r'^/api/v1/titles/export/?$')
+
+
+class StubTitleHandler(BaseHTTPRequestHandler):
+    """
+    Serves title records from the server's 'records' dict with an ETag, answering a matching If-None-Match with 304.
+    Unknown title_ids return 404.
+    If the server's 'fail_first' is set, the first fail_first requests for each title_id are answered with 'fail_status'
+    (e.g. 429 or 503), so retry and backoff behaviour can be exercised.
+    If the server's 'latency' is set, every response is delayed by that many seconds, like a remote server.
+    If the server's 'batch' is set, /api/v1/titles?ids=1,2,3 returns the records of several title_ids as a JSON list
+    (leaving out unknown title_ids); otherwise it returns 404, like a server without a multi-id endpoint.
+    /api/v1/titles/export returns every record as a JSON list, or with ?since=... only the records whose 'updated_at'
+    is at or after since.
+    """
+
+    def do_GET(self):
+        if BATCH_PATH.match(urlsplit(self.path).path):
+            self.get_batch()
+            return
+        if EXPORT_PATH.match(urlsplit(self.path).path):
+            self.get_export()
+            return
+        match = TITLE_PATH.match(self.path)
+        if not match:
+            self.send_error(404)
+            return
+        title_id = int(match.group(1))
+
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            server.request_count += 1
+            attempts = server.attempts.get(title_id, 0) + 1
+            server.attempts[title_id] = attempts
+        if attempts <= server.fail_first:
+            self.send_error(server.fail_status)
+            return
+
+        record = server.records.get(title_id)
+        if record is None:
+            self.send_error(404)
+            return
+        body = json.dumps(record).encode()
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_batch(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            server.batch_request_count += 1
+        if not server.batch:
+            self.send_error(404)
+            return
+        if server.latency:
+            time.sleep(server.latency)
+        ids = ','.join(parse_qs(urlsplit(self.path).query).get('ids', []))
+        try:
+            title_ids = [int(title_id) for title_id in ids.split(',') if title_id]
+        except ValueError:
+            self.send_error(400)
+            return
+        body = json.dumps([server.records[title_id] for title_id in title_ids if title_id in server.records]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_export(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+        since = parse_qs(urlsplit(self.path).query).get('since', [None])[0]
+        records = [record for record in server.records.values()
+                   if since is None or str(record.get('updated_at', '')) >= since]
+        body = json.dumps(records).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep the console quiet, the request counts are kept on the server instead
+        pass
+
+
+def start_stub_server(records: dict, host='127.0.0.1', port=0, fail_first=0, fail_status=503, latency=0.0,
+                      batch=True):
+    """
+    Starts a stub title api in a background thread.
+
+    Parameters:
+    records (dict): Title records keyed by title_id (int), e.g. {1: {'id': 1, 'publication_title': ..., 'common_title': ...}}.
+    host (str): The interface to listen on.
+    port (int): The port to listen on. 0 picks a free port.
+    fail_first (int): The number of requests for each title_id to fail before the record is returned.
+    fail_status (int): The status code to fail with.
+    latency (float): The delay in seconds before each response.
+    batch (bool): Serve the multi-id endpoint /api/v1/titles?ids=...
+
+    Returns:
+    tuple: (server, base_url). Call server.shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), StubTitleHandler)
+    server.daemon_threads = True
+    server.records = records
+    server.fail_first = fail_first
+    server.fail_status = fail_status
+    server.latency = latency
+    server.batch = batch
+    server.attempts = {}
+    server.request_count = 0
+    server.batch_request_count = 0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://{server.server_address[0]}:{server.server_address[1]}"
+    return server, base_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve title records from a JSON file as a stub readallaboutit title api.')
+    parser.add_argument('records_file', help='JSON file containing a list of title records, each with an "id"')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to delay each response by')
+    parser.add_argument('--no-batch', action='store_true', help='do not serve the multi-id endpoint')
+    args = parser.parse_args()
+
+    with open(args.records_file, 'r') as json_file:
+        records = {int(record['id']): record for record in json.load(json_file)}
+    server, base_url = start_stub_server(records, port=args.port, latency=args.latency, batch=not args.no_batch)
+    print(f"Serving {len(records)} title records at {base_url}/api/v1/title/<id>")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""
+This module reads and writes the tables the stages hand to each other, in one of several formats:
+- 'csv': the original format, and the format to export results in.
+- 'parquet': compressed columnar files, much smaller on disk, read back restricted to the columns asked for.
+- 'arrow': uncompressed Arrow IPC files, memory-mapped when read so that only the columns asked for are touched.
+The columnar formats store the canonical columns with a fixed schema (SCHEMA): the ids as nullable 64-bit ints and
+the chapter columns as strings. Later stages get them back with their types, instead of re-inferring them from text
+(so 'title_id' is no longer read back as floats and the chapter columns no longer need their 'nan's repaired).
+The other columns keep their types, except that columns of mixed Python objects (or categories) are stored as strings.
+CSV files can also be read in bounded memory, chunk by chunk, with the dtypes a whole-file read would give each
+column (see scan_csv_dtypes), in their compact form (see compact_dtypes).
+"""
+
+import glob
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+FORMATS = ['csv', 'parquet', 'arrow']
+
+EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+
+# The dtype each canonical column is stored with in the columnar formats
+SCHEMA = {
+    'article_id': 'Int64',
+    'Old_Trove_ID': 'Int64',
+    'title_id': 'Int64',
+    'suggested_title_id': 'Int64',
+    'chapter_number': 'string',
+    'chapter_title': 'string',
+    'duplicate_of_sheet': 'string',
+}
+
+# The text columns read as categories by compact_dtypes, as the same titles and chapter numbers come up again and again
+CATEGORY_COLUMNS = [r'^(trove[_\s])?title$', r'chapter[_\s]number']
+
+# The dtype compact_dtypes reads the other text columns with: Arrow-backed strings when pyarrow is installed
+STRING_DTYPE = 'string[pyarrow]' if pa is not None else object
+
+
+def resolve_format(table_format: str) -> str:
+    """
+    This function returns the format to use for the requested one, falling back to 'csv' (with a message)
+    if pyarrow is not installed.
+    """
+    if table_format not in FORMATS:
+        raise ValueError(f"Unknown table format '{table_format}', expected one of {FORMATS}")
+    if table_format != 'csv' and pa is None:
+        print(f"pyarrow is not installed, writing csv instead of {table_format}")
+        return 'csv'
+    return table_format
+
+
+def format_of(file_path: str) -> str:
+    """Returns the format of a table file from its extension."""
+    extension = os.path.splitext(file_path)[1].lower()
+    for table_format, format_extension in EXTENSIONS.items():
+        if extension == format_extension:
+            return table_format
+    raise ValueError(f"{file_path} is not a table file, expected one of {list(EXTENSIONS.values())}")
+
+
+def table_path(base_path: str, table_format: str) -> str:
+    """Returns base_path (a path without extension) with the extension of table_format."""
+    return base_path + EXTENSIONS[table_format]
+
+
+def table_files(input_dir: str) -> list:
+    """Returns the table files (of any format) in input_dir, sorted by name."""
+    file_list = []
+    for extension in EXTENSIONS.values():
+        file_list.extend(glob.glob(os.path.join(input_dir, '*' + extension)))
+    return sorted(file_list)
+
+
+def _to_int64(series: pd.Series) -> pd.Series:
+    """
+    Converts a column to nullable Int64. Returns None if that would lose a value, i.e. if the column holds a value
+    that is not a whole number.
+    """
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return series.astype('Int64')
+    numbers = pd.to_numeric(series, errors='coerce')
+    lost = series.notna() & (numbers.isna() | (numbers % 1 != 0))
+    if lost.any():
+        return None
+    return numbers.astype('Int64')
+
+
+def apply_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    This function returns a copy of df with the canonical columns converted to their SCHEMA dtypes and the other
+    columns of mixed Python objects converted to strings, ready to be stored in a columnar format.
+    An id column that holds values other than whole numbers is stored as strings instead, with a message.
+    """
+    df = df.copy()
+    for column in df.columns:
+        dtype = SCHEMA.get(column)
+        if dtype == 'Int64':
+            converted = _to_int64(df[column])
+            if converted is not None:
+                df[column] = converted
+                continue
+            print(f"'{column}' has values that are not whole numbers, storing it as strings")
+            dtype = 'string'
+        if dtype == 'string' or df[column].dtype == object or isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('string')
+    return df
+
+
+def write_table(df: pd.DataFrame, file_path: str, table_format='csv') -> None:
+    """
+    This function writes df to file_path in the given format (file_path may be a temporary path, so the format is
+    not taken from its extension). The index is not written.
+    """
+    if table_format == 'csv':
+        df.to_csv(file_path, index=False)
+        return
+    if pa is None:
+        raise ImportError(f"pyarrow is needed to write {table_format}")
+    table = pa.Table.from_pandas(apply_schema(df), preserve_index=False)
+    if table_format == 'parquet':
+        pq.write_table(table, file_path, compression='zstd')
+    else:
+        # Uncompressed, so the file can be memory-mapped and read without copying
+        with pa.OSFile(file_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+
+def table_columns(file_path: str) -> list:
+    """Returns the column names of a table file, reading only its header (or schema)."""
+    table_format = format_of(file_path)
+    if table_format == 'csv':
+        return list(pd.read_csv(file_path, nrows=0).columns)
+    if pa is None:
+        raise ImportError(f"pyarrow is needed to read {file_path}")
+    if table_format == 'parquet':
+        return pq.read_schema(file_path, memory_map=True).names
+    with pa.memory_map(file_path, 'r') as source:
+        return pa.ipc.open_file(source).schema.names
+
+
+def read_table(file_path: str, columns=None, **csv_options) -> pd.DataFrame:
+    """
+    This function reads a table file written by write_table (or any CSV file) into a DataFrame.
+    The columnar formats are read back with the dtypes they were written with.
+
+    Parameters:
+    file_path (str): The path to the table file. Its format is taken from its extension.
+    columns (list): The only columns to read. None reads every column.
+    csv_options: Extra options for pd.read_csv, used only when reading a CSV file.
+
+    Returns:
+    pandas.DataFrame: The table.
+    """
+    table_format = format_of(file_path)
+    if table_format == 'csv':
+        return pd.read_csv(file_path, usecols=columns, **csv_options)
+    if pa is None:
+        raise ImportError(f"pyarrow is needed to read {file_path}")
+    if table_format == 'parquet':
+        return pq.read_table(file_path, columns=columns, memory_map=True).to_pandas()
+    with pa.memory_map(file_path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(columns)
+        return table.to_pandas()
+
+
+def iter_table(file_path: str, chunk_rows: int, columns=None, skip_rows=0, **csv_options):
+    """
+    This function reads a table file chunk by chunk, so only one chunk of it is held as a DataFrame at a time.
+    CSV files are read with pd.read_csv(chunksize=...), Parquet files a batch of rows at a time and Arrow files
+    from a memory map.
+
+    Parameters:
+    file_path (str): The path to the table file. Its format is taken from its extension.
+    chunk_rows (int): The number of rows in each chunk (the last chunk may be shorter).
+    columns (list): The only columns to read. None reads every column.
+    skip_rows (int): The number of data rows to skip at the start, e.g. rows already processed.
+    csv_options: Extra options for pd.read_csv, used only when reading a CSV file.
+
+    Yields:
+    tuple: (the position of the chunk's first row in the table, the chunk as a DataFrame)
+    """
+    table_format = format_of(file_path)
+    if table_format == 'csv':
+        start = skip_rows
+        # Row 0 is the header, so the first data row skipped is row 1
+        for chunk in pd.read_csv(file_path, usecols=columns, chunksize=chunk_rows,
+                                 skiprows=range(1, skip_rows + 1), **csv_options):
+            yield start, chunk
+            start += len(chunk)
+        return
+    if pa is None:
+        raise ImportError(f"pyarrow is needed to read {file_path}")
+    if table_format == 'parquet':
+        batches = pq.ParquetFile(file_path, memory_map=True).iter_batches(batch_size=chunk_rows, columns=columns)
+        start = 0
+        for batch in batches:
+            end = start + batch.num_rows
+            if end > skip_rows:
+                batch = batch.slice(max(skip_rows - start, 0))
+                yield max(start, skip_rows), batch.to_pandas()
+            start = end
+        return
+    with pa.memory_map(file_path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(columns)
+        for start in range(skip_rows, table.num_rows, chunk_rows):
+            yield start, table.slice(start, chunk_rows).to_pandas()
+
+
+def common_dtype(dtypes) -> np.dtype:
+    """
+    Returns the dtype of a column made of parts with the given dtypes, the way pd.read_csv combines the parts of a
+    large file it parses piece by piece (e.g. int64 and float64 parts make a float64 column, any object part an
+    object column).
+    """
+    dtypes = list(dict.fromkeys(dtypes))
+    if len(dtypes) == 1:
+        return dtypes[0]
+    return np.concatenate([np.empty(0, dtype) for dtype in dtypes]).dtype
+
+
+def scan_csv_dtypes(file_path: str, chunk_rows: int, columns=None, **csv_options) -> dict:
+    """
+    This function reads a CSV file chunk by chunk and works out the dtype pd.read_csv would give each column if it
+    read the whole file. A chunk on its own can infer a different dtype (e.g. int64 for a chunk of title_ids without
+    a missing value, where the whole column is float64), so chunks read with these dtypes are written out exactly as
+    the whole file would be.
+
+    Parameters:
+    file_path (str): The path to the CSV file.
+    chunk_rows (int): The number of rows to parse at a time.
+    columns (list): The only columns to read. None reads every column.
+    csv_options: Extra options for pd.read_csv.
+
+    Returns:
+    dict: The dtype of each column, in file order.
+    """
+    dtypes = {}
+    for chunk in pd.read_csv(file_path, usecols=columns, chunksize=chunk_rows, **csv_options):
+        for column, dtype in chunk.dtypes.items():
+            dtypes.setdefault(column, []).append(dtype)
+    return {column: common_dtype(column_dtypes) for column, column_dtypes in dtypes.items()}
+
+
+def compact_dtypes(dtypes: dict, category_columns=CATEGORY_COLUMNS) -> dict:
+    """
+    This function returns the compact form of the given column dtypes, which holds the same values in less memory
+    and writes out the same text:
+    - the text columns matching category_columns (regular expressions, case-insensitive) become categories,
+    - the other text columns become Arrow-backed strings (if pyarrow is installed),
+    - the id columns of SCHEMA with no missing values (int64) become nullable Int64.
+    An id column with missing values stays float64, as Int64 would write '123' where the whole-file read writes '123.0'.
+    """
+    patterns = [re.compile(pattern, re.IGNORECASE) for pattern in category_columns]
+    compact = {}
+    for column, dtype in dtypes.items():
+        if dtype == object:
+            is_category = any(pattern.search(str(column)) for pattern in patterns)
+            compact[column] = 'category' if is_category else STRING_DTYPE
+        elif SCHEMA.get(column) == 'Int64' and dtype == np.int64:
+            compact[column] = 'Int64'
+        else:
+            compact[column] = dtype
+    return compact
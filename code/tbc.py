@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+One command line for the data-cleaning stages:
+
+    python tbc.py update-ids <folder>      stage 1 (1_update_trove_id.py)
+    python tbc.py clean-check <folder>     stage 2 (2_clean_and_check_data.py)
+    python tbc.py verify-titles <folder>   stage 3 (3_check_title_id_query_API.py)
+    python tbc.py clean-titles <file>      clean_titles.py
+    python tbc.py pipeline <folder>        stages 1 to 3 in one process (pipeline.py)
+    python tbc.py watch <folder>           stages 1 to 3 on each new sheet as it lands (watch_folder.py)
+
+This module only imports the standard library (and metrics), and each stage module (with pandas, openpyxl, the api
+clients...) is imported when its subcommand runs, so '--help', a mistyped option or a '--dry-run' return at once.
+The numbered scripts still work as before: their main() parses the same options through this module.
+"""
+
+import argparse
+import contextlib
+import glob
+import importlib
+import json
+import os
+import sys
+
+import metrics
+
+DEFAULT_MAPPINGS = os.environ.get('TBC_MAPPINGS', '/Volumes/UNTITLED/remote_old_to_new_mappings.json')
+
+# The choices below are those of table_io.FORMATS, table_io.EXTENSIONS, xlsx_readers.BACKENDS, the stages' LOADERS
+# and title_api_async.CLIENTS, written out so that the options can be parsed without importing those modules
+FORMATS = ['csv', 'parquet', 'arrow']
+TABLE_EXTENSIONS = ['.csv', '.parquet', '.arrow']
+BACKENDS = ['pandas', 'openpyxl', 'calamine']
+LOADERS = ['index', 'json', 'stream']
+CLIENTS = ['async', 'threads']
+
+# The output folder (in the input folder) and manifest name of each subcommand, for --dry-run
+STAGE_OUTPUTS = {
+    'update-ids': ('processed_files', 'update_trove_id'),
+    'clean-check': ('clean_and_check_processed_files', 'clean_and_check'),
+    'verify-titles': ('3_processed_files', 'check_title_id'),
+    'pipeline': ('pipeline_output', 'pipeline'),
+}
+
+
+def _stage(module_name: str):
+    """
+    Imports a stage module on first use. When the stage's own script is being run, it is already loaded as
+    __main__, so that module is returned rather than importing (and setting up) the script a second time.
+    """
+    main_module = sys.modules.get('__main__')
+    main_file = getattr(main_module, '__file__', None) or ''
+    if os.path.splitext(os.path.basename(main_file))[0] == module_name:
+        return main_module
+    return importlib.import_module(module_name)
+
+
+def _recorded_mappings_version(json_file_path: str) -> str:
+    """
+    Returns the sha256 of the mappings JSON recorded in its index (see mappings_index) if the index was compiled from
+    the file as it is now (same size and mtime), otherwise None.
+    """
+    try:
+        with open(os.path.join(json_file_path + '.index', 'meta.json'), 'r') as json_file:
+            meta = json.load(json_file)
+        stat = os.stat(json_file_path)
+    except (OSError, ValueError):
+        return None
+    if meta.get('size') == stat.st_size and meta.get('mtime') == stat.st_mtime:
+        return meta.get('sha256')
+    return None
+
+
+def _input_files(command: str, input_dir: str) -> list:
+    """Returns the sheets a subcommand would process in input_dir, as the stage itself finds them."""
+    if command in ('update-ids', 'pipeline'):
+        file_list = glob.glob(os.path.join(input_dir, '*.xlsx'))
+    else:
+        file_list = [file_path for extension in TABLE_EXTENSIONS
+                     for file_path in glob.glob(os.path.join(input_dir, '*' + extension))]
+    # Skip temporary files
+    return sorted(file_path for file_path in file_list if not os.path.basename(file_path).startswith('~$'))
+
+
+def dry_run(args) -> None:
+    """
+    This function lists the sheets a subcommand would process and those its manifest (see pipeline_state) already
+    records as done, without importing the stage, loading the mappings or writing anything.
+    The mappings JSON is only hashed if its index does not already record its sha256.
+    """
+    from pipeline_state import PipelineState
+
+    if args.command == 'clean-titles':
+        print(f"Would clean {args.file} into {_clean_titles_output(args)}")
+        return
+    output_folder, stage = STAGE_OUTPUTS[args.command]
+    if args.command == 'pipeline' and args.post_migration:
+        stage = 'pipeline_post_migration'
+    output_dir = os.path.join(args.input_dir, output_folder)
+    mappings_path = getattr(args, 'mappings', None)
+    if getattr(args, 'loader', 'index') != 'index':
+        # The stage hashes the JSON itself when it does not load the index
+        mappings_version = None
+    else:
+        mappings_version = mappings_path and _recorded_mappings_version(mappings_path)
+    state = PipelineState(output_dir, stage, mappings_path, mappings_version, read_only=True)
+    file_list = _input_files(args.command, args.input_dir)
+    done = [file_path for file_path in file_list if state.is_done(file_path)]
+    partial = [file_path for file_path in file_list if file_path not in done and state.progress(file_path)[0]]
+    todo = [file_path for file_path in file_list if file_path not in done]
+    print(f"{len(file_list)} sheets in {args.input_dir}: {len(todo)} to process "
+          f"({len(partial)} to resume), {len(done)} already done (see {state.path})")
+    for file_path in todo:
+        print(f"  {'resume' if file_path in partial else 'process'}  {os.path.basename(file_path)}")
+
+
+def update_ids(args) -> None:
+    stage = _stage('1_update_trove_id')
+    with metrics.session(args):
+        stage.process_directory(args.input_dir, args.mappings, args.workers, args.reader, args.columns, args.loader,
+                                args.output_format)
+
+
+def clean_check(args) -> None:
+    stage = _stage('2_clean_and_check_data')
+    with metrics.session(args):
+        stage.process_directory(args.input_dir, args.mappings, args.loader, args.output_format, args.dataset,
+                                args.duplicate_check, args.article_index, args.chunk_rows)
+
+
+def _title_cache(args, **options):
+    """Opens the title cache the options ask for (title_cache.sqlite in the output folder by default), or None."""
+    if getattr(args, 'no_cache', False):
+        return None
+    from title_cache import TitleCache
+    cache_path = args.cache
+    if cache_path is None:
+        # The watch subcommand writes to the pipeline's output folder
+        output_folder = STAGE_OUTPUTS['pipeline' if args.command == 'watch' else args.command][0]
+        output_dir = os.path.join(args.input_dir, output_folder)
+        os.makedirs(output_dir, exist_ok=True)
+        cache_path = os.path.join(output_dir, 'title_cache.sqlite')
+    return TitleCache(cache_path, **options)
+
+
+def verify_titles(args) -> None:
+    stage = _stage('3_check_title_id_query_API')
+    if args.title_index:
+        from title_index import TitleIndex
+        with TitleIndex(args.title_index) as title_index, metrics.session(args):
+            print(f"Checking titles offline against {len(title_index)} title records in {args.title_index}")
+            stage.process_directory(args.input_dir, None, args.batch_size, args.output_format, args.dataset,
+                                    title_index)
+        return
+
+    from title_api import BASE_URL
+    from title_api_async import create_lookup
+    cache = _title_cache(args, ttl=args.cache_ttl * 24 * 60 * 60, max_entries=args.cache_size)
+    try:
+        with create_lookup(args.client, args.base_url or BASE_URL, max_workers=args.concurrency,
+                           requests_per_second=args.rate, timeout=args.timeout, cache=cache,
+                           batch=args.multi_id) as title_lookup, \
+                metrics.session(args):
+            stage.process_directory(args.input_dir, title_lookup, args.batch_size, args.output_format, args.dataset)
+        if cache is not None:
+            print(f"Title cache: {cache.hits} hits, {cache.misses} misses, {len(cache)} records")
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def _clean_titles_output(args) -> str:
+    return args.output or os.path.splitext(args.file)[0] + '_CLEANED.xlsx'
+
+
+def clean_titles(args) -> None:
+    _stage('clean_titles').clean_file(args.file, _clean_titles_output(args), args.chunk_rows)
+
+
+@contextlib.contextmanager
+def _title_source(args):
+    """
+    Opens what the pipeline checks the titles against, for the whole run: the offline title index with --title-index,
+    otherwise the api (through the title cache). Yields (title_lookup, title_index), one of which is None.
+    """
+    if args.title_index:
+        from title_index import TitleIndex
+        with TitleIndex(args.title_index) as title_index:
+            yield None, title_index
+        return
+
+    from title_api import BASE_URL
+    from title_api_async import create_lookup
+    cache = _title_cache(args)
+    try:
+        with create_lookup(args.client, args.base_url or BASE_URL, max_workers=args.concurrency,
+                           requests_per_second=args.rate, cache=cache, batch=args.multi_id) as title_lookup:
+            yield title_lookup, None
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def _pipeline_options(args) -> dict:
+    """Returns the arguments of pipeline.run_pipeline shared by the pipeline and watch subcommands."""
+    return dict(debug_csv=args.debug_csv, backend=args.reader, queue_size=args.queue_size, batch_size=args.batch_size,
+                output_format=args.output_format, dataset_dir=args.dataset,
+                duplicate_check=args.duplicate_check, article_index_path=args.article_index)
+
+
+def pipeline(args) -> None:
+    stage = _stage('pipeline')
+    with _title_source(args) as (title_lookup, title_index), metrics.session(args):
+        stage.run_pipeline(args.input_dir, args.mappings, title_lookup, not args.post_migration,
+                           ingest_json=args.ingest_json, title_index=title_index, **_pipeline_options(args))
+
+
+def watch(args) -> None:
+    watch_folder = _stage('watch_folder')
+    with _title_source(args) as (title_lookup, title_index), metrics.session(args):
+        watcher = watch_folder.SheetWatcher(args.input_dir, args.mappings, title_lookup, args.settle, args.poll,
+                                            args.polling, title_index=title_index, **_pipeline_options(args))
+        watcher.run()
+
+
+def _add_input_dir(parser) -> None:
+    parser.add_argument('input_dir', help='the folder of sheets to process')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list the sheets that would be processed and those already done, and exit')
+
+
+def _add_mappings(parser) -> None:
+    parser.add_argument('--mappings', default=DEFAULT_MAPPINGS,
+                        help='path to remote_old_to_new_mappings.json (default: $TBC_MAPPINGS, or %(default)s)')
+
+
+def _add_api(parser) -> None:
+    parser.add_argument('--base-url', help='scheme and host of the api, e.g. a local stub server '
+                                           '(default: the readallaboutit api)')
+    parser.add_argument('--client', choices=CLIENTS, default='async',
+                        help='fetch title records with the asyncio client (coalesced requests) or the threaded one')
+    parser.add_argument('--multi-id', action='store_true',
+                        help='fetch many title records per request with the multi-id endpoint (async client only; '
+                             'falls back to one request per title_id if the api has no such endpoint)')
+    parser.add_argument('--concurrency', type=int, default=8, help='maximum number of requests in flight')
+    parser.add_argument('--rate', type=float, default=10.0, help='maximum requests per second per host (0 for no limit)')
+    parser.add_argument('--cache', help='SQLite file to cache title records in (default: title_cache.sqlite in the output folder)')
+    parser.add_argument('--title-index', help='check the titles offline against this title index (see title_index.py) '
+                                              'and suggest title_ids for the not safe rows')
+
+
+def _add_duplicate_check(parser) -> None:
+    parser.add_argument('--duplicate-check', action='store_true',
+                        help='send rows repeating an article_id of an earlier sheet to be checked, with the sheet '
+                             'of the first copy in a duplicate_of_sheet column')
+    parser.add_argument('--article-index', help='SQLite file of the run-wide article_id index for --duplicate-check '
+                                                '(default: article_ids.sqlite in the output folder)')
+
+
+def _add_pipeline_options(parser) -> None:
+    parser.add_argument('--debug-csv', action='store_true', help='also write the intermediate files of stages 1 and 2')
+    parser.add_argument('--output-format', choices=FORMATS, default='csv', help='format to write the outputs in')
+    parser.add_argument('--dataset', help='write all outputs to this run-wide dataset folder instead of files per sheet')
+    parser.add_argument('--reader', choices=BACKENDS, default='pandas', help='Excel reader backend')
+    parser.add_argument('--queue-size', type=int, default=2, help='sheets that may wait between two stages')
+    parser.add_argument('--batch-size', type=int, default=200, help='rows whose title records are fetched at a time')
+    _add_api(parser)
+    _add_duplicate_check(parser)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='tbc.py', description='Clean and check the TBC data entry sheets.')
+    subparsers = parser.add_subparsers(dest='command', metavar='command', required=True)
+
+    update_parser = subparsers.add_parser(
+        'update-ids', help='stage 1: update the Trove IDs of a folder of Excel files',
+        description='Update the Trove ID column of a folder of Excel files with the new Trove IDs.')
+    _add_input_dir(update_parser)
+    _add_mappings(update_parser)
+    update_parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    update_parser.add_argument('--reader', choices=BACKENDS, default='pandas', help='Excel reader backend')
+    update_parser.add_argument('--columns', nargs='+',
+                               help='regular expressions for the only columns to keep, e.g. "article" "trove[_\\s]ID"')
+    update_parser.add_argument('--loader', choices=LOADERS, default='index',
+                               help='load the mappings from the compiled index, by streaming the JSON, or with json.load')
+    update_parser.add_argument('--output-format', choices=FORMATS, default='csv',
+                               help='format to write the updated data in')
+    update_parser.set_defaults(handler=update_ids)
+
+    check_parser = subparsers.add_parser(
+        'clean-check', help='stage 2: split UPDATED_MAPPING files into sheets to check and to upload',
+        description='Split a folder of UPDATED_MAPPING CSV files into sheets to check and sheets to upload.')
+    _add_input_dir(check_parser)
+    _add_mappings(check_parser)
+    check_parser.add_argument('--loader', choices=LOADERS, default='index',
+                              help='load the mappings from the compiled index, by streaming the JSON, or with json.load')
+    check_parser.add_argument('--output-format', choices=FORMATS, default='csv',
+                              help='format to write the two outputs in')
+    check_parser.add_argument('--dataset',
+                              help='add the rows to this run-wide dataset folder instead of two files per sheet')
+    _add_duplicate_check(check_parser)
+    check_parser.add_argument('--chunk-rows', type=int,
+                              help='process each sheet this many rows at a time, to bound memory on very long sheets')
+    check_parser.set_defaults(handler=clean_check)
+
+    verify_parser = subparsers.add_parser(
+        'verify-titles', help='stage 3: check the title_id and title of each row against the api',
+        description='Check the title_id and title string of each row against the readallaboutit api.')
+    _add_input_dir(verify_parser)
+    _add_api(verify_parser)
+    verify_parser.add_argument('--timeout', type=float, default=10.0, help='request timeout in seconds')
+    verify_parser.add_argument('--cache-ttl', type=float, default=7.0,
+                               help='days before a cached title record is revalidated')
+    verify_parser.add_argument('--cache-size', type=int, default=200000, help='maximum number of cached title records')
+    verify_parser.add_argument('--no-cache', action='store_true', help='always query the api')
+    verify_parser.add_argument('--batch-size', type=int, default=200, help='rows checked and committed at a time')
+    verify_parser.add_argument('--output-format', choices=FORMATS, default='csv',
+                               help='format to write the safe/not safe outputs in')
+    verify_parser.add_argument('--dataset',
+                               help='add the rows to this run-wide dataset folder instead of two files per sheet')
+    verify_parser.set_defaults(handler=verify_titles)
+
+    titles_parser = subparsers.add_parser(
+        'clean-titles', help="extract the chapter number and chapter title of each row's title",
+        description="Extract the chapter number and chapter title of each row's title.")
+    titles_parser.add_argument('file', help='the Excel file to clean')
+    titles_parser.add_argument('--dry-run', action='store_true', help='show the file that would be written, and exit')
+    titles_parser.add_argument('--output', help='the Excel file to write (default: the file name with _CLEANED added)')
+    titles_parser.add_argument('--chunk-rows', type=int,
+                               help='read and write the file this many rows at a time, to bound memory on very long files')
+    titles_parser.set_defaults(handler=clean_titles)
+
+    pipeline_parser = subparsers.add_parser(
+        'pipeline', help='stages 1 to 3 over a folder of Excel sheets in one pass, loading the mappings once',
+        description='Run stages 1 to 3 over a folder of Excel sheets in one pass.')
+    _add_input_dir(pipeline_parser)
+    _add_mappings(pipeline_parser)
+    pipeline_parser.add_argument('--post-migration', action='store_true',
+                                 help='the sheets were created after the migration and already have new title_ids (skip stage 1)')
+    pipeline_parser.add_argument('--ingest-json', help='with --dataset, export the safe rows to this API ingest JSON file')
+    _add_pipeline_options(pipeline_parser)
+    pipeline_parser.set_defaults(handler=pipeline)
+
+    watch_parser = subparsers.add_parser(
+        'watch', help='watch a folder and run each new sheet through stages 1 to 3 as soon as it lands',
+        description='Watch a folder (e.g. the synced OneDrive folder) and run each new or changed Excel sheet through '
+                    'stages 1 to 3 once it has finished arriving, skipping stage 1 for post-migration sheets. '
+                    'Stop with Ctrl-C.')
+    watch_parser.add_argument('input_dir', help='the folder to watch')
+    _add_mappings(watch_parser)
+    watch_parser.add_argument('--settle', type=float, default=2.0,
+                              help='seconds a sheet must stay unchanged before it is processed (default: %(default)s)')
+    watch_parser.add_argument('--poll', type=float, default=2.0,
+                              help='seconds between scans of the folder when it is polled (default: %(default)s)')
+    watch_parser.add_argument('--polling', action='store_true',
+                              help='poll the folder even if watchdog is installed (e.g. on a network drive)')
+    _add_pipeline_options(watch_parser)
+    watch_parser.set_defaults(handler=watch, dry_run=False)
+
+    for subparser in subparsers.choices.values():
+        metrics.add_arguments(subparser)
+    return parser
+
+
+def main(argv=None) -> None:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    # Check the paths before importing the stage, so that a typo fails at once
+    if args.command == 'clean-titles':
+        if not os.path.isfile(args.file):
+            parser.error(f"{args.file} is not a file")
+    elif not os.path.isdir(args.input_dir):
+        parser.error(f"{args.input_dir} is not a folder")
+    mappings = getattr(args, 'mappings', None)
+    if mappings and not os.path.exists(mappings):
+        parser.error(f"the mappings file {mappings} does not exist (use --mappings or set TBC_MAPPINGS)")
+    if args.dry_run:
+        dry_run(args)
+        return
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+# The scripts in code/ import each other by module name, so the tests import them the same way
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_title_api import start_stub_server  # noqa: E402
+
+RECORDS = {title_id: {'id': title_id, 'publication_title': f'Title {title_id}', 'common_title': f'Title {title_id}'}
+           for title_id in range(1, 11)}
+
+
+@pytest.fixture
+def stub_api():
+    """Starts a stub title api serving RECORDS. Call it with the options of start_stub_server; returns (server, base_url)."""
+    servers = []
+
+    def start(**options):
+        server, base_url = start_stub_server(dict(RECORDS), **options)
+        servers.append(server)
+        return server, base_url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
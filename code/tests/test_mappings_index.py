@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+import mappings_index
+from mappings_index import build_index_arrays, load_mappings_index, stream_mappings
+
+
+@pytest.fixture
+def mappings_file(tmp_path):
+    file_path = tmp_path / 'remote_old_to_new_mappings.json'
+    file_path.write_text(json.dumps({'trove': {'10': 100, '11': '110', '012': 120},
+                                     'uploaded_chapters': ['123', 456, '0789', '1000', 'abc']}))
+    return str(file_path)
+
+
+def test_uploaded_chapters_only_match_as_strings():
+    # The stages look up str(article_id), which never matched a JSON number in the list
+    trove_old, trove_new, uploaded, skipped = build_index_arrays({'10': 100}, ['123', 456, '0789', '1000'])
+    assert uploaded.tolist() == [123, 1000]
+    assert skipped == 2
+
+
+def test_index_keeps_string_matching(mappings_file):
+    index = load_mappings_index(mappings_file)
+    assert index.uploaded_chapters.contains([123, 456, 789, 1000]).tolist() == [True, False, False, True]
+    assert index.trove.get('10') == 100 and index.trove.get('11') == 110 and index.trove.get('012') is None
+
+
+@pytest.mark.skipif(mappings_index.ijson is None, reason='ijson is not installed')
+def test_streaming_matches_index(mappings_file):
+    trove, uploaded_chapters, skipped = stream_mappings(mappings_file)
+    assert uploaded_chapters.article_ids.tolist() == [123, 1000]
+    assert trove.get('10') == 100 and trove.get('11') == 110 and trove.get('012') is None
+    assert skipped == 4
@@ -0,0 +1,56 @@
+import json
+import os
+import threading
+
+import pytest
+
+import pipeline
+from bench_pipeline import write_synthetic_corpus
+from pipeline_state import PipelineState
+from title_api import TitleLookup
+
+
+@pytest.fixture
+def corpus(tmp_path, stub_api):
+    """A synthetic corpus of two sheets, and a lookup of its title records on a stub title api."""
+    corpus_dir = str(tmp_path / 'corpus')
+    write_synthetic_corpus(corpus_dir, rows=40, rows_per_sheet=20, title_count=10, mappings_entries=10)
+    with open(os.path.join(corpus_dir, 'title_records.json'), 'r') as json_file:
+        records = {record['id']: record for record in json.load(json_file)}
+    server, base_url = stub_api()
+    server.records = records
+    with TitleLookup(base_url, requests_per_second=0) as title_lookup:
+        yield os.path.join(corpus_dir, 'sheets'), os.path.join(corpus_dir, 'mappings.json'), title_lookup
+
+
+def _run_pipeline(*args, **kwargs):
+    # A pipeline that hangs fails the test instead of blocking the run
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(pipeline.run_pipeline(*args, **kwargs)), daemon=True)
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), "run_pipeline did not finish"
+    return result
+
+
+def test_skips_sheets_already_done(corpus):
+    sheets_dir, mappings, title_lookup = corpus
+    first = _run_pipeline(sheets_dir, mappings, title_lookup)
+    assert len(first['processed']) == 2 and not first['failed']
+    second = _run_pipeline(sheets_dir, mappings, title_lookup)
+    assert sorted(second['skipped']) == sorted(first['processed']) and not second['processed']
+
+
+def test_sheet_that_cannot_be_checked_fails_without_hanging(corpus, monkeypatch):
+    sheets_dir, mappings, title_lookup = corpus
+    is_done = PipelineState.is_done
+
+    def removed_first_sheet(self, input_path):
+        if input_path.endswith('sheet_00001.xlsx'):
+            raise FileNotFoundError(2, 'No such file or directory', input_path)
+        return is_done(self, input_path)
+
+    monkeypatch.setattr(PipelineState, 'is_done', removed_first_sheet)
+    summary = _run_pipeline(sheets_dir, mappings, title_lookup)
+    assert [os.path.basename(file_path) for file_path in summary['failed']] == ['sheet_00001.xlsx']
+    assert [os.path.basename(file_path) for file_path in summary['processed']] == ['sheet_00002.xlsx']
@@ -0,0 +1,44 @@
+import pytest
+
+import title_api
+from title_api import TitleLookup
+
+
+def test_get_titles_keeps_order_and_fetches_duplicates_once(stub_api):
+    server, base_url = stub_api()
+    with TitleLookup(base_url, max_workers=4, requests_per_second=0) as title_lookup:
+        records = title_lookup.get_titles([5, 2, 5, 9, 2, 1])
+    assert [record['id'] for record in records] == [5, 2, 5, 9, 2, 1]
+    assert server.attempts == {1: 1, 2: 1, 5: 1, 9: 1}
+
+
+def test_get_titles_returns_none_for_unknown_title_ids(stub_api):
+    server, base_url = stub_api()
+    with TitleLookup(base_url, requests_per_second=0) as title_lookup:
+        records = title_lookup.get_titles([1, 99, 1])
+    assert records[0]['id'] == 1 and records[1] is None and records[2]['id'] == 1
+
+
+@pytest.mark.parametrize('fail_status', [429, 503])
+def test_get_titles_retries_with_backoff(stub_api, monkeypatch, fail_status):
+    delays = []
+
+    def backoff_delay(attempt, backoff, max_backoff, response=None):
+        delays.append(attempt)
+        return 0.0
+
+    monkeypatch.setattr(title_api, 'backoff_delay', backoff_delay)
+    server, base_url = stub_api(fail_first=2, fail_status=fail_status)
+    with TitleLookup(base_url, max_workers=2, requests_per_second=0, retries=3) as title_lookup:
+        records = title_lookup.get_titles([3, 4, 3])
+    assert [record['id'] for record in records] == [3, 4, 3]
+    assert server.attempts == {3: 3, 4: 3}
+    assert sorted(delays) == [0, 0, 1, 1]
+
+
+def test_get_titles_gives_up_after_retries(stub_api, monkeypatch):
+    monkeypatch.setattr(title_api, 'backoff_delay', lambda *args: 0.0)
+    server, base_url = stub_api(fail_first=5, fail_status=503)
+    with TitleLookup(base_url, requests_per_second=0, retries=2) as title_lookup:
+        assert title_lookup.get_titles([1, 2]) == [None, None]
+    assert server.attempts == {1: 2, 2: 2}
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+import title_api_async
+from stub_title_api import StubTitleHandler
+from title_api_async import AsyncTitleClient, AsyncTitleLookup
+
+pytestmark = pytest.mark.skipif(title_api_async.httpx is None, reason='httpx is not installed')
+
+
+def test_coalesces_title_ids_in_flight(stub_api):
+    server, base_url = stub_api(latency=0.2, batch=False)
+
+    async def fetch():
+        async with AsyncTitleClient(base_url, requests_per_second=0) as client:
+            return await asyncio.gather(client.get_titles([1, 2]), client.get_titles([2, 3]), client.get_title(1))
+
+    first, second, third = asyncio.run(fetch())
+    assert [record['id'] for record in first] == [1, 2]
+    assert [record['id'] for record in second] == [2, 3]
+    assert third['id'] == 1
+    # Title_ids 1 and 2 were asked for twice while in flight, but each was fetched once
+    assert server.request_count == 3
+    assert server.attempts == {1: 1, 2: 1, 3: 1}
+
+
+def test_batch_fetches_many_title_ids_in_one_request(stub_api):
+    server, base_url = stub_api()
+    with AsyncTitleLookup(base_url, requests_per_second=0, batch=True) as title_lookup:
+        records = title_lookup.get_titles([3, 1, 2, 3])
+        assert title_lookup.client.batch_supported is True
+    assert [record['id'] for record in records] == [3, 1, 2, 3]
+    assert server.batch_request_count == 1
+    assert server.request_count == 1
+
+
+def test_batch_is_off_by_default(stub_api):
+    server, base_url = stub_api()
+    with AsyncTitleLookup(base_url, requests_per_second=0) as title_lookup:
+        assert [record['id'] for record in title_lookup.get_titles([1, 2])] == [1, 2]
+    assert server.batch_request_count == 0
+    assert server.request_count == 2
+
+
+def test_title_ids_missing_from_batch_are_fetched_singly(stub_api):
+    server, base_url = stub_api()
+    with AsyncTitleLookup(base_url, requests_per_second=0, batch=True) as title_lookup:
+        records = title_lookup.get_titles([1, 99, 2])
+    assert records[0]['id'] == 1 and records[1] is None and records[2]['id'] == 2
+    assert server.batch_request_count == 1
+    # The unknown title_id is asked for on its own, and is not found there either
+    assert server.attempts == {99: 1}
+
+
+def test_falls_back_to_single_fetches_without_batch_endpoint(stub_api):
+    server, base_url = stub_api(batch=False)
+    with AsyncTitleLookup(base_url, requests_per_second=0, batch=True) as title_lookup:
+        assert [record['id'] for record in title_lookup.get_titles([1, 2, 3])] == [1, 2, 3]
+        assert title_lookup.client.batch_supported is False
+        assert [record['id'] for record in title_lookup.get_titles([4, 5])] == [4, 5]
+    # Only the first call tried the multi-id endpoint
+    assert server.batch_request_count == 1
+    assert server.attempts == {title_id: 1 for title_id in range(1, 6)}
+
+
+def test_falls_back_to_single_fetches_on_unexpected_batch_answer(stub_api, monkeypatch):
+    def get_batch(self):
+        with self.server.lock:
+            self.server.batch_request_count += 1
+        body = b'{"results": []}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    monkeypatch.setattr(StubTitleHandler, 'get_batch', get_batch)
+    server, base_url = stub_api()
+    with AsyncTitleLookup(base_url, requests_per_second=0, batch=True) as title_lookup:
+        assert [record['id'] for record in title_lookup.get_titles([1, 2, 3])] == [1, 2, 3]
+        assert title_lookup.client.batch_supported is False
+    assert server.batch_request_count == 1
+    assert server.attempts == {1: 1, 2: 1, 3: 1}
+
+
+@pytest.mark.parametrize('fail_status', [429, 503])
+def test_retries_with_backoff(stub_api, monkeypatch, fail_status):
+    delays = []
+
+    def backoff_delay(attempt, backoff, max_backoff, response=None):
+        delays.append(attempt)
+        return 0.0
+
+    monkeypatch.setattr(title_api_async, 'backoff_delay', backoff_delay)
+    server, base_url = stub_api(fail_first=2, fail_status=fail_status, batch=False)
+    with AsyncTitleLookup(base_url, requests_per_second=0, retries=3) as title_lookup:
+        assert title_lookup.get_title(1)['id'] == 1
+    assert server.attempts == {1: 3}
+    assert delays == [0, 1]
+
+
+def test_gives_up_after_retries(stub_api, monkeypatch):
+    monkeypatch.setattr(title_api_async, 'backoff_delay', lambda *args: 0.0)
+    server, base_url = stub_api(fail_first=5, fail_status=503, batch=False)
+    with AsyncTitleLookup(base_url, requests_per_second=0, retries=2) as title_lookup:
+        assert title_lookup.get_title(1) is None
+    assert server.attempts == {1: 2}
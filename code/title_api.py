@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Functionality to fetch title records from the readallaboutit.com.au api (api)
+# concurrently, over a shared pooled session.
+
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+BASE_URL = "https://readallaboutit.com.au"
+
+# Status codes that are worth retrying: the server is rate limiting us or is temporarily unavailable
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """
+    Spaces out requests so that no more than requests_per_second requests are started against a single host.
+    A requests_per_second of 0 (or None) turns rate limiting off.
+    """
+
+    def __init__(self, requests_per_second=None):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, host: str) -> float:
+        """Reserves the next request slot for the given host and returns the number of seconds until it."""
+        if not self.interval:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        return slot - now
+
+    def wait(self, host: str) -> None:
+        """Block until the next request slot for the given host."""
+        delay = self.reserve(host)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def backoff_delay(attempt: int, backoff: float, max_backoff: float, response=None) -> float:
+    """
+    Returns how long to wait before the next attempt, using exponential backoff with full jitter.
+    A numeric Retry-After header sent with a 429/503 response is used as the minimum delay.
+    """
+    delay = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+    if response is not None:
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            delay = max(delay, min(max_backoff, float(retry_after)))
+    return delay
+
+
+class TitleLookup:
+    """
+    Fetches title records from the readallaboutit api with a bounded thread pool over a shared requests.Session.
+
+    Parameters:
+    base_url (str): The scheme and host of the api, e.g. 'https://readallaboutit.com.au' or the url of a local stub server.
+    max_workers (int): The maximum number of requests in flight at the same time.
+    requests_per_second (float): The maximum rate of requests per host. None or 0 means no limit.
+    timeout (float): The connect/read timeout in seconds for each request.
+    retries (int): The number of attempts for a title_id before giving up.
+    backoff (float): The base delay in seconds for exponential backoff between attempts.
+    max_backoff (float): The cap in seconds on a single backoff delay.
+    cache (title_cache.TitleCache): An optional persistent cache of title records. Fresh records are served from it,
+    stale ones are revalidated with their ETag, and fetched ones are stored in it.
+    """
+
+    def __init__(self, base_url=BASE_URL, max_workers=8, requests_per_second=10.0, timeout=10.0,
+                 retries=3, backoff=0.5, max_backoff=30.0, cache=None):
+        self.base_url = base_url.rstrip('/')
+        self.cache = cache
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = requests.Session()
+        # Keep one pooled connection per worker so connections are reused instead of reopened for every request
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        self.session.close()
+
+    def build_url(self, title_id: int) -> str:
+        """Builds the url to query the api with, given a title_id."""
+        return f"{self.base_url}/api/v1/title/{title_id}"
+
+    def _backoff_delay(self, attempt: int, response=None) -> float:
+        return backoff_delay(attempt, self.backoff, self.max_backoff, response)
+
+    def get_title(self, title_id: int) -> dict:
+        """Get a title record from the readallaboutit api given a title_id. Returns None if it could not be fetched."""
+        return self.get_titles([title_id])[0]
+
+    def _fetch_title(self, title_id: int) -> dict:
+        """
+        Fetch a title record from the api, bypassing the fresh records in the cache.
+        If the cache holds a stale copy with an ETag, the request is made conditional and a 304 response reuses the copy.
+        """
+        url = self.build_url(title_id)
+        host = urlparse(url).netloc
+        headers = {}
+        cached_record, etag = self.cache.get_stale(title_id) if self.cache is not None else (None, None)
+        if etag:
+            headers['If-None-Match'] = etag
+
+        for attempt in range(self.retries):
+            self.rate_limiter.wait(host)
+            if attempt:
+                metrics.count('api_retries')
+            metrics.count('api_requests')
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.observe('api_latency', time.perf_counter() - start, status='error')
+                print(f"Connection error when fetching title_id {title_id}: {e}. Retrying...")
+                if attempt == self.retries - 1:
+                    print(f"Failed to fetch title_id {title_id} after {self.retries} retries. Response Code: {e}")
+                    return None
+                time.sleep(self._backoff_delay(attempt))
+                continue
+            metrics.observe('api_latency', time.perf_counter() - start, status=response.status_code)
+
+            if response.status_code in RETRY_STATUS_CODES:
+                if attempt == self.retries - 1:
+                    print(f"Failed to fetch title_id {title_id} after {self.retries} retries. Response Code: {response.status_code}")
+                    return None
+                time.sleep(self._backoff_delay(attempt, response))
+                continue
+
+            if response.status_code == 304 and cached_record is not None:
+                self.cache.touch(title_id)
+                return cached_record
+
+            try:
+                response.raise_for_status()
+            except requests.HTTPError as e:
+                print(f"Failed to fetch title_id {title_id}. Response Code: {e.response.status_code}")
+                return None
+            print(f"Successfully fetched title_id {title_id}.")
+            title_record = json.loads(response.text)
+            if self.cache is not None:
+                self.cache.put(title_id, title_record, response.headers.get('ETag'))
+            return title_record
+        return None
+
+    def get_titles(self, title_ids) -> list:
+        """
+        Get the title records for a list of title_ids. Each distinct title_id is looked up once: fresh records come
+        from the cache and the rest are fetched, up to max_workers of them at the same time.
+        Returns a list of title records (or None where a record could not be fetched) in the same order as title_ids.
+        """
+        title_ids = list(title_ids)
+        unique_ids = list(dict.fromkeys(title_ids))
+        title_records = self.cache.get_many(unique_ids) if self.cache is not None else {}
+        missing_ids = [title_id for title_id in unique_ids if title_id not in title_records]
+        if len(missing_ids) == 1:
+            title_records[missing_ids[0]] = self._fetch_title(missing_ids[0])
+        elif missing_ids:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                title_records.update(zip(missing_ids, executor.map(self._fetch_title, missing_ids)))
+        return [title_records.get(title_id) for title_id in title_ids]
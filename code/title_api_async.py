@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# Functionality to fetch title records from the readallaboutit.com.au api (api) with an asyncio client:
+# concurrent requests for the same title_id are coalesced into one, connections are kept alive (over HTTP/2 where
+# the server offers it), and optionally the records of many title_ids are fetched with one multi-id request.
+
+import asyncio
+import json
+import threading
+import time
+from urllib.parse import urlparse
+
+import metrics
+from title_api import BASE_URL, RETRY_STATUS_CODES, RateLimiter, TitleLookup, backoff_delay
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import h2
+except ImportError:
+    h2 = None
+
+CLIENTS = ['async', 'threads']
+
+# The multi-id endpoint: GET /api/v1/titles?ids=1,2,3 returns a JSON list of the records found
+BATCH_PATH = '/api/v1/titles'
+
+# The most title_ids asked for in one multi-id request, to keep the url short
+MAX_BATCH_IDS = 100
+
+# Status codes that mean the server has no multi-id endpoint
+NO_BATCH_STATUS_CODES = {400, 404, 405, 501}
+
+
+def _batch_records(body: str) -> dict:
+    """
+    This function parses the answer of a multi-id request, which should be a JSON list of title records each with
+    an 'id'. Returns the records keyed by title_id, or None if the answer has any other shape.
+    """
+    try:
+        records = json.loads(body)
+        if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+            return None
+        return {int(record['id']): record for record in records}
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+class AsyncTitleClient:
+    """
+    Fetches title records from the readallaboutit api with asyncio, over one pooled httpx.AsyncClient.
+
+    Every title_id being fetched has one future: a caller asking for a title_id that is already in flight waits for
+    that request instead of sending another, so sheets checked at the same time never fetch the same record twice.
+    The title_ids that have to be fetched are sent as one GET per title_id (as TitleLookup does), with at most
+    max_connections of them in flight. With batch, they are asked for with the multi-id endpoint (BATCH_PATH) instead,
+    MAX_BATCH_IDS at a time; title_ids missing from its answer are fetched singly, and if the server has no such
+    endpoint or answers with something other than a list of records, the client remembers it and falls back to one GET
+    per title_id. Stale cached records are always revalidated with a conditional per-id GET, so their ETag can be used.
+
+    Parameters:
+    base_url (str): The scheme and host of the api, e.g. 'https://readallaboutit.com.au' or the url of a local stub server.
+    max_connections (int): The maximum number of connections (and per-id requests in flight).
+    requests_per_second (float): The maximum rate of requests per host. None or 0 means no limit.
+    timeout (float): The connect/read timeout in seconds for each request.
+    retries (int): The number of attempts for a request before giving up.
+    backoff (float): The base delay in seconds for exponential backoff between attempts.
+    max_backoff (float): The cap in seconds on a single backoff delay.
+    cache (title_cache.TitleCache): An optional persistent cache of title records (see TitleLookup).
+    batch (bool): Try the multi-id endpoint. Off by default, as the readallaboutit api is not known to have it.
+    """
+
+    def __init__(self, base_url=BASE_URL, max_connections=8, requests_per_second=10.0, timeout=10.0,
+                 retries=3, backoff=0.5, max_backoff=30.0, cache=None, batch=False):
+        if httpx is None:
+            raise ImportError("httpx is needed for the async title client")
+        self.base_url = base_url.rstrip('/')
+        self.cache = cache
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limiter = RateLimiter(requests_per_second)
+        # None until the first multi-id request shows whether the server has the endpoint
+        self.batch_supported = None if batch else False
+        # HTTP/2 needs the h2 package; without it the client keeps HTTP/1.1 connections alive instead
+        self.client = httpx.AsyncClient(
+            http2=h2 is not None, timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+        self._in_flight = {}
+        self._tasks = set()
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    def build_url(self, title_id: int) -> str:
+        """Builds the url to query the api with, given a title_id."""
+        return f"{self.base_url}/api/v1/title/{title_id}"
+
+    async def _wait_for_slot(self, url: str) -> None:
+        delay = self.rate_limiter.reserve(urlparse(url).netloc)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def get_title(self, title_id: int) -> dict:
+        """Get a title record from the readallaboutit api given a title_id. Returns None if it could not be fetched."""
+        return (await self.get_titles([title_id]))[0]
+
+    async def get_titles(self, title_ids) -> list:
+        """
+        Get the title records for a list of title_ids. Fresh records come from the cache; the other title_ids are
+        fetched, joining the requests already in flight for any of them.
+        Returns a list of title records (or None where a record could not be fetched) in the same order as title_ids.
+        """
+        title_ids = list(title_ids)
+        unique_ids = list(dict.fromkeys(title_ids))
+        title_records = self.cache.get_many(unique_ids) if self.cache is not None else {}
+        missing_ids = [title_id for title_id in unique_ids if title_id not in title_records]
+
+        new_ids = [title_id for title_id in missing_ids if title_id not in self._in_flight]
+        if len(new_ids) < len(missing_ids):
+            metrics.count('api_coalesced', len(missing_ids) - len(new_ids))
+        loop = asyncio.get_running_loop()
+        for title_id in new_ids:
+            self._in_flight[title_id] = loop.create_future()
+        futures = [self._in_flight[title_id] for title_id in missing_ids]
+        if new_ids:
+            # The fetch runs as its own task, so a caller that gives up does not cancel it for the others waiting
+            task = asyncio.ensure_future(self._resolve(new_ids))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        title_records.update(zip(missing_ids, await asyncio.gather(*futures)))
+        return [title_records.get(title_id) for title_id in title_ids]
+
+    async def _resolve(self, title_ids: list) -> None:
+        """Fetches the records of title_ids and settles their futures."""
+        try:
+            # Stale cached records are revalidated one at a time, with their ETag
+            stale_ids = set()
+            if self.cache is not None:
+                stale_ids = {title_id for title_id in title_ids if self.cache.get_stale(title_id)[1]}
+            batch_ids = [title_id for title_id in title_ids if title_id not in stale_ids]
+            single_ids = [title_id for title_id in title_ids if title_id in stale_ids]
+            if self.batch_supported is False:
+                single_ids, batch_ids = title_ids, []
+
+            chunks = [batch_ids[start:start + MAX_BATCH_IDS] for start in range(0, len(batch_ids), MAX_BATCH_IDS)]
+            if chunks and self.batch_supported is None:
+                # Find out whether the server has the multi-id endpoint with the first chunk before sending the rest
+                await self._fetch_batch_or_singly(chunks.pop(0))
+            await asyncio.gather(*(self._fetch_batch_or_singly(chunk) for chunk in chunks),
+                                 *(self._fetch_and_settle(title_id) for title_id in single_ids))
+        except Exception as e:
+            for title_id in title_ids:
+                future = self._in_flight.get(title_id)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+        finally:
+            for title_id in title_ids:
+                future = self._in_flight.pop(title_id, None)
+                if future is not None and not future.done():
+                    future.set_result(None)
+
+    def _settle(self, title_id: int, record: dict) -> None:
+        future = self._in_flight.get(title_id)
+        if future is not None and not future.done():
+            future.set_result(record)
+
+    async def _fetch_and_settle(self, title_id: int) -> None:
+        self._settle(title_id, await self._fetch_title(title_id))
+
+    async def _fetch_batch_or_singly(self, title_ids: list) -> None:
+        records = await self._fetch_batch(title_ids) if self.batch_supported is not False else None
+        if records is None:
+            records = {}
+        for title_id in title_ids:
+            if title_id in records:
+                self._settle(title_id, records[title_id])
+        # The title_ids the multi-id request did not return are fetched singly
+        await asyncio.gather(*(self._fetch_and_settle(title_id) for title_id in title_ids if title_id not in records))
+
+    async def _fetch_batch(self, title_ids: list) -> dict:
+        """
+        Fetch the records of title_ids with one multi-id request. Returns them keyed by title_id (title_ids the api
+        did not return are left out), or None if they could not be fetched this way and should be fetched singly.
+        An answer that is not a list of records with an 'id' turns the multi-id endpoint off for the rest of the run.
+        """
+        url = self.base_url + BATCH_PATH
+        params = {'ids': ','.join(str(title_id) for title_id in title_ids)}
+        for attempt in range(self.retries):
+            await self._wait_for_slot(url)
+            metrics.count('api_requests', endpoint='batch')
+            start = time.perf_counter()
+            try:
+                response = await self.client.get(url, params=params)
+            except httpx.TransportError as e:
+                metrics.observe('api_latency', time.perf_counter() - start, status='error', endpoint='batch')
+                print(f"Connection error when fetching {len(title_ids)} title records: {e}. Retrying...")
+                await asyncio.sleep(backoff_delay(attempt, self.backoff, self.max_backoff))
+                continue
+            metrics.observe('api_latency', time.perf_counter() - start, status=response.status_code, endpoint='batch')
+
+            if response.status_code in NO_BATCH_STATUS_CODES:
+                if self.batch_supported is None:
+                    print("The api has no multi-id endpoint, fetching title records one at a time")
+                self.batch_supported = False
+                return None
+            if response.status_code in RETRY_STATUS_CODES:
+                await asyncio.sleep(backoff_delay(attempt, self.backoff, self.max_backoff, response))
+                continue
+            if response.status_code != 200:
+                print(f"Failed to fetch {len(title_ids)} title records. Response Code: {response.status_code}")
+                return None
+            records = _batch_records(response.text)
+            if records is None:
+                print("The api's multi-id endpoint did not answer with a list of title records, "
+                      "fetching title records one at a time")
+                self.batch_supported = False
+                return None
+            self.batch_supported = True
+            print(f"Successfully fetched {len(records)} of {len(title_ids)} title records.")
+            if self.cache is not None:
+                for title_id, record in records.items():
+                    self.cache.put(title_id, record)
+            return records
+        print(f"Failed to fetch {len(title_ids)} title records after {self.retries} retries, fetching them one at a time")
+        return None
+
+    async def _fetch_title(self, title_id: int) -> dict:
+        """
+        Fetch a title record from the api with a GET for its title_id, bypassing the fresh records in the cache.
+        If the cache holds a stale copy with an ETag, the request is made conditional and a 304 response reuses the copy.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        url = self.build_url(title_id)
+        headers = {}
+        cached_record, etag = self.cache.get_stale(title_id) if self.cache is not None else (None, None)
+        if etag:
+            headers['If-None-Match'] = etag
+
+        async with self._semaphore:
+            for attempt in range(self.retries):
+                await self._wait_for_slot(url)
+                if attempt:
+                    metrics.count('api_retries')
+                metrics.count('api_requests')
+                start = time.perf_counter()
+                try:
+                    response = await self.client.get(url, headers=headers)
+                except httpx.TransportError as e:
+                    metrics.observe('api_latency', time.perf_counter() - start, status='error')
+                    print(f"Connection error when fetching title_id {title_id}: {e}. Retrying...")
+                    if attempt == self.retries - 1:
+                        print(f"Failed to fetch title_id {title_id} after {self.retries} retries. Response Code: {e}")
+                        return None
+                    await asyncio.sleep(backoff_delay(attempt, self.backoff, self.max_backoff))
+                    continue
+                metrics.observe('api_latency', time.perf_counter() - start, status=response.status_code)
+
+                if response.status_code in RETRY_STATUS_CODES:
+                    if attempt == self.retries - 1:
+                        print(f"Failed to fetch title_id {title_id} after {self.retries} retries. Response Code: {response.status_code}")
+                        return None
+                    await asyncio.sleep(backoff_delay(attempt, self.backoff, self.max_backoff, response))
+                    continue
+
+                if response.status_code == 304 and cached_record is not None:
+                    self.cache.touch(title_id)
+                    return cached_record
+
+                if response.status_code != 200:
+                    print(f"Failed to fetch title_id {title_id}. Response Code: {response.status_code}")
+                    return None
+                print(f"Successfully fetched title_id {title_id}.")
+                title_record = json.loads(response.text)
+                if self.cache is not None:
+                    self.cache.put(title_id, title_record, response.headers.get('ETag'))
+                return title_record
+        return None
+
+
+class AsyncTitleLookup:
+    """
+    A synchronous wrapper around AsyncTitleClient with the interface of TitleLookup (get_title, get_titles,
+    build_url, close), so it can be passed wherever a TitleLookup is used.
+    The client runs on an event loop in a background thread; calls from any number of threads are run on that loop,
+    so their requests for the same title_id are coalesced.
+
+    Parameters are those of TitleLookup, with max_workers as the client's max_connections, and batch as for
+    AsyncTitleClient.
+    """
+
+    def __init__(self, base_url=BASE_URL, max_workers=8, requests_per_second=10.0, timeout=10.0,
+                 retries=3, backoff=0.5, max_backoff=30.0, cache=None, batch=False):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+        async def create_client():
+            return AsyncTitleClient(base_url, max_workers, requests_per_second, timeout, retries, backoff,
+                                    max_backoff, cache, batch)
+        self.client = self._run(create_client())
+        self.base_url = self.client.base_url
+        self.cache = cache
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        if self._loop.is_closed():
+            return
+        self._run(self.client.aclose())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def build_url(self, title_id: int) -> str:
+        """Builds the url to query the api with, given a title_id."""
+        return self.client.build_url(title_id)
+
+    def get_title(self, title_id: int) -> dict:
+        """Get a title record from the readallaboutit api given a title_id. Returns None if it could not be fetched."""
+        return self._run(self.client.get_title(title_id))
+
+    def get_titles(self, title_ids) -> list:
+        """Get the title records for a list of title_ids (see AsyncTitleClient.get_titles)."""
+        return self._run(self.client.get_titles(title_ids))
+
+
+def create_lookup(client='async', base_url=BASE_URL, max_workers=8, requests_per_second=10.0, timeout=10.0,
+                  cache=None, batch=False):
+    """
+    This function returns the lookup engine for the given client: 'async' (AsyncTitleLookup) or 'threads'
+    (TitleLookup). 'async' falls back to 'threads' (with a message) if httpx is not installed.
+    batch turns on the multi-id endpoint of the async client (see AsyncTitleClient); the threaded client has none.
+    """
+    if client not in CLIENTS:
+        raise ValueError(f"Unknown title client '{client}', expected one of {CLIENTS}")
+    if client == 'async' and httpx is None:
+        print("httpx is not installed, fetching title records with the threaded client instead")
+        client = 'threads'
+    if client == 'async':
+        return AsyncTitleLookup(base_url, max_workers=max_workers, requests_per_second=requests_per_second,
+                                timeout=timeout, cache=cache, batch=batch)
+    return TitleLookup(base_url, max_workers=max_workers, requests_per_second=requests_per_second, timeout=timeout,
+                       cache=cache)
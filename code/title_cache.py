@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# A persistent, size-bounded cache of readallaboutit title records keyed by title_id,
+# stored in a local SQLite database so that reruns only query the api for new title_ids.
+
+import json
+import sqlite3
+import threading
+import time
+
+import metrics
+
+# SQLite limits the number of parameters in a single statement
+_MAX_PARAMS = 500
+
+
+class TitleCache:
+    """
+    Stores title records in a SQLite database.
+
+    Records older than ttl seconds are stale: they are not returned by get/get_many, but their ETag is kept
+    (see get_stale) so the caller can revalidate them with a conditional request instead of downloading them again.
+    When the cache holds more than max_entries records the least recently used ones are evicted.
+
+    Parameters:
+    path (str): The path to the SQLite database file. It is created if it does not exist.
+    ttl (float): The number of seconds a record is fresh for. None means records never go stale.
+    max_entries (int): The maximum number of records to keep.
+    """
+
+    def __init__(self, path: str, ttl=7 * 24 * 60 * 60, max_entries=200000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # The lookup engine reads and writes from its worker threads, so one connection is shared behind a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS titles ('
+            ' title_id INTEGER PRIMARY KEY,'
+            ' record TEXT NOT NULL,'
+            ' etag TEXT,'
+            ' fetched_at REAL NOT NULL,'
+            ' last_used REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS titles_last_used ON titles (last_used)')
+        self._conn.commit()
+        self._count = self._conn.execute('SELECT COUNT(*) FROM titles').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _is_fresh(self, fetched_at: float, now: float) -> bool:
+        return self.ttl is None or now - fetched_at < self.ttl
+
+    def get(self, title_id: int) -> dict:
+        """Returns the cached title record for title_id, or None if it is not cached or is stale."""
+        return self.get_many([title_id]).get(title_id)
+
+    def get_many(self, title_ids) -> dict:
+        """
+        Returns the fresh cached title records for the given title_ids as a dict keyed by title_id.
+        title_ids that are not cached, or whose records are stale, are left out.
+        """
+        title_ids = list(title_ids)
+        now = time.time()
+        found = {}
+        with self._lock:
+            for start in range(0, len(title_ids), _MAX_PARAMS):
+                chunk = title_ids[start:start + _MAX_PARAMS]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f'SELECT title_id, record, fetched_at FROM titles WHERE title_id IN ({placeholders})', chunk
+                ).fetchall()
+                for title_id, record, fetched_at in rows:
+                    if self._is_fresh(fetched_at, now):
+                        found[title_id] = json.loads(record)
+            if found:
+                self._conn.executemany('UPDATE titles SET last_used = ? WHERE title_id = ?',
+                                       [(now, title_id) for title_id in found])
+                self._conn.commit()
+        self.hits += len(found)
+        self.misses += len(title_ids) - len(found)
+        metrics.count('cache_hits', len(found))
+        metrics.count('cache_misses', len(title_ids) - len(found))
+        return found
+
+    def get_stale(self, title_id: int) -> tuple:
+        """Returns (record, etag) for title_id whether or not it is fresh, or (None, None) if it is not cached."""
+        with self._lock:
+            row = self._conn.execute('SELECT record, etag FROM titles WHERE title_id = ?', (title_id,)).fetchone()
+        if row is None:
+            return None, None
+        return json.loads(row[0]), row[1]
+
+    def put(self, title_id: int, record: dict, etag=None) -> None:
+        """Stores a title record (and the ETag it was served with), evicting the least recently used records if the cache is full."""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute('SELECT 1 FROM titles WHERE title_id = ?', (title_id,))
+            is_new = cursor.fetchone() is None
+            self._conn.execute('INSERT OR REPLACE INTO titles VALUES (?, ?, ?, ?, ?)',
+                               (title_id, json.dumps(record), etag, now, now))
+            if is_new:
+                self._count += 1
+            if self.max_entries and self._count > self.max_entries:
+                excess = self._count - self.max_entries
+                self._conn.execute(
+                    'DELETE FROM titles WHERE title_id IN '
+                    '(SELECT title_id FROM titles ORDER BY last_used LIMIT ?)', (excess,))
+                self._count -= excess
+            self._conn.commit()
+
+    def touch(self, title_id: int) -> None:
+        """Marks a stale record as fresh again, after the api confirmed (304 Not Modified) that it has not changed."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('UPDATE titles SET fetched_at = ?, last_used = ? WHERE title_id = ?',
+                               (now, now, title_id))
+            self._conn.commit()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# An offline index of readallaboutit title records, built from a bulk export, so that stage 3 can validate
+# (title_id, Trove Title) pairs without querying the api and suggest the likely title_id for rows that fail.
+
+import argparse
+import collections
+import heapq
+import json
+import re
+import sqlite3
+import time
+
+import requests
+from rapidfuzz import fuzz
+
+from title_match import DEFAULT_TOLERANCE, candidate_pairs, is_match
+
+# The export endpoint of the api: GET /api/v1/titles/export?since=<updated_at> returns a JSON list of the title
+# records updated at or after since (all of them without it)
+EXPORT_PATH = '/api/v1/titles/export'
+
+# The number of variants (ranked by shared trigrams) that are scored for each suggestion
+SUGGESTION_CANDIDATES = 50
+
+NON_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+LEADING_ARTICLE = re.compile(r'^(the|a|an) ')
+
+
+def normalize_title(title: str) -> str:
+    """Lowercases a title and reduces all punctuation and whitespace to single spaces."""
+    return NON_ALPHANUMERIC.sub(' ', (title or '').lower()).strip()
+
+
+def title_variants(publication_title: str, common_title: str) -> set:
+    """Returns the normalized variants a title record is indexed under: both titles, with and without a leading article."""
+    variants = set()
+    for title in (publication_title, common_title):
+        normalized = normalize_title(title)
+        if normalized:
+            variants.add(normalized)
+            variants.add(LEADING_ARTICLE.sub('', normalized))
+    return variants
+
+
+def trigrams(text: str) -> set:
+    """Returns the trigrams of a normalized title, padded so that short titles and word starts have trigrams too."""
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def read_export(source: str, since=None) -> list:
+    """
+    This function reads title records from a bulk export: a JSON file holding a list of records (each with 'id',
+    'publication_title', 'common_title' and optionally 'updated_at'), or the url of the api's export endpoint,
+    which is asked only for the records updated at or after since.
+    """
+    if source.startswith(('http://', 'https://')):
+        url = source.rstrip('/')
+        if not url.endswith(EXPORT_PATH):
+            url += EXPORT_PATH
+        response = requests.get(url, params={'since': since} if since else None, timeout=60)
+        response.raise_for_status()
+        return response.json()
+    with open(source, 'r') as json_file:
+        return json.load(json_file)
+
+
+class TitleIndex:
+    """
+    Title records stored in a local SQLite database, with the normalized variants of each title indexed by trigram.
+
+    A TitleIndex can be used in place of a TitleLookup (get_title / get_titles): the records come from the index, so
+    check_titles makes exactly the decisions it makes with the api, without any requests. suggest() returns the
+    title_id whose title best matches a sheet title, for rows whose title does not match their title_id.
+    The records are loaded into memory when the index is opened; the trigram postings are built on the first suggestion.
+
+    Parameters:
+    path (str): The path to the SQLite database. It is created if it does not exist.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS titles ('
+            ' title_id INTEGER PRIMARY KEY,'
+            ' publication_title TEXT,'
+            ' common_title TEXT,'
+            ' updated_at TEXT)'
+        )
+        self._conn.commit()
+        self.records = {}
+        for title_id, publication_title, common_title in self._conn.execute(
+                'SELECT title_id, publication_title, common_title FROM titles'):
+            self.records[title_id] = {'id': title_id, 'publication_title': publication_title,
+                                      'common_title': common_title}
+        self._variants = None
+        self._postings = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    def close(self) -> None:
+        self._conn.close()
+
+    @property
+    def watermark(self) -> str:
+        """The latest 'updated_at' of the records in the index, or None if the exports had none."""
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'watermark'").fetchone()
+        return row[0] if row else None
+
+    def update(self, records) -> dict:
+        """
+        This function adds title records to the index, replacing the stored records with the same title_id.
+        A record is only written if it is new or differs from the stored one.
+
+        Returns:
+        dict: The number of records 'added', 'changed' and 'unchanged'.
+        """
+        counts = {'added': 0, 'changed': 0, 'unchanged': 0}
+        watermark = self.watermark
+        rows = []
+        for record in records:
+            title_id = int(record['id'])
+            stored = {'id': title_id, 'publication_title': record.get('publication_title'),
+                      'common_title': record.get('common_title')}
+            updated_at = record.get('updated_at')
+            if updated_at is not None:
+                updated_at = str(updated_at)
+                watermark = max(watermark, updated_at) if watermark else updated_at
+            previous = self.records.get(title_id)
+            if previous == stored:
+                counts['unchanged'] += 1
+                continue
+            counts['changed' if previous is not None else 'added'] += 1
+            self.records[title_id] = stored
+            rows.append((title_id, stored['publication_title'], stored['common_title'], updated_at))
+        with self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO titles VALUES (?, ?, ?, ?)', rows)
+            if watermark:
+                self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('watermark', ?)", (watermark,))
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('refreshed_at', ?)", (str(time.time()),))
+        if rows:
+            # The trigram postings are rebuilt on the next suggestion
+            self._variants = self._postings = None
+        return counts
+
+    def refresh(self, source: str) -> dict:
+        """
+        This function updates the index from an export (see read_export). An export url is only asked for the
+        records updated since the index's watermark.
+        """
+        return self.update(read_export(source, self.watermark))
+
+    def get_title(self, title_id: int) -> dict:
+        """Returns the title record for title_id, or None if it is not in the index."""
+        return self.records.get(title_id)
+
+    def get_titles(self, title_ids) -> list:
+        """Returns the title record (or None) for each title_id, in order."""
+        return [self.records.get(title_id) for title_id in title_ids]
+
+    def _build_postings(self) -> None:
+        self._variants = []
+        self._postings = collections.defaultdict(list)
+        # In title_id order, so an index refreshed in this process and one loaded from disk rank ties the same way
+        for title_id, record in sorted(self.records.items()):
+            for variant in sorted(title_variants(record['publication_title'], record['common_title'])):
+                position = len(self._variants)
+                self._variants.append(title_id)
+                for trigram in trigrams(variant):
+                    self._postings[trigram].append(position)
+
+    def suggest(self, title: str, tolerance=DEFAULT_TOLERANCE, candidates=SUGGESTION_CANDIDATES) -> tuple:
+        """
+        This function suggests the title_id whose record best matches a sheet title.
+        The variants sharing the most trigrams with the title are scored the way check_titles scores a title against
+        its record (see title_match.candidate_pairs), so a suggested title_id would pass the check. Ties are broken
+        by the order of the variants in the index, so the same index always makes the same suggestion.
+
+        Parameters:
+        title (str): The sheet title.
+        tolerance (int): The minimum fuzz ratio for a suggestion.
+        candidates (int): The number of variants to score.
+
+        Returns:
+        tuple: (title_id, score) of the best match, or (None, None) if no record reaches the tolerance.
+        """
+        if self._postings is None:
+            self._build_postings()
+        shared = collections.Counter()
+        for trigram in trigrams(normalize_title(title)):
+            shared.update(self._postings.get(trigram, ()))
+        best_id, best_score = None, None
+        scored = set()
+        # Not Counter.most_common, which breaks ties in the order the trigrams of the title happen to be iterated in
+        for position, _ in heapq.nsmallest(candidates, shared.items(), key=lambda item: (-item[1], item[0])):
+            title_id = self._variants[position]
+            if title_id in scored:
+                continue
+            scored.add(title_id)
+            record = self.records[title_id]
+            score = max(fuzz.ratio(a, b) for a, b in candidate_pairs(title, record['publication_title'],
+                                                                      record['common_title']))
+            if best_score is None or score > best_score:
+                best_id, best_score = title_id, score
+        if best_score is None or not is_match(best_score, tolerance):
+            return None, None
+        return best_id, best_score
+
+    def suggest_many(self, titles, tolerance=DEFAULT_TOLERANCE) -> list:
+        """Returns the suggested title_id (or None) for each title, suggesting once per distinct title."""
+        suggestions = {}
+        for title in titles:
+            if title not in suggestions:
+                suggestions[title] = self.suggest(title, tolerance)[0]
+        return [suggestions[title] for title in titles]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build, refresh and query the offline index of title records.')
+    parser.add_argument('index_path', help='the SQLite file of the index')
+    parser.add_argument('--refresh', metavar='SOURCE',
+                        help='add the records of a bulk export (a JSON file, or the api url to fetch the records '
+                             'changed since the last refresh from)')
+    parser.add_argument('--suggest', metavar='TITLE', help='suggest the title_id for a sheet title')
+    parser.add_argument('--check', nargs=2, metavar=('TITLE_ID', 'TITLE'), help='check a title_id and sheet title pair')
+    args = parser.parse_args()
+
+    with TitleIndex(args.index_path) as index:
+        if args.refresh:
+            counts = index.refresh(args.refresh)
+            print(f"{counts['added']} added, {counts['changed']} changed, {counts['unchanged']} unchanged")
+        print(f"{len(index)} title records, updated up to {index.watermark}")
+        if args.suggest:
+            title_id, score = index.suggest(args.suggest)
+            print(f"suggested title_id: {title_id} (score {score})" if title_id else "no title matches")
+        if args.check:
+            from title_match import batch_fuzzy_check, record_triples
+            title_id, title = int(args.check[0]), args.check[1]
+            match = batch_fuzzy_check(record_triples([title], [index.get_title(title_id)]))[0]
+            print('match' if match else 'no match')
+
+
+if __name__ == "__main__":
+    main()
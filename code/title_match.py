@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Functionality to fuzzy match sheet titles against title records ('publication_title' and
+# 'common_title') in bulk, with the same prefix-truncation rules as fuzzy_check_title_id_string_pair.
+
+from rapidfuzz import fuzz, process
+
+import metrics
+
+DEFAULT_TOLERANCE = 75
+
+
+def candidate_pairs(title: str, publication_title: str, common_title: str) -> tuple:
+    """
+    Returns the two (record string, sheet string) pairs that fuzzy_check_title_id_string_pair compares, after
+    lowercasing and truncating. Which side is truncated depends on how the sheet title's length compares
+    with the publication title's:
+    - shorter: both record titles are cut to the sheet title's length;
+    - longer: the sheet title is cut to each record title's length;
+    - equal: nothing is cut.
+    """
+    publication_title = publication_title or ''
+    common_title = common_title or ''
+    title = (title or '').lower()
+    title_len = len(title)
+    pub_title_len = len(publication_title)
+    if title_len < pub_title_len:
+        return ((publication_title[:title_len].lower(), title),
+                (common_title[:title_len].lower(), title))
+    if title_len > pub_title_len:
+        return ((publication_title.lower(), title[:pub_title_len]),
+                (common_title.lower(), title[:len(common_title)]))
+    return ((publication_title.lower(), title),
+            (common_title.lower(), title))
+
+
+def is_match(score: float, tolerance=DEFAULT_TOLERANCE) -> bool:
+    """thefuzz.fuzz.ratio rounds rapidfuzz's score to an int before it is compared with the tolerance."""
+    return int(round(score)) >= tolerance
+
+
+def _score_pairs(pairs: list, tolerance: float) -> list:
+    """
+    Scores a list of distinct (a, b) string pairs with rapidfuzz's ratio. Pairs that cannot reach the tolerance
+    after rounding score 0, which lets rapidfuzz stop early on them.
+    """
+    if not pairs:
+        return []
+    score_cutoff = tolerance - 0.5
+    if hasattr(process, 'cpdist'):
+        firsts, seconds = zip(*pairs)
+        return process.cpdist(firsts, seconds, scorer=fuzz.ratio, score_cutoff=score_cutoff).tolist()
+    return [fuzz.ratio(a, b, score_cutoff=score_cutoff) for a, b in pairs]
+
+
+def batch_fuzzy_check(triples, tolerance=DEFAULT_TOLERANCE) -> list:
+    """
+    Checks many sheet titles against their title records at once.
+
+    Parameters:
+    triples (iterable): (title, publication_title, common_title) for each row, or None for a row whose title
+    record could not be fetched.
+    tolerance (int): The minimum fuzz ratio for a match.
+
+    Returns:
+    list: True for each row whose title matches its 'publication_title' or 'common_title', in the same order.
+    The decisions are the same as calling fuzzy_check_title_id_string_pair on each row.
+    """
+    with metrics.timer('fuzzy_match') as timer:
+        results = _batch_fuzzy_check(triples, tolerance)
+        timer.rows = len(results)
+    return results
+
+
+def _batch_fuzzy_check(triples, tolerance) -> list:
+    row_pairs = []
+    pair_positions = {}
+    # Each distinct triple is normalized and truncated once, and each distinct pair is scored once
+    normalized = {}
+    for triple in triples:
+        if triple is None:
+            row_pairs.append(None)
+            continue
+        pairs = normalized.get(triple)
+        if pairs is None:
+            pairs = normalized[triple] = candidate_pairs(*triple)
+        for pair in pairs:
+            pair_positions.setdefault(pair, len(pair_positions))
+        row_pairs.append(pairs)
+
+    scores = _score_pairs(list(pair_positions), tolerance)
+    matched = [is_match(score, tolerance) for score in scores]
+    return [pairs is not None and (matched[pair_positions[pairs[0]]] or matched[pair_positions[pairs[1]]])
+            for pairs in row_pairs]
+
+
+def record_triples(titles, title_records) -> list:
+    """Pairs up sheet titles with their title records as the (title, publication_title, common_title) triples batch_fuzzy_check takes."""
+    return [(title, title_record['publication_title'], title_record['common_title']) if title_record else None
+            for title, title_record in zip(titles, title_records)]
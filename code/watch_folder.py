@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+This program watches a folder (e.g. the local copy of the OneDrive folder the new sheets are synced to) and runs each
+Excel sheet that lands in it through stages 1 to 3 (see pipeline.py) as soon as it has finished arriving, instead of
+the stage scripts being rerun over the whole folder by hand.
+
+- The folder is watched with watchdog (inotify on Linux, FSEvents on macOS) if it is installed, otherwise it is
+  polled every few seconds. Either way it is scanned once at the start, so the sheets that arrived while nothing was
+  watching are caught up (those already in the pipeline's manifest are skipped).
+- A sheet is only processed once it has settled: its size and mtime have not changed for settle_seconds and it is a
+  complete Excel file (a partly synced .xlsx is a truncated zip). The events of a file being synced, and the
+  temporary files of Excel ('~$...') and of the sync client (hidden files), are ignored.
+- Each sheet is classified from its header row (see sheet_schema): a post-migration sheet, which already has its new
+  title_ids, skips stage 1. A sheet missing a column the stages need is listed in 'column_not_found.txt'.
+- The mappings index, the title lookup (with its pooled connections and title cache) and the title index stay loaded
+  between sheets, so a sheet's safe / not safe outputs are written seconds after it lands. The mappings index is
+  reloaded if the mappings JSON changes.
+"""
+
+import os
+import queue
+import signal
+import threading
+import time
+import zipfile
+
+import metrics
+from mappings_index import load_mappings_index
+from pipeline import OUTPUT_FOLDER, run_pipeline
+from pipeline_state import PipelineState
+from sheet_schema import report_unprocessable, sniff_sheet
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+DEFAULT_SETTLE_SECONDS = 2.0
+DEFAULT_POLL_SECONDS = 2.0
+
+# How often the sheets waiting to settle are checked
+_TICK_SECONDS = 0.25
+
+# The watchdog events of a file being written ('closed' is a close after writing)
+WRITE_EVENTS = ('created', 'modified', 'moved', 'closed')
+
+# The layouts of the sheets that already have their new title_ids, and so skip stage 1
+POST_MIGRATION_LAYOUTS = ('post_migration', 'updated')
+
+
+def is_sheet(file_path: str) -> bool:
+    """Returns True for an Excel sheet, and False for the temporary files of Excel ('~$...') and of sync clients."""
+    name = os.path.basename(file_path)
+    return name.lower().endswith('.xlsx') and not name.startswith(('~$', '.'))
+
+
+def is_complete(file_path: str) -> bool:
+    """
+    Returns True if an Excel file has been written completely. An .xlsx file is a zip, whose directory is written
+    at its end, so a partly synced (truncated) file is not a readable zip yet.
+    """
+    return zipfile.is_zipfile(file_path)
+
+
+def _signature(file_path: str) -> tuple:
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime
+
+
+def _event_handler(events: queue.Queue, watched_dir: str):
+    """Returns a watchdog event handler that puts the path of each sheet written to watched_dir (absolute) on events."""
+
+    class SheetEventHandler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            # Only writes: the stages reading a sheet raise 'opened' events, which must not queue it again
+            if event.is_directory or event.event_type not in WRITE_EVENTS:
+                return
+            # A sheet written elsewhere and renamed into place arrives as a move
+            for file_path in (event.src_path, getattr(event, 'dest_path', None)):
+                if file_path and os.path.dirname(file_path) == watched_dir and is_sheet(file_path):
+                    events.put(file_path)
+
+    return SheetEventHandler()
+
+
+class PendingSheets:
+    """
+    The sheets seen arriving, each held until it has settled: its size and mtime are unchanged for settle_seconds
+    and it is a complete Excel file. This debounces the stream of events of a file being synced, and a sheet is never
+    read while it is still being written.
+
+    Parameters:
+    settle_seconds (float): How long a sheet must stay unchanged before it is processed.
+    """
+
+    def __init__(self, settle_seconds=DEFAULT_SETTLE_SECONDS):
+        self.settle_seconds = settle_seconds
+        # [signature, time since when it has not changed, time first seen] by path
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, file_path: str) -> None:
+        """Starts tracking a sheet (a sheet already tracked keeps the time it was first seen)."""
+        if file_path not in self._pending:
+            self._pending[file_path] = [None, None, time.monotonic()]
+
+    def ready(self) -> list:
+        """
+        This function checks the tracked sheets and stops tracking those that have settled or been removed.
+
+        Returns:
+        list: (path, time first seen) of each sheet that has settled, by path.
+        """
+        now = time.monotonic()
+        ready = []
+        for file_path, entry in list(self._pending.items()):
+            try:
+                signature = _signature(file_path)
+            except OSError:
+                # Removed (or renamed) before it settled
+                del self._pending[file_path]
+                continue
+            if signature != entry[0]:
+                entry[0], entry[1] = signature, now
+            elif now - entry[1] >= self.settle_seconds and is_complete(file_path):
+                del self._pending[file_path]
+                ready.append((file_path, entry[2]))
+        return sorted(ready)
+
+
+class SheetWatcher:
+    """
+    Watches a folder and runs each new or changed sheet through stages 1 to 3 (see the module docstring).
+
+    Parameters:
+    input_dir (str): The folder to watch. The outputs are written to its 'pipeline_output' folder.
+    json_file_path (str): The path to remote_old_to_new_mappings.json.
+    title_lookup (TitleLookup): The lookup engine for the title records, kept open between sheets.
+    settle_seconds (float): How long a sheet must stay unchanged before it is processed.
+    poll_seconds (float): How often the folder is scanned when it is polled.
+    polling (bool): Poll the folder even if watchdog is installed (e.g. for network drives, which send no events).
+    pipeline_options: The other arguments of pipeline.run_pipeline (backend, batch_size, output_format,
+    title_index, ...).
+    """
+
+    def __init__(self, input_dir: str, json_file_path: str, title_lookup=None, settle_seconds=DEFAULT_SETTLE_SECONDS,
+                 poll_seconds=DEFAULT_POLL_SECONDS, polling=False, **pipeline_options):
+        # Absolute, as the paths watchdog reports are
+        self.input_dir = os.path.abspath(input_dir)
+        self.json_file_path = json_file_path
+        self.title_lookup = title_lookup
+        self.poll_seconds = poll_seconds
+        self.polling = polling or Observer is None
+        self.pipeline_options = pipeline_options
+        self.output_dir = os.path.join(self.input_dir, OUTPUT_FOLDER)
+        self.pending = PendingSheets(settle_seconds)
+        # The schema of each sheet seen, for the report of the sheets that can't be processed
+        self.schemas = {}
+        self.summary = {'processed': {}, 'failed': {}, 'unprocessable': {}}
+        # Paths of the sheets that may have changed, put by the watchdog thread or by scan()
+        self._events = queue.Queue()
+        # The signature of each sheet when the folder was last scanned
+        self._scanned = {}
+        self._observer = None
+
+    def scan(self) -> None:
+        """Queues the sheets in the folder that are new or have changed since the last scan."""
+        scanned = {}
+        with os.scandir(self.input_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and is_sheet(entry.path):
+                    stat = entry.stat()
+                    scanned[entry.path] = (stat.st_size, stat.st_mtime)
+                    if self._scanned.get(entry.path) != scanned[entry.path]:
+                        self._events.put(entry.path)
+        self._scanned = scanned
+
+    def start(self) -> None:
+        """Loads the mappings index, starts watching the folder and queues the sheets already in it."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        with metrics.timer('mappings_load', stage='watch', loader='index'):
+            load_mappings_index(self.json_file_path)
+        if not self.polling:
+            self._observer = Observer()
+            self._observer.schedule(_event_handler(self._events, self.input_dir), self.input_dir, recursive=False)
+            self._observer.start()
+            print(f"Watching {self.input_dir} for new sheets")
+        else:
+            if Observer is None:
+                print("watchdog is not installed, so the folder is polled (pip install watchdog to be notified of "
+                      "new sheets instead)")
+            print(f"Polling {self.input_dir} for new sheets every {self.poll_seconds}s")
+        self.scan()
+
+    def stop(self) -> None:
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+    def process_sheet(self, file_path: str, seen_at: float) -> None:
+        """
+        This function runs one settled sheet through the stages: stages 1 to 3 for a pre-migration sheet, stages 2
+        and 3 for a post-migration one. Sheets already processed (with the same content and mappings) are skipped.
+
+        Parameters:
+        file_path (str): The path to the sheet.
+        seen_at (float): When the sheet was first seen (time.monotonic()), to measure the latency of its outputs.
+        """
+        schema = sniff_sheet(file_path, 'pipeline')
+        update_ids = schema.layout not in POST_MIGRATION_LAYOUTS
+        if not update_ids:
+            schema = sniff_sheet(file_path, 'pipeline_post_migration')
+        was_processable = file_path not in self.schemas or self.schemas[file_path].processable
+        self.schemas[file_path] = schema
+        if not schema.processable or not was_processable:
+            # Rewrite the list of the sheets that can't be processed
+            self.summary['unprocessable'] = report_unprocessable(self.schemas, self.output_dir)
+        if not schema.processable:
+            return
+        stage = 'pipeline' if update_ids else 'pipeline_post_migration'
+        mappings_index = load_mappings_index(self.json_file_path)
+        state = PipelineState(self.output_dir, stage, self.json_file_path, mappings_index.source_sha256,
+                              read_only=True)
+        if state.is_done(file_path):
+            return
+        print(f"{file_path} ({schema.layout.replace('_', '-')} sheet{'' if update_ids else ', skipping stage 1'})")
+        summary = run_pipeline(self.input_dir, self.json_file_path, self.title_lookup, update_ids,
+                               file_list=[file_path], schemas={file_path: schema}, **self.pipeline_options)
+        if file_path in summary['failed']:
+            self.summary['failed'][file_path] = summary['failed'][file_path]
+            return
+        self.summary['processed'][file_path] = summary['processed'].get(file_path)
+        latency = time.monotonic() - seen_at
+        metrics.observe('watch_latency', latency, stage='watch', sheet=file_path)
+        print(f"{file_path}: outputs written {latency:.1f}s after it was first seen")
+
+    def run(self, stop_event=None) -> dict:
+        """
+        This function watches the folder and processes each sheet once it has settled, until it is interrupted
+        (Ctrl-C), terminated (SIGTERM, e.g. by a service manager) or stop_event is set.
+
+        Parameters:
+        stop_event (threading.Event): Stops the watcher when set.
+
+        Returns:
+        dict: The sheets processed ('processed', with the rows per outcome), those that failed ('failed', with the
+        error) and those that can't be processed ('unprocessable', with the reason).
+        """
+        stop_event = stop_event or threading.Event()
+        if threading.current_thread() is threading.main_thread():
+            # Finish the sheet being processed, then stop
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+        self.start()
+        last_scan = time.monotonic()
+        try:
+            while not stop_event.is_set():
+                try:
+                    self.pending.add(self._events.get(timeout=_TICK_SECONDS))
+                    while True:
+                        self.pending.add(self._events.get_nowait())
+                except queue.Empty:
+                    pass
+                if self.polling and time.monotonic() - last_scan >= self.poll_seconds:
+                    self.scan()
+                    last_scan = time.monotonic()
+                for file_path, seen_at in self.pending.ready():
+                    self.process_sheet(file_path, seen_at)
+        except KeyboardInterrupt:
+            print("Stopped watching")
+        finally:
+            self.stop()
+        print(f"Processed {len(self.summary['processed'])} sheets, failed {len(self.summary['failed'])}, "
+              f"unprocessable {len(self.summary['unprocessable'])}")
+        return self.summary
@@ -0,0 +1,403 @@
+"""
+This module reads the first sheet of data from an Excel file into a DataFrame through one of several reader backends:
+- 'pandas': pd.read_excel with the openpyxl engine (the original behaviour).
+- 'openpyxl': openpyxl in read-only mode, streaming the rows with iter_rows(values_only=True).
+- 'calamine': the Rust calamine reader (python-calamine), used when it is installed.
+The 'openpyxl' and 'calamine' backends can resolve the header row first and keep only the columns the caller needs,
+and all backends build the DataFrame with the same parser pandas uses, so column names and dtypes match read_excel.
+A sheet can also be read chunk by chunk (see iter_sheet_chunks), holding only one chunk of rows in memory at a time.
+"""
+
+import itertools
+import re
+import time
+import zipfile
+from xml.etree import ElementTree
+
+import numpy as np
+import pandas as pd
+from pandas.io.parsers import TextParser
+
+from table_io import common_dtype
+
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+
+BACKENDS = ['pandas', 'openpyxl', 'calamine']
+
+
+def resolve_backend(backend: str) -> str:
+    """
+    This function returns the backend to use for the requested one, falling back to 'openpyxl' (with a message)
+    if the requested backend is not installed.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown reader backend '{backend}', expected one of {BACKENDS}")
+    if backend == 'calamine' and CalamineWorkbook is None:
+        print("python-calamine is not installed, falling back to the openpyxl reader")
+        return 'openpyxl'
+    return backend
+
+
+def resolve_columns(header: list, usecols=None, columns=None) -> list:
+    """
+    This function works out which column positions to keep from a sheet's header row.
+
+    Parameters:
+    header (list): The values of the header row.
+    usecols (list): Column positions to consider, e.g. range(33). None means all columns.
+    columns (list): Regular expressions (case-insensitive) for the column names to keep. None keeps every column in usecols.
+
+    Returns:
+    list: The positions of the columns to keep, in sheet order.
+    """
+    positions = range(len(header)) if usecols is None else [i for i in usecols if i < len(header)]
+    if columns is None:
+        return list(positions)
+    patterns = [re.compile(column, re.IGNORECASE) for column in columns]
+    return [i for i in positions
+            if header[i] not in (None, '') and any(p.search(str(header[i])) for p in patterns)]
+
+
+def _convert_cell(value):
+    """Converts a cell value the way pandas' openpyxl reader does: empty cells become '' and whole floats become ints."""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _rows_to_frame(rows, usecols=None, columns=None) -> pd.DataFrame:
+    """
+    This function turns an iterator of sheet rows (header first) into a DataFrame, keeping only the resolved columns
+    and trimming trailing empty cells and rows the same way pd.read_excel does.
+    """
+    rows = iter(rows)
+    header = [_convert_cell(value) for value in next(rows, [])]
+    keep = resolve_columns(header, usecols, columns)
+
+    data = []
+    last_row_with_data = -1
+    for row in itertools.chain([header], rows):
+        converted_row = [_convert_cell(row[i]) if i < len(row) else '' for i in keep]
+        while converted_row and converted_row[-1] == '':
+            # trim trailing empty elements
+            converted_row.pop()
+        if converted_row:
+            last_row_with_data = len(data)
+        data.append(converted_row)
+    # Trim trailing empty rows
+    data = data[:last_row_with_data + 1]
+    if not data:
+        return pd.DataFrame()
+
+    # extend rows to max width
+    width = max(len(data_row) for data_row in data)
+    data = [data_row + [''] * (width - len(data_row)) for data_row in data]
+    # Name empty header cells after their position in the sheet, as read_excel would, not their position after pruning
+    data[0] = [name if name != '' else f'Unnamed: {keep[i]}' for i, name in enumerate(data[0])]
+    return TextParser(data, header=0, skip_blank_lines=False).read()
+
+
+def _iter_openpyxl_rows(file_path: str, sheet_name: str, max_col=None):
+    import openpyxl
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = workbook[sheet_name]
+        # The dimensions recorded in read-only workbooks are not always right, so let openpyxl work them out
+        sheet.reset_dimensions()
+        yield from sheet.iter_rows(max_col=max_col, values_only=True)
+    finally:
+        workbook.close()
+
+
+def _iter_calamine_rows(file_path: str, sheet_name: str):
+    workbook = CalamineWorkbook.from_path(file_path)
+    yield from workbook.get_sheet_by_name(sheet_name).to_python(skip_empty_area=False)
+
+
+def read_sheet(file_path: str, sheet_name='Sheet1', usecols=None, columns=None, backend='pandas') -> tuple:
+    """
+    This function reads a sheet of an Excel file into a DataFrame with the given backend.
+
+    Parameters:
+    file_path (str): The path to the Excel file.
+    sheet_name (str): The name of the sheet to read.
+    usecols (list): Column positions to read, e.g. range(33). None reads all columns.
+    columns (list): Regular expressions for the column names to keep. Not supported by the 'pandas' backend,
+    which falls back to 'openpyxl' when columns are given.
+    backend (str): One of 'pandas', 'openpyxl' or 'calamine'.
+
+    Returns:
+    tuple: (DataFrame, the backend used, parse time in seconds)
+    """
+    backend = resolve_backend(backend)
+    if backend == 'pandas' and columns is not None:
+        backend = 'openpyxl'
+    start = time.perf_counter()
+    if backend == 'pandas':
+        df = pd.read_excel(file_path, sheet_name=sheet_name, usecols=usecols)
+    elif backend == 'openpyxl':
+        # Stop parsing each row after the last column that could be needed
+        max_col = max(usecols) + 1 if usecols is not None and len(usecols) else None
+        df = _rows_to_frame(_iter_openpyxl_rows(file_path, sheet_name, max_col), usecols, columns)
+    else:
+        df = _rows_to_frame(_iter_calamine_rows(file_path, sheet_name), usecols, columns)
+    return df, backend, time.perf_counter() - start
+
+
+def _iter_sheet_rows(file_path: str, sheet_name: str, backend: str):
+    """
+    Yields the rows of a sheet with their cells converted (see _convert_cell) and trailing empty cells trimmed,
+    leaving out the empty rows at the end of the sheet, as read_excel does.
+    """
+    backend = resolve_backend(backend)
+    rows = _iter_calamine_rows(file_path, sheet_name) if backend == 'calamine' else \
+        _iter_openpyxl_rows(file_path, sheet_name)
+    empty_rows = 0
+    for row in rows:
+        converted_row = [_convert_cell(value) for value in row]
+        while converted_row and converted_row[-1] == '':
+            converted_row.pop()
+        if not converted_row:
+            # Only kept if a row with data follows
+            empty_rows += 1
+            continue
+        yield from [[]] * empty_rows
+        empty_rows = 0
+        yield converted_row
+
+
+def _iter_row_chunks(rows, chunk_rows: int):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _header_names(header: list, width: int) -> list:
+    """Pads the header row to width and names its empty cells after their position, as read_excel does."""
+    header = header + [''] * (width - len(header))
+    return [name if name != '' else f'Unnamed: {i}' for i, name in enumerate(header)]
+
+
+def _parse_chunk(header: list, chunk: list, dtype=None) -> pd.DataFrame:
+    width = len(header)
+    data = [header] + [row[:width] + [''] * (width - len(row)) for row in chunk]
+    return TextParser(data, header=0, skip_blank_lines=False, dtype=dtype).read()
+
+
+def scan_sheet(file_path: str, chunk_rows: int, sheet_name='Sheet1', backend='openpyxl') -> tuple:
+    """
+    This function reads a sheet chunk by chunk and works out the header and column dtypes read_excel would give it if
+    it read the whole sheet (a chunk on its own can infer a different dtype, see table_io.scan_csv_dtypes).
+
+    Parameters:
+    file_path (str): The path to the Excel file.
+    chunk_rows (int): The number of rows to parse at a time.
+    sheet_name (str): The name of the sheet to read.
+    backend (str): 'openpyxl' or 'calamine'.
+
+    Returns:
+    tuple: (the header row, padded to the widest row, the dtype of each column by name, the set of object columns
+    holding values other than strings, e.g. numbers mixed with text, which can only be read as objects)
+    """
+    rows = _iter_sheet_rows(file_path, sheet_name, backend)
+    header = next(rows, [])
+    width = len(header)
+    dtypes = [[] for _ in range(width)]
+    mixed = set()
+    chunks = 0
+    for chunk in _iter_row_chunks(rows, chunk_rows):
+        width = max([width] + [len(row) for row in chunk])
+        # Columns that only start in this chunk were empty (so float64) in every earlier chunk
+        dtypes.extend([np.dtype('float64')] * chunks for _ in range(width - len(dtypes)))
+        df = _parse_chunk(_header_names(header, width), chunk)
+        for position, column_dtypes in enumerate(dtypes):
+            column_dtypes.append(df.dtypes.iloc[position])
+            if df.dtypes.iloc[position] == object and \
+                    pd.api.types.infer_dtype(df.iloc[:, position], skipna=True) not in ('string', 'empty'):
+                mixed.add(position)
+        chunks += 1
+    header = _header_names(header, width)
+    names = _parse_chunk(header, []).columns
+    dtypes = {name: common_dtype(column_dtypes) for name, column_dtypes in zip(names, dtypes) if column_dtypes}
+    return header, dtypes, {names[position] for position in mixed}
+
+
+def iter_sheet_chunks(file_path: str, chunk_rows: int, sheet_name='Sheet1', backend='openpyxl', header=None,
+                      dtype=None):
+    """
+    This function reads a sheet of an Excel file chunk by chunk, streaming its rows with the openpyxl (read-only) or
+    calamine reader, so only one chunk of rows is held in memory at a time.
+
+    Parameters:
+    file_path (str): The path to the Excel file.
+    chunk_rows (int): The number of rows in each chunk (the last chunk may be shorter).
+    sheet_name (str): The name of the sheet to read.
+    backend (str): 'openpyxl' or 'calamine'.
+    header (list): The header row to use, e.g. from scan_sheet. None uses the sheet's first row as it is.
+    dtype (dict): The dtype of each column, e.g. from scan_sheet. None infers the dtypes of each chunk on its own.
+
+    Yields:
+    pandas.DataFrame: Each chunk, indexed by the position of its rows in the sheet.
+    """
+    rows = _iter_sheet_rows(file_path, sheet_name, backend)
+    first_row = next(rows, [])
+    header = header if header is not None else _header_names(first_row, len(first_row))
+    start = 0
+    for chunk in _iter_row_chunks(rows, chunk_rows):
+        df = _parse_chunk(header, chunk, dtype)
+        df.index = pd.RangeIndex(start, start + len(df))
+        start += len(df)
+        yield df
+
+
+# The XML namespaces of the parts of an xlsx file that read_header reads
+_MAIN = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_RELATIONSHIPS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_PACKAGE_RELATIONSHIPS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+CELL_REFERENCE = re.compile(r'([A-Z]+)(\d+)')
+
+
+def _column_number(letters: str) -> int:
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - ord('A') + 1
+    return number
+
+
+def _string_item_text(item) -> str:
+    """Returns the text of a shared or inline string, joining its rich text runs and leaving out phonetic runs."""
+    parts = []
+    for child in item:
+        if child.tag == _MAIN + 't':
+            parts.append(child.text or '')
+        elif child.tag == _MAIN + 'r':
+            parts.append(child.findtext(_MAIN + 't') or '')
+    return ''.join(parts)
+
+
+def _cell_value(cell, shared_strings: dict):
+    """Returns the value of a header cell the way openpyxl reads it (numbers as ints or floats, strings as str)."""
+    cell_type = cell.get('t', 'n')
+    if cell_type == 'inlineStr':
+        item = cell.find(_MAIN + 'is')
+        return _string_item_text(item) if item is not None else None
+    value = cell.findtext(_MAIN + 'v')
+    if value is None:
+        return None
+    if cell_type == 's':
+        return shared_strings[int(value)]
+    if cell_type == 'b':
+        return value == '1'
+    if cell_type == 'n':
+        number = float(value)
+        return int(number) if number.is_integer() and 'E' not in value.upper() and '.' not in value else number
+    return value
+
+
+def _read_shared_strings(archive, path: str, indices: set) -> dict:
+    """Reads the shared strings with the given indices, stopping at the last of them rather than reading them all."""
+    strings = {}
+    if not indices:
+        return strings
+    last = max(indices)
+    position = 0
+    for _, element in ElementTree.iterparse(archive.open(path), events=('end',)):
+        if element.tag != _MAIN + 'si':
+            continue
+        if position in indices:
+            strings[position] = _string_item_text(element)
+        if position == last:
+            break
+        position += 1
+        element.clear()
+    return strings
+
+
+def _read_xlsx_header(file_path: str, sheet_name: str) -> tuple:
+    """
+    Reads the first row and the recorded dimensions of a sheet straight from the XML in the xlsx file, stopping at the
+    end of the first row (and of the shared strings it uses), so the cost does not grow with the size of the sheet.
+    """
+    with zipfile.ZipFile(file_path) as archive:
+        workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        sheet = next(sheet for sheet in workbook.iter(_MAIN + 'sheet') if sheet.get('name') == sheet_name)
+        relationships = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+        targets = {relationship.get('Id'): relationship.get('Target')
+                   for relationship in relationships.iter(_PACKAGE_RELATIONSHIPS + 'Relationship')}
+        target = targets[sheet.get(_RELATIONSHIPS + 'id')]
+        sheet_path = target.lstrip('/') if target.startswith('/') else 'xl/' + target
+
+        width = 0
+        cells = []
+        for _, element in ElementTree.iterparse(archive.open(sheet_path), events=('end',)):
+            if element.tag == _MAIN + 'dimension':
+                last_cell = CELL_REFERENCE.match(element.get('ref', '').split(':')[-1])
+                width = _column_number(last_cell.group(1)) if last_cell else 0
+            elif element.tag == _MAIN + 'row':
+                # The header is the sheet's first row; if that is empty, there is no row 1 in the XML
+                if element.get('r', '1') == '1':
+                    cells = list(element.iter(_MAIN + 'c'))
+                break
+            elif element.tag == _MAIN + 'sheetData':
+                break
+
+        shared_strings = {}
+        indices = {int(cell.findtext(_MAIN + 'v')) for cell in cells
+                   if cell.get('t') == 's' and cell.findtext(_MAIN + 'v') is not None}
+        if indices:
+            shared_strings = _read_shared_strings(archive, 'xl/sharedStrings.xml', indices)
+
+    header = []
+    for cell in cells:
+        reference = CELL_REFERENCE.match(cell.get('r', ''))
+        column = _column_number(reference.group(1)) if reference else len(header) + 1
+        header.extend([None] * (column - 1 - len(header)))
+        header.append(_cell_value(cell, shared_strings))
+    return header, width
+
+
+def _read_openpyxl_header(file_path: str, sheet_name: str) -> tuple:
+    import openpyxl
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = workbook[sheet_name]
+        width = sheet.max_column or 0
+        return list(next(sheet.iter_rows(max_row=1, values_only=True), ())), width
+    finally:
+        workbook.close()
+
+
+def read_header(file_path: str, sheet_name='Sheet1') -> tuple:
+    """
+    This function reads only the header row of a sheet of an Excel file, without parsing the rest of the sheet.
+    The row is read straight from the sheet's XML, falling back to the read-only openpyxl reader for files laid out
+    in a way it does not handle.
+
+    Parameters:
+    file_path (str): The path to the Excel file.
+    sheet_name (str): The name of the sheet to read.
+
+    Returns:
+    tuple: (the column names read_excel would give the sheet, the number of columns the sheet spans, taken from the
+    dimensions recorded in the file where they are wider than the header)
+    """
+    try:
+        first_row, width = _read_xlsx_header(file_path, sheet_name)
+    except (KeyError, StopIteration, ValueError, ElementTree.ParseError):
+        first_row, width = _read_openpyxl_header(file_path, sheet_name)
+    header = [_convert_cell(value) for value in first_row]
+    while header and header[-1] == '':
+        header.pop()
+    names = list(_parse_chunk(_header_names(header, len(header)), []).columns)
+    return names, max(width, len(names))